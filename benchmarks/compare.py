@@ -0,0 +1,81 @@
+# -*- coding: future_fstrings -*-
+# Compares two result files of benchmarks.run (e.g. of two versions)
+#
+# Runs are matched by instance and options, repeated runs are reduced to their median.
+# Options listed in --ignore-options are not matched, e.g. to compare two backends on the same instances.
+# Exits with 1 if a run got slower by more than --threshold or the results differ.
+#
+# python -m benchmarks.compare old.jsonl new.jsonl [--metric calc_seconds] [--threshold 1.2] [--ignore-options backend]
+import argparse
+import json
+import math
+import statistics
+import sys
+
+METRICS = ["calc_seconds", "setup_seconds", "wall_seconds"]
+
+# {(instance, options): (median of metric, results)}
+def load(fname, metric, ignore = []):
+    runs = {}
+    with open(fname) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            r = json.loads(line)
+            # results of versions without the backend axis were run on PostgreSQL
+            options = dict({"backend": "postgres"}, **r["options"])
+            key = (r["instance"], json.dumps({k: v for k, v in options.items() if k not in ignore}, sort_keys=True))
+            times, results = runs.setdefault(key, ([], set()))
+            if r["status"] == "ok" and r[metric] is not None:
+                times.append(r[metric])
+            if r["result"] not in (None, ""):
+                results.add(r["result"])
+    return {k: (statistics.median(t) if t else None, res) for k, (t, res) in runs.items()}
+
+def options_str(options):
+    o = json.loads(options)
+    return " ".join(f"{k}={v}" for k, v in o.items() if v not in ("", None))
+
+def compare(old, new, threshold = 1.2, min_seconds = 0.05):
+    rows = []
+    for key in sorted(set(old) & set(new)):
+        (t_old, r_old), (t_new, r_new) = old[key], new[key]
+        if t_old is None or t_new is None:
+            flag = "FAILED" if t_new is None and t_old is not None else ""
+            ratio = None
+        else:
+            ratio = max(t_new, min_seconds) / max(t_old, min_seconds)
+            flag = "SLOWER" if ratio > threshold else "faster" if ratio < 1 / threshold else ""
+        if r_old and r_new and r_old != r_new:
+            flag = "RESULT"
+        rows.append((key, t_old, t_new, ratio, flag))
+    return rows
+
+def fmt(t):
+    return f"{t:10.3f}" if t is not None else f"{'-':>10}"
+
+def report(rows, only_old, only_new):
+    print(f"{'instance':<36} {'options':<44} {'old':>10} {'new':>10} {'ratio':>7}")
+    for (instance, options), t_old, t_new, ratio, flag in sorted(rows, key=lambda r: (not r[4], -(r[3] or 0))):
+        print(f"{instance:<36} {options_str(options):<44} {fmt(t_old)} {fmt(t_new)} {ratio if ratio is not None else 0:7.2f} {flag}")
+    ratios = [r[3] for r in rows if r[3]]
+    if ratios:
+        print(f"geometric mean ratio: {math.exp(sum(map(math.log, ratios)) / len(ratios)):.3f} ({len(ratios)} runs)")
+    if only_old or only_new:
+        print(f"unmatched runs: {len(only_old)} only old, {len(only_new)} only new")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("old", help="Results of the baseline")
+    parser.add_argument("new", help="Results to compare")
+    parser.add_argument("--metric", help="Time to compare", choices=METRICS, default="calc_seconds")
+    parser.add_argument("--threshold", type=float, help="Ratio new/old above which a run counts as a regression", default=1.2)
+    parser.add_argument("--ignore-options", dest="ignore_options", nargs="+", help="Options not used to match runs", default=[])
+    parser.add_argument("--min-seconds", dest="min_seconds", type=float, help="Times are rounded up to this to ignore noise of short runs", default=0.05)
+    opts = parser.parse_args()
+
+    old = load(opts.old, opts.metric, opts.ignore_options)
+    new = load(opts.new, opts.metric, opts.ignore_options)
+    rows = compare(old, new, opts.threshold, opts.min_seconds)
+    report(rows, set(old) - set(new), set(new) - set(old))
+    sys.exit(1 if any(r[4] in ("SLOWER", "FAILED", "RESULT") for r in rows) else 0)
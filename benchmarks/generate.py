@@ -0,0 +1,125 @@
+# -*- coding: future_fstrings -*-
+# Generates benchmark instances with controlled treewidth
+#
+#   kcnf:   random k-CNF whose clauses lie in the cliques of a random partial k-tree (treewidth <= width)
+#   window: chained formula, each clause over a window of width + 1 consecutive variables (deep, path like TDs)
+#   grid:   rows x cols grid graph for vc (treewidth min(rows, cols)), ladders are grids with 2 rows
+#
+# python -m benchmarks.generate [--suite default] [--out benchmarks/instances] [--seed 1]
+#
+# Writes the instances and instances.json, the list of instances read by benchmarks.run.
+import argparse
+import json
+import logging
+import os
+import random
+
+from dpdb.writer import FileWriter
+
+logger = logging.getLogger("benchmarks.generate")
+
+# (kind, parameters), instance files are named after both
+SUITES = {
+    "small": [
+        ("kcnf", dict(n=40, width=5, clauses=100, k=3)),
+        ("window", dict(n=60, width=4, clauses=150, k=3)),
+        ("grid", dict(rows=4, cols=8)),
+        ("grid", dict(rows=2, cols=30)),
+    ],
+    "default": [
+        ("kcnf", dict(n=80, width=6, clauses=200, k=3)),
+        ("kcnf", dict(n=120, width=8, clauses=300, k=3)),
+        ("kcnf", dict(n=150, width=10, clauses=400, k=4)),
+        ("window", dict(n=200, width=6, clauses=500, k=3)),
+        ("window", dict(n=400, width=8, clauses=1000, k=3)),
+        ("grid", dict(rows=6, cols=20)),
+        ("grid", dict(rows=8, cols=20)),
+        ("grid", dict(rows=2, cols=200)),
+    ]
+}
+
+# random partial k-tree: each vertex is attached to a random k-clique, edges are kept with probability keep
+# returns the edges and the (k+1)-cliques of the underlying k-tree
+def partial_ktree(n, k, rng, keep = 0.8):
+    cliques = [list(range(1, min(n, k + 1) + 1))]
+    # k-cliques new vertices can be attached to
+    attach = [cliques[0][:i] + cliques[0][i + 1:] for i in range(len(cliques[0]))] if n > k else []
+    for v in range(k + 2, n + 1):
+        base = rng.choice(attach)
+        cliques.append(base + [v])
+        attach.extend([base[:i] + base[i + 1:] + [v] for i in range(k)])
+    edges = set()
+    for c in cliques:
+        for i, u in enumerate(c):
+            for w in c[i + 1:]:
+                if (u, w) not in edges and rng.random() < keep:
+                    edges.add((min(u, w), max(u, w)))
+    return sorted(edges), cliques
+
+def random_clause(variables, k, rng):
+    return [v if rng.random() < 0.5 else -v for v in rng.sample(variables, min(k, len(variables)))]
+
+def kcnf(n, width, clauses, k, rng):
+    _, cliques = partial_ktree(n, width, rng)
+    return n, [random_clause(rng.choice(cliques), k, rng) for _ in range(clauses)]
+
+def window(n, width, clauses, k, rng):
+    formula = []
+    for _ in range(clauses):
+        start = rng.randint(1, max(n - width, 1))
+        formula.append(random_clause(list(range(start, min(start + width, n) + 1)), k, rng))
+    return n, formula
+
+def grid(rows, cols):
+    vertex = lambda r, c: r * cols + c + 1
+    edges = []
+    for r in range(rows):
+        for c in range(cols):
+            if c + 1 < cols:
+                edges.append((vertex(r, c), vertex(r, c + 1)))
+            if r + 1 < rows:
+                edges.append((vertex(r, c), vertex(r + 1, c)))
+    return rows * cols, edges
+
+def write_cnf(fname, num_vars, clauses):
+    with open(fname, "w") as f:
+        f.write(f"p cnf {num_vars} {len(clauses)}\n")
+        for c in clauses:
+            f.write(" ".join(map(str, c + [0])) + "\n")
+
+def instance_name(kind, params, seed):
+    return "_".join([kind] + [f"{k}{v}" for k, v in params.items()] + [f"s{seed}"])
+
+# writes the instances of suite to out, returns their descriptions
+def generate(suite, out, seed = 1):
+    if suite not in SUITES:
+        raise ValueError(f"Unknown suite {suite}, one of {', '.join(SUITES)}")
+    os.makedirs(out, exist_ok=True)
+    instances = []
+    for i, (kind, params) in enumerate(SUITES[suite]):
+        rng = random.Random(seed * 1000 + i)
+        name = instance_name(kind, params, seed)
+        if kind == "grid":
+            fname = f"{name}.tw"
+            with FileWriter(os.path.join(out, fname)) as fw:
+                fw.write_gr(*grid(**params))
+            problem, args = "vc", ["--input-format", "tw"]
+        else:
+            fname = f"{name}.cnf"
+            write_cnf(os.path.join(out, fname), *(kcnf if kind == "kcnf" else window)(rng=rng, **params))
+            problem, args = "sharpsat", []
+        instances.append({"name": name, "file": fname, "problem": problem, "args": args, "kind": kind, "params": params, "seed": seed})
+    with open(os.path.join(out, "instances.json"), "w") as f:
+        json.dump(instances, f, indent=1)
+    logger.info("Wrote %d instances to %s", len(instances), out)
+    return instances
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--suite", help="Instance suite", choices=list(SUITES), default="default")
+    parser.add_argument("--out", help="Output directory", default=os.path.join("benchmarks", "instances"))
+    parser.add_argument("--seed", type=int, help="Random seed", default=1)
+    opts = parser.parse_args()
+
+    logging.basicConfig(format='[%(levelname)s] %(name)s: %(message)s', level=logging.INFO)
+    generate(opts.suite, opts.out, opts.seed)
@@ -0,0 +1,190 @@
+# -*- coding: future_fstrings -*-
+# Microbenchmarks of the python stages before the first SQL statement runs (no database needed)
+#
+# Each stage is timed (best of --repeat runs) and memory profiled (tracemalloc peak) on generated
+# inputs of increasing size. The slope of log(time) over log(size) is about 1 for linear stages,
+# stages with a larger slope than --max-slope are flagged (and the exit status is 1).
+#
+#   cnf_read, cnf2primal, sat_filter, assignment_view: chained formula of n variables (benchmarks.generate.window)
+#   td_read, treedecomp, postorder: path decomposition of n bags (deep trees)
+#   vc_filter: VertexCover.edge_filter of a bag with n edges
+#
+# python -m benchmarks.micro [--stages ...] [--sizes 2000 4000 8000 16000] [--out micro.jsonl]
+import argparse
+import gc
+import json
+import math
+import random
+import sys
+import time
+import tracemalloc
+
+from collections import defaultdict
+from datetime import datetime
+
+from dpdb.reader import CnfReader, TdReader
+from dpdb.treedecomp import TreeDecomp
+from dpdb.problems.sat_util import cnf2primal, filter
+from dpdb.problems.sharpsat import SharpSat
+from dpdb.problems.vertexcover import VertexCover
+from benchmarks.generate import window
+from benchmarks.run import version
+
+WIDTH = 8
+
+# pool without connections, the stages do not run SQL
+class NoDatabase(object):
+    def getconn(self):
+        return None
+
+    def putconn(self, conn):
+        pass
+
+def cnf_text(n):
+    num_vars, clauses = window(n, WIDTH, 3 * n, 3, random.Random(n))
+    return "p cnf {} {}\n".format(num_vars, len(clauses)) + "".join(" ".join(map(str, c + [0])) + "\n" for c in clauses)
+
+# path decomposition of the chained formula, bag i contains variables i..i+WIDTH
+def td_text(n):
+    bags = max(n - WIDTH, 1)
+    lines = [f"s td {bags} {WIDTH + 1} {n}", "c r 1"]
+    lines += [f"b {i} {' '.join(map(str, range(i, min(i + WIDTH, n) + 1)))}" for i in range(1, bags + 1)]
+    lines += [f"{i} {i + 1}" for i in range(1, bags)]
+    return "\n".join(lines) + "\n"
+
+def read_td(n):
+    tdr = TdReader.from_string(td_text(n))
+    return TreeDecomp(tdr.num_bags, tdr.tree_width, tdr.num_orig_vertices, tdr.root, tdr.bags, tdr.adjacency_list)
+
+def sharpsat(n):
+    p = SharpSat("micro", NoDatabase())
+    cnf = CnfReader.from_string(cnf_text(n))
+    p.var_clause_dict = defaultdict(set)
+    cnf2primal(cnf.num_vars, cnf.clauses, p.var_clause_dict)
+    p.set_td(read_td(n))
+    return p
+
+def vertexcover(n):
+    # clique with about n edges in a single bag
+    k = int((1 + math.sqrt(1 + 8 * n)) / 2)
+    p = VertexCover("micro", NoDatabase(), "tw")
+    p.edges = {v: [w for w in range(1, k + 1) if w != v] for v in range(1, k + 1)}
+    return p, list(range(1, k + 1))
+
+# stage -> setup(size) returning the function to measure
+def cnf_read(n):
+    text = cnf_text(n)
+    return lambda: CnfReader.from_string(text)
+
+def primal(n):
+    cnf = CnfReader.from_string(cnf_text(n))
+    return lambda: cnf2primal(cnf.num_vars, cnf.clauses, defaultdict(set))
+
+def td_read(n):
+    text = td_text(n)
+    return lambda: TdReader.from_string(text)
+
+def treedecomp(n):
+    tdr = TdReader.from_string(td_text(n))
+    return lambda: TreeDecomp(tdr.num_bags, tdr.tree_width, tdr.num_orig_vertices, tdr.root, tdr.bags, tdr.adjacency_list)
+
+def postorder(n):
+    td = read_td(n)
+    return td.postorder
+
+def sat_filter(n):
+    p = sharpsat(n)
+    nodes = p.td.nodes
+    return lambda: [filter(p.var_clause_dict, node) for node in nodes]
+
+def assignment_view(n):
+    p = sharpsat(n)
+    nodes = p.td.nodes
+    return lambda: [p.assignment_view(node) for node in nodes]
+
+def vc_filter(n):
+    p, vertices = vertexcover(n)
+    return lambda: p.edge_filter(vertices)
+
+STAGES = {
+    "cnf_read": cnf_read,
+    "cnf2primal": primal,
+    "td_read": td_read,
+    "treedecomp": treedecomp,
+    "postorder": postorder,
+    "sat_filter": sat_filter,
+    "assignment_view": assignment_view,
+    "vc_filter": vc_filter
+}
+
+# like timeit without garbage collection during the timed runs
+def measure(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        start = time.perf_counter()
+        fn()
+        t = time.perf_counter() - start
+        gc.enable()
+        best = t if best is None else min(best, t)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+# least squares slope of log(y) over log(x)
+def slope(xs, ys):
+    lx = [math.log(x) for x in xs]
+    ly = [math.log(max(y, 1e-9)) for y in ys]
+    mx, my = sum(lx) / len(lx), sum(ly) / len(ly)
+    return sum((a - mx) * (b - my) for a, b in zip(lx, ly)) / sum((a - mx) ** 2 for a in lx)
+
+def run(stages, sizes, repeat = 3):
+    res = {}
+    for name in stages:
+        res[name] = []
+        for n in sizes:
+            t, peak = measure(STAGES[name](n), repeat)
+            res[name].append((n, t, peak))
+    return res
+
+def report(res, max_slope):
+    flagged = []
+    sizes = [n for n, _, _ in next(iter(res.values()))]
+    print(f"{'stage':<16}" + "".join(f"{n:>12}" for n in sizes) + f"{'slope':>8}{'peak MB':>10}")
+    for name, rows in res.items():
+        s = slope([n for n, _, _ in rows], [t for _, t, _ in rows])
+        flag = ""
+        if s > max_slope:
+            flag = "SUPERLINEAR"
+            flagged.append(name)
+        print(f"{name:<16}" + "".join(f"{t * 1000:>10.2f}ms" for _, t, _ in rows) + f"{s:>8.2f}{rows[-1][2] / 2**20:>10.1f} {flag}")
+    return flagged
+
+# records in the format of benchmarks.run, to be compared with benchmarks.compare
+def write(fname, res, label = None):
+    meta = {"version": version(), "label": label, "date": datetime.now().isoformat(timespec="seconds")}
+    with open(fname, "a") as f:
+        for name, rows in res.items():
+            for n, t, peak in rows:
+                f.write(json.dumps(dict(meta, instance=f"{name}_{n}", problem="micro", options={}, repeat=0, id=None,
+                    status="ok", result=None, tree_width=None, setup_seconds=None, calc_seconds=t, wall_seconds=t,
+                    peak_bytes=peak)) + "\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), help="Stages to run", default=list(STAGES))
+    parser.add_argument("--sizes", type=int, nargs="+", help="Input sizes (variables, bags or edges)", default=[2000, 4000, 8000, 16000])
+    parser.add_argument("--repeat", type=int, help="Runs per size, the fastest is reported", default=3)
+    parser.add_argument("--max-slope", dest="max_slope", type=float, help="Flag stages whose time grows faster than size^max-slope", default=1.5)
+    parser.add_argument("--out", help="Append the results to this file (JSON lines, see benchmarks.compare)")
+    parser.add_argument("--label", help="Label of the results")
+    opts = parser.parse_args()
+
+    res = run(opts.stages, sorted(opts.sizes), opts.repeat)
+    flagged = report(res, opts.max_slope)
+    if opts.out:
+        write(opts.out, res, opts.label)
+    sys.exit(1 if flagged else 0)
@@ -0,0 +1,117 @@
+# -*- coding: future_fstrings -*-
+# Checks that --execution-mode numpy and the SQL path (node worker threads) give the same results
+#
+# The cnf instances of a suite of benchmarks.generate are solved as sat and as sharpsat (with both
+# --numpy-counts), its graphs as vc. Chains (x1 v x2) (x2 v x3) ... add known model counts beyond
+# 2^63 and 2^127. Each mode solves each problem type with one `dpdb.py --batch` run (see
+# benchmarks.run), embedded databases (db.backend sqlite / duckdb) need no server.
+# A backend may reject counts beyond its exact integers with an error, but must not give a wrong result.
+# Exits with 1 if the modes disagree, a result differs from the known count or an instance failed.
+#
+# python -m benchmarks.parity --config config.json [--backend sqlite] [--suite small] [--seed 1]
+import argparse
+import logging
+import os
+import sys
+import tempfile
+
+from benchmarks.generate import SUITES, generate, write_cnf
+from benchmarks.run import BACKENDS, run_batch
+from dpdb.runner import read_cfg
+
+logger = logging.getLogger("benchmarks.parity")
+
+MODES = ["worker", "numpy"]
+
+# number of variables of the chains
+CHAINS = [100, 190]
+
+# exact model counts of the backends (NUMERIC columns), PostgreSQL has no limit
+COUNT_LIMITS = {"sqlite": 2**63, "duckdb": 10**38}
+
+# models of the chain over n variables: fib(n + 2)
+def chain_count(n):
+    a, b = 1, 1
+    for _ in range(n):
+        a, b = b, a + b
+    return b
+
+def write_chains(out):
+    instances = []
+    for n in CHAINS:
+        name = f"chain_n{n}"
+        write_cnf(os.path.join(out, f"{name}.cnf"), n, [[v, v + 1] for v in range(1, n)])
+        instances.append({"name": name, "file": f"{name}.cnf", "args": [], "count": chain_count(n)})
+    return instances
+
+# (problem type, problem specific arguments) to solve instance with
+def variants(instance):
+    if instance["file"].endswith(".tw"):
+        return [("vc", instance["args"])]
+    counts = ["object"] if "count" in instance and instance["count"] >= 2**63 else ["object", "int64"]
+    return [("sat", [])] + [("sharpsat", ["--numpy-counts", c]) for c in counts]
+
+def expected(instance, problem):
+    if "count" not in instance:
+        return None
+    return str(instance["count"]) if problem == "sharpsat" else "True"
+
+# sat results are booleans, SQLite returns them as integers
+def normalize(result, problem):
+    if problem == "sat":
+        return {"1": "True", "0": "False"}.get(result, result)
+    return result
+
+def check(cfg, directory, instances, backend, threads, log):
+    options = {"backend": backend, "candidate_store": "cte", "faster": False, "threads": threads}
+    limit = COUNT_LIMITS.get(backend)
+    failed = 0
+    print(f"{'instance':<36} {'problem':<24} {'worker':>24} {'numpy':>24}")
+    for problem, args in sorted(set((p, tuple(a)) for i in instances for p, a in variants(i))):
+        group = [dict(i, problem=problem, args=list(args)) for i in instances if (problem, list(args)) in variants(i)]
+        results = {}
+        for mode in MODES:
+            logger.info("%s %s: %d instances with --execution-mode %s", problem, " ".join(args), len(group), mode)
+            results[mode] = run_batch(cfg, group, directory, options, ["--execution-mode", mode], log)
+        for i in group:
+            rows = [results[m][i["file"]] if i["file"] in results[m] else {"status": "error: no result"} for m in MODES]
+            shown = [normalize(r["result"], problem) if r["status"] == "ok" else r["status"] for r in rows]
+            ok = [normalize(r["result"], problem) for r in rows if r["status"] == "ok"]
+            exp = expected(i, problem)
+            if exp is not None and any(r != exp for r in ok):
+                flag = "WRONG"
+            elif len(set(ok)) > 1:
+                flag = "DIFF"
+            elif len(ok) < len(rows):
+                # rejecting counts beyond the exact integers of the backend is fine
+                flag = "limit" if problem == "sharpsat" and limit and exp is not None and i["count"] >= limit else "FAILED"
+            else:
+                flag = ""
+            if flag and flag != "limit":
+                failed += 1
+            print(f"{i['name']:<36} {' '.join([problem] + list(args)):<24} {shown[0][:24]:>24} {shown[1][:24]:>24} {flag}")
+    return failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="Config file", default="config.json")
+    parser.add_argument("--backend", choices=BACKENDS, help="Database backend (default: db.backend of the config)")
+    parser.add_argument("--suite", help="Instance suite of benchmarks.generate", choices=list(SUITES), default="small")
+    parser.add_argument("--seed", type=int, help="Random seed", default=1)
+    parser.add_argument("--threads", type=int, help="Worker threads (max_worker_threads)", default=4)
+    parser.add_argument("--log", help="File for the output of dpdb.py", default=os.devnull)
+    opts = parser.parse_args()
+
+    logging.basicConfig(format='[%(levelname)s] %(name)s: %(message)s', level=logging.INFO)
+
+    cfg = read_cfg(opts.config)
+    backend = opts.backend or (cfg["db"]["backend"] if "backend" in cfg["db"] else "postgres")
+    with tempfile.TemporaryDirectory() as tmp, open(opts.log, "a") as log:
+        if backend in ("sqlite", "duckdb"):
+            # the batch runs are separate processes, an in-memory database would not outlive them
+            cfg["db"][backend] = dict(cfg["db"][backend] if backend in cfg["db"] else {}, path=os.path.join(tmp, f"parity.{backend}"))
+        instances = generate(opts.suite, tmp, opts.seed) + write_chains(tmp)
+        failed = check(cfg, tmp, instances, backend, opts.threads, log)
+    if failed:
+        logger.error("%d results differ or failed", failed)
+    sys.exit(1 if failed else 0)
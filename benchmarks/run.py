@@ -0,0 +1,158 @@
+# -*- coding: future_fstrings -*-
+# Solves the generated instances (see benchmarks.generate) with a matrix of options
+#
+# Each combination of --backend, --candidate-store, --faster and --threads solves all instances of
+# a problem type with one `dpdb.py --batch` run. Setup and calc time are read from table problem
+# (the database must outlive the run, i.e. not an in-memory SQLite or DuckDB), wall time and result
+# from the batch results. Every solved instance appends one JSON line to --out:
+#   {"version", "label", "date", "instance", "problem", "options", "repeat", "id", "status",
+#    "result", "tree_width", "setup_seconds", "calc_seconds", "wall_seconds"}
+# Result files of different versions are compared with benchmarks.compare.
+#
+# python -m benchmarks.run --config config.json [--instances benchmarks/instances] [--out results.jsonl]
+#     [--backend postgres duckdb] [--candidate-store cte table] [--faster both] [--threads 1 4] [--repeat 3]
+#     [--options "--parallel-setup"]
+import argparse
+import csv
+import itertools
+import json
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+
+from datetime import datetime
+
+from dpdb.costmodel import seconds
+from dpdb.db import DB, create_pool
+from dpdb.runner import read_cfg
+
+logger = logging.getLogger("benchmarks.run")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def version():
+    try:
+        rev = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=ROOT, capture_output=True, text=True, check=True)
+        return rev.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+BACKENDS = ["postgres", "duckdb", "sqlite"]
+
+# option combinations as dicts {"backend", "candidate_store", "faster", "threads"}
+def option_matrix(backends, candidate_stores, faster, threads):
+    return [{"backend": b, "candidate_store": c, "faster": f, "threads": t}
+        for b, c, f, t in itertools.product(backends, candidate_stores, {"off": [False], "on": [True], "both": [False, True]}[faster], threads)]
+
+# db section of the config for backend, the other settings (dsn, duckdb, sqlite) are shared
+def backend_cfg(cfg, backend):
+    db_cfg = dict(cfg["db"], backend=backend)
+    if backend in ("duckdb", "sqlite"):
+        path = db_cfg[backend]["path"] if backend in db_cfg and "path" in db_cfg[backend] else ":memory:"
+        if path == ":memory:":
+            raise ValueError(f"Benchmarks with db.backend {backend} require a file (db.{backend}.path)")
+    return db_cfg
+
+def arguments(options, extra):
+    args = ["--candidate-store", options["candidate_store"]] + extra
+    if options["faster"]:
+        args.append("--faster")
+    return args
+
+# solves instances (of the same problem type and specific arguments) in one batch, returns the rows of the results csv
+def run_batch(cfg, instances, directory, options, extra, log):
+    with tempfile.TemporaryDirectory() as tmp:
+        run_cfg = dict(cfg, db=backend_cfg(cfg, options["backend"]),
+            dpdb=dict(cfg["dpdb"] if "dpdb" in cfg else {}, max_worker_threads=options["threads"]))
+        with open(os.path.join(tmp, "config.json"), "w") as f:
+            json.dump(run_cfg, f)
+        with open(os.path.join(tmp, "manifest"), "w") as f:
+            for i in instances:
+                f.write(os.path.abspath(os.path.join(directory, i["file"])) + "\n")
+        results = os.path.join(tmp, "results.csv")
+        cmd = [sys.executable, os.path.join(ROOT, "dpdb.py"), "--config", os.path.join(tmp, "config.json"),
+            "-f", os.path.join(tmp, "manifest"), "--batch", "--batch-jobs", "1", "--results", results,
+            *arguments(options, extra), instances[0]["problem"], *instances[0]["args"]]
+        logger.debug("Running %s", " ".join(map(shlex.quote, cmd)))
+        proc = subprocess.run(cmd, cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+        # failed instances are in the results as well (with exit status 1)
+        if proc.returncode != 0:
+            logger.error("dpdb.py exited with %d", proc.returncode)
+        if not os.path.exists(results):
+            return {}
+        with open(results, newline="") as f:
+            return {os.path.basename(r["file"]): r for r in csv.DictReader(f)}
+
+# setup and calc time of the problems ids from table problem
+# connected only after the batch, an embedded database file can only be opened by one process
+def problem_times(db_cfg, ids):
+    if not ids:
+        return {}
+    pool = create_pool(db_cfg)
+    db = DB.from_pool(pool)
+    try:
+        if not db.table_names("problem"):
+            return {}
+        db.ignore_next_praefix()
+        rows = db.select_all("problem", ["id", "setup_start_time", "calc_start_time", "end_time"], [f"id IN ({','.join(map(str, ids))})"])
+        return {r[0]: (seconds(r[1], r[2]), seconds(r[2], r[3])) for r in rows}
+    finally:
+        db.close()
+        pool.closeall()
+
+def run(cfg, directory, out, matrix, extra = [], repeat = 1, label = None, log = None):
+    with open(os.path.join(directory, "instances.json")) as f:
+        instances = json.load(f)
+    groups = {}
+    for i in instances:
+        groups.setdefault((i["problem"], tuple(i["args"])), []).append(i)
+    # fails before the first batch for in-memory databases
+    for backend in set(o["backend"] for o in matrix):
+        backend_cfg(cfg, backend)
+    meta = {"version": version(), "label": label, "date": datetime.now().isoformat(timespec="seconds")}
+    with open(out, "a") as res:
+        for options, rep in itertools.product(matrix, range(repeat)):
+            for group in groups.values():
+                logger.info("%s: %d %s instances (repeat %d)", json.dumps(options), len(group), group[0]["problem"], rep)
+                rows = run_batch(cfg, group, directory, options, extra, log)
+                ids = [int(r["id"]) for r in rows.values() if r["id"]]
+                times = problem_times(backend_cfg(cfg, options["backend"]), ids)
+                for i in group:
+                    r = rows[i["file"]] if i["file"] in rows else {"status": "error: no result"}
+                    pid = int(r["id"]) if "id" in r and r["id"] else None
+                    setup, calc = times[pid] if pid in times else (None, None)
+                    rec = dict(meta, instance=i["name"], problem=i["problem"], options=dict(options, extra=" ".join(extra)), repeat=rep,
+                        id=pid, status=r["status"], result=r["result"] if "result" in r else None,
+                        tree_width=int(r["tree_width"]) if "tree_width" in r and r["tree_width"] else None,
+                        setup_seconds=setup, calc_seconds=calc,
+                        wall_seconds=float(r["wall_time"]) if "wall_time" in r and r["wall_time"] else None)
+                    res.write(json.dumps(rec) + "\n")
+                    res.flush()
+                    logger.info("%s: %s %s (calc %s s)", i["name"], rec["status"], rec["result"], calc)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="Config file", default="config.json")
+    parser.add_argument("--instances", help="Directory of benchmarks.generate", default=os.path.join("benchmarks", "instances"))
+    parser.add_argument("--out", help="Results (JSON lines, appended)", default="results.jsonl")
+    parser.add_argument("--backend", nargs="+", choices=BACKENDS, help="Database backends to run (default: db.backend of the config)")
+    parser.add_argument("--candidate-store", dest="candidate_store", nargs="+", help="Candidate stores to run", default=["cte"])
+    parser.add_argument("--faster", help="Run without --faster, with it or both", choices=["off", "on", "both"], default="off")
+    parser.add_argument("--threads", type=int, nargs="+", help="Worker thread counts to run (max_worker_threads)")
+    parser.add_argument("--repeat", type=int, help="Number of runs of each combination", default=1)
+    parser.add_argument("--options", help="Additional general options of every run", default="")
+    parser.add_argument("--label", help="Label of the runs in the results")
+    parser.add_argument("--log", help="File for the output of dpdb.py", default=os.devnull)
+    opts = parser.parse_args()
+
+    logging.basicConfig(format='[%(levelname)s] %(name)s: %(message)s', level=logging.INFO)
+
+    cfg = read_cfg(opts.config)
+    threads = opts.threads or [cfg["dpdb"]["max_worker_threads"] if "dpdb" in cfg and "max_worker_threads" in cfg["dpdb"] else 12]
+    backends = opts.backend or [cfg["db"]["backend"] if "backend" in cfg["db"] else "postgres"]
+    with open(opts.log, "a") as log:
+        run(cfg, opts.instances, opts.out, option_matrix(backends, opts.candidate_store, opts.faster, threads),
+            shlex.split(opts.options), opts.repeat, opts.label, log)
@@ -2,90 +2,92 @@
 # -*- coding: future_fstrings -*-
 import logging
 import sys
-import subprocess
 import argparse
 import signal
 
 import dpdb.problems as problems
-from dpdb.db import BlockingThreadedConnectionPool, DEBUG_SQL, setup_debug_sql, DBAdmin
-from dpdb.reader import TdReader
-from dpdb.writer import StreamWriter, FileWriter
-from dpdb.treedecomp import TreeDecomp
+from dpdb.db import BlockingThreadedConnectionPool, DEBUG_SQL, setup_debug_sql, DB, DBAdmin, QueryStats, create_pool
+from dpdb.trace import Tracer
+from dpdb.runner import read_cfg, run_problem, run_batch, batch_files, write_results
 from dpdb.problem import args
 
 logger = logging.getLogger("dpdb")
 
-def read_cfg(cfg_file):
-    import json
-
-    with open(cfg_file) as c:
-        cfg = json.load(c)
-    return cfg
-
-def flatten_cfg(dd, filter=[], separator='.', prefix=''):
-    if prefix.startswith(tuple(filter)):
-        return {}
-
-    if isinstance(dd, dict):
-        return { prefix + separator + k if prefix else k : v
-            for kk, vv in dd.items()
-            for k, v in flatten_cfg(vv, filter, separator, kk).items()
-                if not (prefix + separator + k).startswith(tuple(filter))
-            }
-    elif isinstance(dd, list):
-        return { prefix : " ".join(dd) }
-    else:
-        return { prefix : dd }
-
 def solve_problem(cfg, cls, file, **kwargs):
+    # problems currently being solved
+    running = set()
+
     def signal_handler(sig, frame):
         if sig == signal.SIGUSR1:
             logger.warning("Terminating because of error in worker thread")
         else:
             logger.warning("Killing all connections")
-        problem.interrupt()
-
-        app_name = None
-        if "application_name" in cfg["db"]["dsn"]:
-            app_name = cfg["db"]["dsn"]["application_name"]
-        admin_db.killall(app_name)
+        for problem in list(running):
+            problem.interrupt()
+
+        # statements of embedded databases run in this process and are cancelled directly
+        for problem in list(running):
+            problem.cancel()
+        if admin_db:
+            app_name = None
+            if "application_name" in cfg["db"]["dsn"]:
+                app_name = cfg["db"]["dsn"]["application_name"]
+            admin_db.killall(app_name)
         sys.exit(0)
 
-    admin_db = DBAdmin.from_cfg(cfg["db_admin"])
+    # not needed without a PostgreSQL server
+    admin_db = DBAdmin.from_cfg(cfg["db_admin"]) if "db_admin" in cfg else None
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGUSR1, signal_handler)
 
-    pool = BlockingThreadedConnectionPool(1,cfg["db"]["max_connections"],**cfg["db"]["dsn"])
-    problem = cls(file,pool, **cfg["dpdb"], **kwargs)
-
-    logger.info("Using tree decomposition seed: {}".format(kwargs["runid"]))
-    # Run htd
-    p = subprocess.Popen([cfg["htd"]["path"], "--seed", str(kwargs["runid"]), *cfg["htd"]["parameters"]], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    logger.info("Parsing input file")
-    input = problem.prepare_input(file)
-    if "gr_file" in kwargs and kwargs["gr_file"]:
-        logger.info("Writing graph file")
-        with FileWriter(kwargs["gr_file"]) as fw:
-            fw.write_gr(*input)
-    logger.info("Running htd")
-    StreamWriter(p.stdin).write_gr(*input)
-    p.stdin.close()
-    tdr = TdReader.from_stream(p.stdout)
-    p.wait()
-
-    # solve it
-    logger.info("Parsing tree decomposition")
-    td = TreeDecomp(tdr.num_bags, tdr.tree_width, tdr.num_orig_vertices, tdr.root, tdr.bags, tdr.adjacency_list)
-    logger.info(f"#bags: {td.num_bags} tree_width: {td.tree_width} #vertices: {td.num_orig_vertices} #leafs: {len(td.leafs)} #edges: {len(td.edges)}")
-    if "td_file" in kwargs and kwargs["td_file"]:
-        with FileWriter(kwargs["td_file"]) as fw:
-            fw.write_td(tdr.num_bags, tdr.tree_width, tdr.num_orig_vertices, tdr.root, tdr.bags, td.edges)
-    problem.set_td(td)
-    problem.setup()
-    if "faster" not in kwargs or not kwargs["faster"]:
-        problem.store_cfg(flatten_cfg(cfg,("db.dsn","db_admin","htd.path")))
-    problem.solve()
+    pool = create_pool(cfg["db"])
+    # additional database servers solving subtrees
+    backend_pools = []
+    if "backends" in cfg["db"]:
+        backend_pools = [BlockingThreadedConnectionPool(1,cfg["db"]["max_connections"],**dsn) for dsn in cfg["db"]["backends"]]
+    if ("query_stats" in kwargs and kwargs["query_stats"]) or ("query_stats_table" in kwargs and kwargs["query_stats_table"]):
+        pool.stats = QueryStats()
+    tracer = None
+    if "trace_file" in kwargs and kwargs["trace_file"]:
+        tracer = Tracer()
+
+    if "batch" in kwargs and kwargs["batch"]:
+        if ("progress_port" in kwargs and kwargs["progress_port"]) or ("progress_interval" in kwargs and kwargs["progress_interval"]):
+            logger.warning("Progress is not reported in batch mode")
+            kwargs["progress_port"] = kwargs["progress_interval"] = None
+        files = batch_files(file)
+        logger.info("Solving %d instances with %d jobs", len(files), kwargs["batch_jobs"])
+        results = run_batch(cfg, cls, files, pool, kwargs["batch_jobs"], tracer, running, backend_pools=backend_pools, **kwargs)
+        write_results(kwargs["results"], results)
+        failed = [r for r in results if r["status"].startswith("error")]
+        if failed:
+            logger.error("%d of %d instances failed", len(failed), len(results))
+        problem = None
+    else:
+        problem = run_problem(cfg, cls, file, pool, tracer, running=running, backend_pools=backend_pools, **kwargs)
+
+    if tracer:
+        logger.info("Writing trace file")
+        tracer.write(kwargs["trace_file"])
+
+    if pool.stats:
+        stats = pool.stats
+        # do not record storing the stats
+        pool.stats = None
+        stats.log_summary()
+        if "query_stats" in kwargs and kwargs["query_stats"]:
+            stats.write_json(kwargs["query_stats"])
+        if "query_stats_table" in kwargs and kwargs["query_stats_table"]:
+            db = DB.from_pool(pool)
+            # batches store the stats of all problems in one table
+            if problem:
+                db.set_praefix(f"p{problem.id}_")
+            stats.store(db)
+            db.close()
+
+    if "batch" in kwargs and kwargs["batch"] and failed:
+        sys.exit(1)
 
 _LOG_LEVEL_STRINGS = ["DEBUG_SQL", "DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
 
@@ -120,7 +122,7 @@ if __name__ == "__main__":
         for arg, kwargs in options.items():
             p.add_argument(arg,**kwargs)
 
-    parser.add_argument("-f", "--file", dest="file", help="Input file for the problem to solve", required=True)
+    parser.add_argument("-f", "--file", dest="file", help="Input file for the problem to solve (with --batch: directory or manifest file listing one input file per line)", required=True)
     
     # general options
     gen_opts = parser.add_argument_group("general options", "General options")
@@ -132,6 +134,16 @@ if __name__ == "__main__":
     gen_opts.add_argument("--gr-file", dest="gr_file", help="Store Graph file (htd Input)")
     gen_opts.add_argument("--faster", dest="faster", help="Store less information in database", action="store_true")
     gen_opts.add_argument("--parallel-setup", dest="parallel_setup", help="Perform setup in parallel", action="store_true")
+    gen_opts.add_argument("--batch", dest="batch", help="Solve all instances given by -f concurrently, sharing connections and node worker threads", action="store_true")
+    gen_opts.add_argument("--batch-jobs", dest="batch_jobs", help="Number of instances solved concurrently in batch mode", default=4, type=int)
+    gen_opts.add_argument("--results", dest="results", help="CSV file for the results of batch mode", default="results.csv")
+    gen_opts.add_argument("--query-stats", dest="query_stats", help="Record timings of all statements and write them as JSON lines to this file")
+    gen_opts.add_argument("--trace-file", dest="trace_file", help="Write a timeline of the node workers in Chrome trace event format (chrome://tracing, Perfetto)")
+    gen_opts.add_argument("--progress-port", dest="progress_port", type=int, help="Serve progress and ETA of the running solve on http://localhost:PORT/metrics (Prometheus text format)")
+    gen_opts.add_argument("--progress-interval", dest="progress_interval", type=float, help="Log progress and ETA every this many seconds")
+    gen_opts.add_argument("--dry-run", dest="dry_run", help="Print the time, disk usage and critical path predicted by the cost model instead of solving", action="store_true")
+    gen_opts.add_argument("--td-candidates", dest="td_candidates", type=int, help="Decompose with this many seeds and keep the decomposition with the shortest predicted time", default=1)
+    gen_opts.add_argument("--query-stats-table", dest="query_stats_table", help="Record timings of all statements and store them in table query_stats", action="store_true")
 
     # problem options
     prob_opts = parser.add_argument_group("problem options", "Options that apply to all problem types")
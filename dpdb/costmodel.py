@@ -0,0 +1,263 @@
+# -*- coding: future_fstrings -*-
+# Predicts rows and time of each node from the history in td_node_status / td_bag / td_edge
+#
+# Two linear models (least squares) per problem type on log2 scales:
+#   log2(rows + 1) and log2(milliseconds + 1)
+# from the width, stored / introduced / forgotten vertices, number of children and constraints
+# (e.g. clauses) of a node and the log2 of its estimated candidates, which is computed from the
+# (predicted) rows of its children. Trained models are stored in table cost_model.
+#
+# python -m dpdb.costmodel [--config config.json] [--type SharpSat] [--max-problems N]
+import argparse
+import json
+import logging
+import math
+
+from datetime import datetime
+
+from psycopg2 import sql
+
+from dpdb.db import DB, create_pool
+from dpdb.incremental import read_td
+from dpdb.treedecomp import TreeDecomp
+
+logger = logging.getLogger("dpdb.costmodel")
+
+FEATURES = ["bias", "width", "stored", "introduced", "forgotten", "children", "constraints", "log_candidates"]
+
+# log2 of the number of candidates of node given the rows of its children (see Problem.estimate_rows)
+def log_candidates(node, rows):
+    est = len([v for v in node.vertices if node.needs_introduce(v)])
+    for c in node.children:
+        est += math.log2(max(rows[c.id], 1))
+    for v in node.vertices:
+        if len(node.vertex_children(v)) > 1:
+            est -= len(node.vertex_children(v)) - 1
+    return min(max(est, 0), len(node.vertices))
+
+def features(node, constraints, rows):
+    return [1.0, len(node.vertices), len(node.stored_vertices), len([v for v in node.vertices if node.needs_introduce(v)]),
+        len(node.vertices) - len(node.stored_vertices), len(node.children), constraints, log_candidates(node, rows)]
+
+# least squares with a small ridge for features that do not vary
+def fit(X, y, ridge = 1e-3):
+    n = len(FEATURES)
+    a = [[sum(x[i] * x[j] for x in X) + (ridge if i == j else 0) for j in range(n)] for i in range(n)]
+    b = [sum(x[i] * t for x, t in zip(X, y)) for i in range(n)]
+    # gaussian elimination with partial pivoting
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(a[r][col]))
+        a[col], a[pivot] = a[pivot], a[col]
+        b[col], b[pivot] = b[pivot], b[col]
+        for r in range(col + 1, n):
+            f = a[r][col] / a[col][col]
+            for c in range(col, n):
+                a[r][c] -= f * a[col][c]
+            b[r] -= f * b[col]
+    coef = [0.0] * n
+    for r in reversed(range(n)):
+        coef[r] = (b[r] - sum(a[r][c] * coef[c] for c in range(r + 1, n))) / a[r][r]
+    return coef
+
+def dot(coef, x):
+    return sum(c * v for c, v in zip(coef, x))
+
+def rmse(coef, X, y):
+    return math.sqrt(sum((dot(coef, x) - t) ** 2 for x, t in zip(X, y)) / len(y)) if y else 0.0
+
+def seconds(start, end):
+    if start is None or end is None:
+        return None
+    # SQLite returns timestamps as text
+    if isinstance(start, str):
+        start, end = datetime.fromisoformat(start), datetime.fromisoformat(end)
+    return (end - start).total_seconds()
+
+# {node: (start, end, rows, constraints)}, problems solved before num_constraints was recorded have none
+def node_status(db, pid):
+    cols = ["node", "start_time", "end_time", "rows"]
+    try:
+        db.ignore_next_praefix()
+        rows = db.select_all(f"p{pid}_td_node_status", cols + ["coalesce(num_constraints,0)"])
+    except Exception:
+        db.rollback()
+        db.ignore_next_praefix()
+        rows = [r + (0,) for r in db.select_all(f"p{pid}_td_node_status", cols)]
+    return {r[0]: tuple(r[1:]) for r in rows}
+
+def create_model_table(db):
+    db.ignore_next_praefix()
+    db.create_table("cost_model", [
+        ("type", "VARCHAR(32) NOT NULL"),
+        ("target", "VARCHAR(8) NOT NULL"),
+        ("coef", "TEXT NOT NULL"),
+        ("samples", "INTEGER"),
+        ("rmse", "DOUBLE PRECISION"),
+        ("trained", "TIMESTAMP")
+    ])
+
+# samples (features, log2 rows, log2 ms) of the nodes of solved problems of type
+def history(db, type, max_problems = 200):
+    if not db.table_names("problem"):
+        return []
+    db.ignore_next_praefix()
+    ids = [r[0] for r in db.select_all("problem", ["id"], [f"type = '{type}'", "end_time IS NOT NULL"])]
+    status_tables = set(db.table_names("p%\\_td\\_node\\_status"))
+    samples = []
+    used = 0
+    for pid in sorted(ids, reverse=True):
+        if used >= max_problems:
+            break
+        if f"p{pid}_td_node_status" not in status_tables:
+            continue
+        bags, adj, root = read_td(db, pid)
+        if not bags:
+            continue
+        td = TreeDecomp(len(bags), 0, 0, root, {b: sorted(v) for b, v in bags.items()}, adj)
+        status = node_status(db, pid)
+        rows = {}
+        for n in td.nodes:
+            start, end, cnt, num_constraints = status.get(n.id, (None, None, None, 0))
+            secs = seconds(start, end)
+            if cnt is None or secs is None:
+                break
+            x = features(n, num_constraints, rows)
+            rows[n.id] = cnt
+            samples.append((x, math.log2(cnt + 1), math.log2(secs * 1000 + 1)))
+        used += 1
+    logger.info("%d nodes of %d %s problems", len(samples), used, type)
+    return samples
+
+class CostModel(object):
+    def __init__(self, rows_coef, time_coef, samples = 0):
+        self.rows_coef = rows_coef
+        self.time_coef = time_coef
+        self.samples = samples
+
+    @classmethod
+    def train(cls, db, type, max_problems = 200):
+        samples = history(db, type, max_problems)
+        if len(samples) < len(FEATURES):
+            raise ValueError(f"Not enough solved {type} problems to train the cost model ({len(samples)} nodes)")
+        X = [s[0] for s in samples]
+        model = cls(fit(X, [s[1] for s in samples]), fit(X, [s[2] for s in samples]), len(samples))
+        model.rows_rmse = rmse(model.rows_coef, X, [s[1] for s in samples])
+        model.time_rmse = rmse(model.time_coef, X, [s[2] for s in samples])
+        return model
+
+    # the latest stored model of type, None if there is none
+    @classmethod
+    def load(cls, db, type):
+        if not db.table_names("cost\\_model"):
+            return None
+        db.ignore_next_praefix()
+        coef = {}
+        for target, c, samples in db.select_all("cost_model", ["target", "coef", "samples"], [f"type = '{type}'"]):
+            coef[target] = (json.loads(c), samples)
+        if "rows" not in coef or "time" not in coef:
+            return None
+        return cls(coef["rows"][0], coef["time"][0], coef["rows"][1])
+
+    def store(self, db, type):
+        create_model_table(db)
+        db.execute(sql.SQL("DELETE FROM {} WHERE type = %s").format(sql.Identifier("cost_model")), [type])
+        for target, coef, err in (("rows", self.rows_coef, self.rows_rmse), ("time", self.time_coef, self.time_rmse)):
+            db.ignore_next_praefix()
+            db.insert("cost_model", ("type", "target", "coef", "samples", "rmse"), (type, target, json.dumps(coef), self.samples, err))
+            db.ignore_next_praefix()
+            db.update("cost_model", ["trained"], ["statement_timestamp()"], [f"type = '{type}'", f"target = '{target}'"])
+        db.commit()
+
+    # {node id: {"rows", "seconds", "bytes"}} for the decomposition td of problem, bottom up
+    def predict(self, problem, td):
+        extra = len(problem.td_node_extra_columns())
+        pred = {}
+        rows = {}
+        for n in td.nodes:
+            x = features(n, problem.node_constraints(n), rows)
+            rows[n.id] = min(max(2 ** dot(self.rows_coef, x) - 1, 0), 2 ** len(n.stored_vertices))
+            pred[n.id] = {
+                "rows": rows[n.id],
+                "seconds": max(2 ** dot(self.time_coef, x) - 1, 0) / 1000,
+                "bytes": rows[n.id] * (24 + len(n.vertices) + 16 * extra)
+            }
+        return pred
+
+# critical path (list of nodes from a leaf to the root) and its time
+def critical_path(td, pred):
+    path = {}
+    for n in td.nodes:
+        below = max([path[c.id] for c in n.children], key=lambda p: p[0], default=(0, []))
+        path[n.id] = (below[0] + pred[n.id]["seconds"], below[1] + [n])
+    return path[td.root.id][1], path[td.root.id][0]
+
+# postorder visiting the child with the longest critical path first, so that long chains start early
+def schedule(td, pred):
+    below = {}
+    for n in td.nodes:
+        below[n.id] = pred[n.id]["seconds"] + max([below[c.id] for c in n.children], default=0)
+    order = []
+    stack = [(td.root, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            order.append(node)
+            continue
+        stack.append((node, True))
+        for c in sorted(node.children, key=lambda c: below[c.id]):
+            stack.append((c, False))
+    return order
+
+# predicted wall time with threads workers, nodes taken in schedule order as soon as their children are done
+def makespan(td, pred, threads):
+    finish = {}
+    free = [0.0] * threads
+    for n in schedule(td, pred):
+        ready = max([finish[c.id] for c in n.children], default=0.0)
+        worker = min(range(threads), key=lambda w: free[w])
+        finish[n.id] = max(ready, free[worker]) + pred[n.id]["seconds"]
+        free[worker] = finish[n.id]
+    return finish[td.root.id]
+
+def summary(td, pred, threads):
+    path, path_time = critical_path(td, pred)
+    return {
+        "rows": sum(p["rows"] for p in pred.values()),
+        "work_seconds": sum(p["seconds"] for p in pred.values()),
+        "makespan_seconds": makespan(td, pred, threads),
+        "critical_path_seconds": path_time,
+        "critical_path": [n.id for n in path],
+        # node tables are kept until the end of solve
+        "peak_bytes": sum(p["bytes"] for p in pred.values())
+    }
+
+def report(td, pred, threads, top = 5):
+    s = summary(td, pred, threads)
+    print(f"predicted rows:     {s['rows']:.0f}")
+    print(f"predicted work:     {s['work_seconds']:.3f}s")
+    print(f"predicted time:     {s['makespan_seconds']:.3f}s ({threads} threads)")
+    print(f"peak disk:          {s['peak_bytes'] / 2**20:.1f} MB")
+    print(f"critical path:      {s['critical_path_seconds']:.3f}s, {len(s['critical_path'])} nodes: {' '.join(map(str, s['critical_path']))}")
+    print("most expensive nodes:")
+    for node_id, p in sorted(pred.items(), key=lambda t: t[1]["seconds"], reverse=True)[:top]:
+        print(f"  node {node_id:>6} {p['seconds']:>10.3f}s {p['rows']:>14.0f} rows")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="Config file", default="config.json")
+    parser.add_argument("--type", help="Problem type (class name) to train the model for", default="SharpSat")
+    parser.add_argument("--max-problems", type=int, help="Number of most recent problems to train on", default=200)
+    opts = parser.parse_args()
+
+    logging.basicConfig(format='[%(levelname)s] %(name)s: %(message)s', level=logging.INFO)
+
+    with open(opts.config) as c:
+        cfg = json.load(c)
+    pool = create_pool(cfg["db"])
+    db = DB.from_pool(pool)
+    model = CostModel.train(db, opts.type, opts.max_problems)
+    model.store(db, opts.type)
+    logger.info("Trained on %d nodes, rmse log2 rows %.2f, log2 ms %.2f", model.samples, model.rows_rmse, model.time_rmse)
+    for name, r, t in zip(FEATURES, model.rows_coef, model.time_coef):
+        print(f"{name:<16} {r:>10.3f} {t:>10.3f}")
+    db.close()
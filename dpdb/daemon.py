@@ -0,0 +1,407 @@
+# -*- coding: future_fstrings -*-
+# Long running solver accepting jobs over a local HTTP API
+#
+# python -m dpdb.daemon [--config config.json] [--port 8765 | --socket PATH] [--jobs N]
+#
+# POST   /jobs             {"problem": "sharpsat", "file": PATH | "input": TEXT, "options": {...}, "client": NAME}
+# GET    /jobs             all jobs
+# GET    /jobs/ID          state, result and progress of a job
+# GET    /jobs/ID/events   job events as JSON lines, streamed until the job is finished
+# DELETE /jobs/ID          cancel a job
+import argparse
+import json
+import logging
+import os
+import socketserver
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import dpdb.problems
+from dpdb.db import DB, create_pool
+from dpdb.problem import args, create_base_tables
+from dpdb.runner import read_cfg, run_problem, WarmUp
+
+logger = logging.getLogger("dpdb.daemon")
+
+# thread pool running the tasks of different keys (jobs) round robin, tasks of the same key in FIFO order
+# like a FIFO executor it cannot deadlock on node workers, as each job submits its nodes in postorder
+class FairExecutor(object):
+    def __init__(self, max_workers):
+        self._queues = OrderedDict()
+        self._cond = threading.Condition()
+        self._shutdown = False
+        self._threads = [threading.Thread(target=self._work, name=f"node_{i}", daemon=True) for i in range(max_workers)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, key, fn, *args):
+        f = Future()
+        with self._cond:
+            if key not in self._queues:
+                self._queues[key] = deque()
+            self._queues[key].append((f, fn, args))
+            self._cond.notify()
+        return f
+
+    # executor interface for Problem.solve
+    def for_key(self, key):
+        executor = self
+
+        class KeyedExecutor(object):
+            def submit(self, fn, *args):
+                return executor.submit(key, fn, *args)
+
+        return KeyedExecutor()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queues and not self._shutdown:
+                    self._cond.wait()
+                if self._shutdown:
+                    return
+                key, queue = next(iter(self._queues.items()))
+                f, fn, args = queue.popleft()
+                if queue:
+                    self._queues.move_to_end(key)
+                else:
+                    del self._queues[key]
+            if not f.set_running_or_notify_cancel():
+                continue
+            try:
+                f.set_result(fn(*args))
+            except BaseException as e:
+                f.set_exception(e)
+
+    def shutdown(self):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+
+class Job(object):
+    def __init__(self, id, cls, file, options, client, tmp_file = False):
+        self.id = id
+        self.cls = cls
+        self.file = file
+        self.options = options
+        self.client = client
+        self.tmp_file = tmp_file
+        self.state = "queued"
+        self.problem = None
+        self.problem_id = None
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.events = []
+        self.cond = threading.Condition()
+        self.event("queued")
+
+    def event(self, name, **data):
+        with self.cond:
+            self.events.append(dict(event=name, job=self.id, time=time.time(), **data))
+            self.cond.notify_all()
+
+    # run_problem registers the problem currently being solved via add / discard
+    def add(self, problem):
+        problem.cancel_on_error = True
+        self.problem = problem
+        if self.cancelled:
+            problem.interrupt()
+
+    def discard(self, problem):
+        self.problem_id = getattr(problem, "id", None)
+
+    @property
+    def done(self):
+        return self.state in ("done", "failed", "cancelled")
+
+    def to_dict(self):
+        d = {
+            "id": self.id,
+            "problem": self.cls.__name__.lower(),
+            "file": None if self.tmp_file else self.file,
+            "client": self.client,
+            "state": self.state,
+            "problem_id": self.problem.id if self.problem and hasattr(self.problem, "id") else self.problem_id,
+            "result": self.result,
+            "error": self.error,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished
+        }
+        if self.state == "running" and self.problem and self.problem.progress:
+            d["progress"] = self.problem.progress.snapshot()
+        return d
+
+class Daemon(object):
+    def __init__(self, cfg, jobs):
+        self.cfg = cfg
+        max_worker_threads = cfg["dpdb"]["max_worker_threads"] if "max_worker_threads" in cfg["dpdb"] else 12
+        # the problem connections of all jobs must leave room for node workers
+        if cfg["db"]["max_connections"] <= jobs:
+            raise ValueError(f"max_connections ({cfg['db']['max_connections']}) must be larger than the number of jobs ({jobs})")
+        # keep connections for all jobs and node workers open
+        self.pool = create_pool(cfg["db"], min(cfg["db"]["max_connections"], jobs + max_worker_threads))
+        db = DB.from_pool(self.pool)
+        create_base_tables(db)
+        db.commit()
+        db.close()
+
+        self.registry = {}
+        for cls, prob_args in args.specific.items():
+            self.registry[cls.__name__.lower()] = cls
+            for alias in prob_args.get("aliases", []):
+                self.registry[alias] = cls
+        self.warm_ups = {cls: WarmUp() for cls in args.specific}
+
+        self.executor = FairExecutor(max_worker_threads)
+        self.jobs = OrderedDict()
+        # queued jobs per client, clients are served round robin
+        self.queued = OrderedDict()
+        self.lock = threading.Condition()
+        self.next_id = 1
+        self.stopped = False
+        self.threads = [threading.Thread(target=self.work, name=f"job_{i}", daemon=True) for i in range(jobs)]
+        for t in self.threads:
+            t.start()
+
+    # defaults of the command line options of dpdb.py
+    def defaults(self, cls):
+        options = dict(args.general)
+        options.update(args.specific[cls].get("options", {}))
+        defaults = {"runid": 0}
+        for opt in options.values():
+            if "dest" in opt:
+                defaults[opt["dest"]] = opt.get("default", False if opt.get("action") == "store_true" else None)
+        return defaults
+
+    def submit(self, spec):
+        problem = spec.get("problem", "").lower()
+        if problem not in self.registry:
+            raise ValueError(f"Unknown problem type: {spec.get('problem')}")
+        cls = self.registry[problem]
+        tmp_file = "file" not in spec
+        if tmp_file:
+            if "input" not in spec:
+                raise ValueError("Either file or input is required")
+            fd, file = tempfile.mkstemp(prefix="dpdb_", suffix=".in")
+            with os.fdopen(fd, "w") as f:
+                f.write(spec["input"])
+        else:
+            file = spec["file"]
+        options = self.defaults(cls)
+        options.update(spec.get("options", {}))
+        client = spec.get("client", "")
+
+        with self.lock:
+            job = Job(self.next_id, cls, file, options, client, tmp_file)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            if client not in self.queued:
+                self.queued[client] = deque()
+            self.queued[client].append(job)
+            self.lock.notify()
+        logger.info("Job %d queued (%s %s)", job.id, problem, file)
+        return job
+
+    def cancel(self, job):
+        with self.lock:
+            if job.done:
+                return
+            job.cancelled = True
+            if job.state == "queued":
+                self.queued[job.client].remove(job)
+                if not self.queued[job.client]:
+                    del self.queued[job.client]
+                self.finish(job, "cancelled")
+                return
+        logger.info("Cancelling job %d", job.id)
+        if job.problem:
+            job.problem.cancel()
+
+    def finish(self, job, state):
+        job.state = state
+        job.finished = time.time()
+        if job.tmp_file and os.path.exists(job.file):
+            os.remove(job.file)
+        job.event(state, result=job.result, error=job.error, problem_id=job.problem_id)
+
+    def next_job(self):
+        with self.lock:
+            while not self.queued and not self.stopped:
+                self.lock.wait()
+            if self.stopped:
+                return None
+            client, queue = next(iter(self.queued.items()))
+            job = queue.popleft()
+            if queue:
+                self.queued.move_to_end(client)
+            else:
+                del self.queued[client]
+            job.state = "running"
+            job.started = time.time()
+        return job
+
+    def work(self):
+        while True:
+            job = self.next_job()
+            if not job:
+                return
+            job.event("running")
+            try:
+                problem = run_problem(self.cfg, job.cls, job.file, self.pool, executor=self.executor.for_key(job.id),
+                    running=job, warm_up=self.warm_ups[job.cls], track_progress=True, **job.options)
+                job.problem_id = problem.id
+                job.result = problem.result
+                if problem.error:
+                    job.error = str(problem.error)
+                    state = "failed"
+                elif job.cancelled:
+                    state = "cancelled"
+                elif problem.budget_exceeded:
+                    job.error = f"budget exceeded: {problem.budget_exceeded}"
+                    state = "failed"
+                else:
+                    state = "done"
+            except Exception as e:
+                logger.exception("Job %d failed", job.id)
+                job.error = str(e)
+                state = "failed"
+            logger.info("Job %d %s", job.id, state)
+            self.finish(job, state)
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            jobs = [j for j in self.jobs.values() if not j.done]
+            self.lock.notify_all()
+        for job in jobs:
+            self.cancel(job)
+        for t in self.threads:
+            t.join()
+        self.executor.shutdown()
+
+class Handler(BaseHTTPRequestHandler):
+    daemon = None
+    # seconds between progress events of /jobs/ID/events
+    progress_interval = 1
+
+    def send_json(self, code, data):
+        body = json.dumps(data, default=str).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def job(self, parts):
+        try:
+            return self.daemon.jobs[int(parts[1])]
+        except (IndexError, KeyError, ValueError):
+            self.send_json(404, {"error": "unknown job"})
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        if parts == ["jobs"]:
+            self.send_json(200, [j.to_dict() for j in list(self.daemon.jobs.values())])
+        elif parts[0] == "jobs" and len(parts) == 2:
+            job = self.job(parts)
+            if job:
+                self.send_json(200, job.to_dict())
+        elif parts[0] == "jobs" and len(parts) == 3 and parts[2] == "events":
+            job = self.job(parts)
+            if job:
+                self.stream_events(job)
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def stream_events(self, job):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        sent = 0
+        while True:
+            with job.cond:
+                if sent == len(job.events):
+                    job.cond.wait(self.progress_interval)
+                events = job.events[sent:]
+                done = job.done
+            sent += len(events)
+            if not events and job.state == "running" and job.problem and job.problem.progress:
+                events = [dict(event="progress", job=job.id, time=time.time(), **job.problem.progress.snapshot())]
+            try:
+                for e in events:
+                    self.wfile.write(json.dumps(e, default=str).encode() + b"\n")
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            if done and sent == len(job.events):
+                return
+
+    def do_POST(self):
+        if self.path.strip("/") != "jobs":
+            self.send_json(404, {"error": "not found"})
+            return
+        try:
+            spec = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            job = self.daemon.submit(spec)
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        self.send_json(201, job.to_dict())
+
+    def do_DELETE(self):
+        parts = self.path.strip("/").split("/")
+        if parts[0] != "jobs" or len(parts) != 2:
+            self.send_json(404, {"error": "not found"})
+            return
+        job = self.job(parts)
+        if job:
+            self.daemon.cancel(job)
+            self.send_json(200, job.to_dict())
+
+    # client_address is empty for unix sockets
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="Config file", default="config.json")
+    parser.add_argument("--port", type=int, help="Local port of the HTTP API", default=8765)
+    parser.add_argument("--socket", help="Serve the HTTP API on this unix socket instead of a port")
+    parser.add_argument("--jobs", type=int, help="Number of jobs solved concurrently", default=4)
+    parser.add_argument("--log-level", dest="log_level", help="Log level", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], default="INFO")
+    opts = parser.parse_args()
+
+    logging.basicConfig(format='[%(levelname)s] %(name)s: %(message)s', level=getattr(logging, opts.log_level))
+
+    Handler.daemon = Daemon(read_cfg(opts.config), opts.jobs)
+    if opts.socket:
+        if os.path.exists(opts.socket):
+            os.remove(opts.socket)
+        server = UnixHTTPServer(opts.socket, Handler)
+        logger.info("Listening on %s", opts.socket)
+    else:
+        server = ThreadingHTTPServer(("localhost", opts.port), Handler)
+        logger.info("Listening on http://localhost:%d", opts.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down")
+    finally:
+        server.server_close()
+        Handler.daemon.stop()
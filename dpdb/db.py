@@ -1,14 +1,38 @@
 # -*- coding: future_fstrings -*-
+import itertools
+import json
 import logging
 import select
 import re
+import sqlite3
+import time
+from contextlib import nullcontext
 import psycopg2 as pg
 from psycopg2 import sql
+from psycopg2.extras import execute_values
 from psycopg2.pool import ThreadedConnectionPool
-from threading import Semaphore
+from threading import RLock, Semaphore
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
 
 DEBUG_SQL = logging.DEBUG - 5
 
+# names of server side cursors
+_cursor_ids = itertools.count()
+
+# placeholder for the praefix in compiled queries, see compile_dynamic_tabs
+PRAEFIX_TOKEN = "{{praefix}}"
+
+# quotes the names of dynamic tables like DB.replace_dynamic_tabs (the same regular expression, run once per cached query),
+# leaving a placeholder for the praefix (see DB.bind_praefix)
+def compile_dynamic_tabs(query):
+    return re.sub("(\W)(td_node_\w+)((\W|$))",
+        lambda m: '{}"{}{}"{}'.format(m.group(1), PRAEFIX_TOKEN, m.group(2), m.group(3)),
+        query)
+
 def setup_debug_sql():
     logging.addLevelName(DEBUG_SQL, "SQL")
 
@@ -19,12 +43,83 @@ def setup_debug_sql():
 
 logger = logging.getLogger(__name__)
 
+# raised in the connection whose statement was cancelled (see DB.cancel)
+# sqlite3 reports interrupted statements as OperationalError
+QueryCanceled = (pg.errors.QueryCanceled, sqlite3.OperationalError)
+if duckdb:
+    QueryCanceled += (duckdb.InterruptException,)
+
+EXPLAIN_ANALYZE = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) "
+
+# number of rows produced by an EXPLAIN ANALYZE'd statement
+def plan_rows(plan):
+    top = plan[0]["Plan"]
+    if top["Node Type"] == "ModifyTable":
+        top = top["Plans"][0]
+    return int(top["Actual Rows"] * top["Actual Loops"])
+
+def _parse_plan(res):
+    plan = res[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan
+
+# collects timings of all statements executed by DB instances it is attached to
+class QueryStats(object):
+    # query_bytes is the length of the SQL text, not the data read or written
+    fields = ("start", "kind", "tab", "node", "wall_time", "rows", "query_bytes")
+
+    def __init__(self):
+        self._t0 = time.perf_counter()
+        # list.append is atomic, no lock needed for concurrent workers
+        self.records = []
+
+    def record(self, start, kind, table, node, rows, query_bytes):
+        end = time.perf_counter()
+        self.records.append((start - self._t0, kind, table, node, end - start, rows, query_bytes))
+
+    def summary(self):
+        kinds = {}
+        for r in self.records:
+            cnt, total = kinds.get(r[1], (0, 0.0))
+            kinds[r[1]] = (cnt + 1, total + r[4])
+        return kinds
+
+    def log_summary(self):
+        for kind, (cnt, total) in sorted(self.summary().items(), key=lambda k: -k[1][1]):
+            logger.info("%-14s %8d statements %12.3fs", kind, cnt, total)
+
+    def write_json(self, fname):
+        with open(fname, "w") as f:
+            for r in self.records:
+                f.write(json.dumps(dict(zip(self.fields, r))))
+                f.write("\n")
+
+    def store(self, db, table = "query_stats"):
+        db.drop_table(table)
+        db.create_table(table, [
+            ("start", "DOUBLE PRECISION"),
+            ("kind", "VARCHAR(16)"),
+            ("tab", "VARCHAR(255)"),
+            ("node", "INTEGER"),
+            ("wall_time", "DOUBLE PRECISION"),
+            ("rows", "BIGINT"),
+            ("query_bytes", "BIGINT")
+        ])
+        db.insert_many(table, self.fields, self.records)
+        db.commit()
+
 class DB(object):
+    name = "PostgreSQL"
+    # whether generate_series can be used to enumerate introduced vertices
+    generate_series = True
     _pool = None
     _conn = None
     _auto_commit = False
     _praefix = None
     _ignore_next_praefix = 0
+    _stats = None
+    _node = None
 
     @classmethod
     def from_cfg(cls, params):
@@ -32,16 +127,25 @@ class DB(object):
         instance.connect(params)
         return instance
 
+    # pools of other backends determine the class of their connections
     @classmethod
     def from_pool(cls, pool):
-        instance = cls()
+        instance = getattr(pool, "db_class", cls)()
         instance._pool = pool
         instance._conn = pool.getconn()
+        instance._stats = getattr(pool, "stats", None)
         return instance 
 
     # we need this wrapper because conn object is required
     def __debug_query__ (self, query, params = []):
-        logger.debug_sql(query.as_string(self._conn),*params)
+        if logger.isEnabledFor(DEBUG_SQL):
+            logger.debug_sql(self.__as_string__(query),*params)
+
+    def __as_string__(self, query):
+        return query.as_string(self._conn)
+
+    def __record__(self, start, kind, table, cur):
+        self._stats.record(start, kind, table, self._node, cur.rowcount, len(cur.query or b""))
 
     def __table_name__(self, table):
         if self._praefix and self._ignore_next_praefix == 0:
@@ -57,69 +161,161 @@ class DB(object):
 
     def close(self):
         if self._pool:
+            # pooled connections are shared, hand them back in default state
+            if self._auto_commit:
+                self.set_autocommit(False)
             self._pool.putconn(self._conn)
         else:
             self._conn.close()
             self._conn = None
 
+    def set_autocommit(self, auto_commit):
+        self._auto_commit = auto_commit
+        self._conn.autocommit = auto_commit
+
     def commit(self):
+        start = time.perf_counter() if self._stats else None
         self._conn.commit()
+        if start:
+            self._stats.record(start, "commit", None, self._node, None, 0)
 
     def rollback(self):
         self._conn.rollback()
 
-    def execute(self,q,p = []):
+    def set_stats(self, stats):
+        self._stats = stats
+
+    # statements are attributed to this node in the query stats
+    def set_node(self, node):
+        self._node = node
+
+    def execute(self,q,p = [],kind = "query",table = None):
         try:
             self.__debug_query__(q,p)
+            start = time.perf_counter() if self._stats else None
             with self._conn.cursor() as cur:
                 cur.execute(q,p)
                 self.last_rowcount = cur.rowcount
+                if start:
+                    self.__record__(start, kind, table, cur)
         except pg.errors.AdminShutdown:
             logger.warning("Connection closed by admin")
 
-    def exec_and_fetch(self,q,p = []):
+    def exec_and_fetchall(self,q,p = [],kind = "query",table = None):
+        self.__debug_query__(q,p)
+        start = time.perf_counter() if self._stats else None
+        with self._conn.cursor() as cur:
+            cur.execute(q,p)
+            self.last_rowcount = cur.rowcount
+            rows = cur.fetchall()
+            if start:
+                self.__record__(start, kind, table, cur)
+            return rows
+
+    def exec_and_fetch(self,q,p = [],kind = "query",table = None):
         try:
             self.__debug_query__(q,p)
+            start = time.perf_counter() if self._stats else None
             with self._conn.cursor() as cur:
                 cur.execute(q,p)
                 self.last_rowcount = cur.rowcount
-                return cur.fetchone()
+                res = cur.fetchone()
+                if start:
+                    self.__record__(start, kind, table, cur)
+                return res
         except pg.errors.AdminShutdown:
             logger.warning("Connection closed by admin")
         
-    def execute_ddl(self,q):
+    # iterates the rows of a query fetched in batches by a server side cursor
+    def stream(self,q,p = [],itersize = 1000):
+        self.__debug_query__(q,p)
+        with self._conn.cursor(name=f"dpdb_stream_{next(_cursor_ids)}") as cur:
+            cur.itersize = itersize
+            cur.execute(q,p)
+            yield from cur
+
+    def execute_ddl(self,q,kind = "ddl",table = None):
         try:
             self.__debug_query__(q)
+            start = time.perf_counter() if self._stats else None
             with self._conn.cursor() as cur:
                 cur.execute(q)
+                self.last_rowcount = cur.rowcount
+                if start:
+                    self.__record__(start, kind, table, cur)
             # DDL always auto-commits as its default for many DBMS
             # should make transition to e.g. Oracle easier
             self.commit()
         except pg.errors.AdminShutdown:
             logger.warning("Connection closed by admin")
 
-    def drop_table(self, name, if_exists = True):
-        q = sql.SQL("DROP TABLE %s {}" % "IF EXISTS" if if_exists else "").format(
+    # 0 if the table does not exist (yet)
+    def relation_size(self, table):
+        name = self.__table_name__(table).string
+        return self.exec_and_fetch(sql.SQL("SELECT coalesce(pg_total_relation_size(to_regclass(%s)),0)"), [name], "size", table)[0]
+
+    def table_names(self, like):
+        return [r[0] for r in self.exec_and_fetchall(
+            sql.SQL("SELECT tablename FROM pg_tables WHERE schemaname = current_schema() AND tablename LIKE %s"), [like])]
+
+    # cancels the statement currently running in this connection (called from another thread)
+    # same as pg_cancel_backend, but works without a connection to the same server
+    def cancel(self):
+        self._conn.cancel()
+
+    def copy_to(self, table, f):
+        q = sql.SQL("COPY {} TO STDOUT").format(self.__table_name__(table))
+        self.__debug_query__(q)
+        start = time.perf_counter() if self._stats else None
+        with self._conn.cursor() as cur:
+            cur.copy_expert(q.as_string(self._conn), f)
+            self.last_rowcount = cur.rowcount
+            if start:
+                self.__record__(start, "copy", table, cur)
+
+    def copy_from(self, table, f):
+        q = sql.SQL("COPY {} FROM STDIN").format(self.__table_name__(table))
+        self.__debug_query__(q)
+        start = time.perf_counter() if self._stats else None
+        with self._conn.cursor() as cur:
+            cur.copy_expert(q.as_string(self._conn), f)
+            self.last_rowcount = cur.rowcount
+            if start:
+                self.__record__(start, "copy", table, cur)
+
+    def drop_table(self, name, if_exists = True, cascade = False):
+        q = sql.SQL("DROP TABLE %s{}%s" % ("IF EXISTS " if if_exists else "", " CASCADE" if cascade else "")).format(
                     self.__table_name__(name)
                     )
-        self.execute_ddl(q)
+        self.execute_ddl(q,table=name)
 
-    def create_table(self, name, columns, if_not_exists = True):
-        q = sql.SQL("CREATE TABLE %s {} ({})" % "IF NOT EXISTS" if if_not_exists else "").format(
+    # unlogged: skip WAL for data that can be recomputed
+    def __table_options__(self, unlogged, tablespace):
+        kind = sql.SQL("UNLOGGED TABLE" if unlogged else "TABLE")
+        if tablespace:
+            return kind, sql.SQL(" TABLESPACE {}").format(sql.Identifier(tablespace))
+        else:
+            return kind, sql.SQL("")
+
+    def create_table(self, name, columns, if_not_exists = True, unlogged = False, tablespace = None):
+        kind, space = self.__table_options__(unlogged, tablespace)
+        q = sql.SQL("CREATE {} %s{} ({}){}" % ("IF NOT EXISTS " if if_not_exists else "")).format(
+                    kind,
                     self.__table_name__(name),
-                    sql.SQL(', ').join(sql.Identifier(c[0]) + sql.SQL(" "+c[1]) for c in columns)
+                    sql.SQL(', ').join(sql.Identifier(c[0]) + sql.SQL(" "+c[1]) for c in columns),
+                    space
                     )
-        self.execute_ddl(q)
+        self.execute_ddl(q,table=name)
 
-    def create_view(self, name, text):
-        q = sql.SQL("CREATE VIEW {} AS ").format(self.__table_name__(name))
+    def create_view(self, name, text, replace = False):
+        q = sql.SQL("CREATE %sVIEW {} AS " % ("OR REPLACE " if replace else "")).format(self.__table_name__(name))
         q = sql.Composed([q,sql.SQL(text)])
-        self.execute_ddl(q)
+        self.execute_ddl(q,table=name)
 
     def replace_dynamic_tabs(self,query):
         def repl(m):
             tab = m.group(2)
-            dyn_tab = self.__table_name__(tab).as_string(self._conn)
+            dyn_tab = self.__as_string__(self.__table_name__(tab))
             return m.group(1) + dyn_tab + m.group(3)
 
         query = re.sub("(\W)(td_node_\w+)((\W|$))",
@@ -128,6 +324,10 @@ class DB(object):
 
         return query
 
+    # query compiled by compile_dynamic_tabs with the tables of this praefix
+    def bind_praefix(self, query):
+        return query.replace(PRAEFIX_TOKEN, self._praefix or "")
+
     def insert(self, table, columns, values, returning = None):
         sql_str = "INSERT INTO {} ({}) VALUES ({})"
         q = sql.SQL(sql_str).format(
@@ -137,20 +337,38 @@ class DB(object):
                     )
         if returning:
             q = sql.Composed([q,sql.SQL(" RETURNING {}").format(sql.Identifier(returning))])
-            return self.exec_and_fetch(q,values)
+            return self.exec_and_fetch(q,values,"insert",table)
         else:
-            self.execute(q,values)
+            self.execute(q,values,"insert",table)
 
-    def insert_select(self, table, select, columns = None, returning = None):
+    def insert_many(self, table, columns, rows):
+        q = sql.SQL("INSERT INTO {} ({}) VALUES %s").format(
+                    self.__table_name__(table),
+                    sql.SQL(', ').join(map(sql.Identifier, columns))
+                    )
+        self.__debug_query__(q)
+        start = time.perf_counter() if self._stats else None
+        with self._conn.cursor() as cur:
+            execute_values(cur, q, rows)
+            # rowcount and query only cover the last page of execute_values
+            if start:
+                self._stats.record(start, "insert", table, self._node, len(rows), len(cur.query or b""))
+
+    # explain: run under EXPLAIN ANALYZE and return the plan
+    def insert_select(self, table, select, columns = None, returning = None, explain = False):
         sql_str = "INSERT INTO {} {}"
         q = sql.SQL(sql_str).format(self.__table_name__(table), sql.SQL(select))
         if columns:
             q = sql.Composed([q,sql.SQL(', ').join(map(sql.Identifier, columns))])
+        if explain:
+            plan = _parse_plan(self.exec_and_fetch(sql.Composed([sql.SQL(EXPLAIN_ANALYZE),q]),kind="insert_select",table=table))
+            self.last_rowcount = plan_rows(plan)
+            return plan
         if returning:
             q = sql.Composed([q,sql.SQL(" RETURNING {}").format(sql.Identifier(returning))])
-            return self.exec_and_fetch(q)
+            return self.exec_and_fetch(q,kind="insert_select",table=table)
         else:
-            self.execute(q)
+            self.execute(q,kind="insert_select",table=table)
 
     def persist_view(self, table, view=None):
         if not view:
@@ -167,14 +385,37 @@ class DB(object):
         if where:
             q = sql.Composed([q,sql.SQL(" WHERE {}").format(sql.SQL(' AND ').join(map(sql.SQL,where)))])
 
-        return self.exec_and_fetch(q)
+        return self.exec_and_fetch(q,kind="select",table=table)
 
-    def create_select(self,table,ass_sql):
-        q = sql.SQL("CREATE TABLE {} AS {}").format(
+    def select_all(self, table, columns, where = None):
+        q = sql.SQL("SELECT {} FROM {}").format(
+                    sql.SQL(', ').join(sql.SQL(c) for c in columns),
+                    self.__table_name__(table)
+                    )
+        if where:
+            q = sql.Composed([q,sql.SQL(" WHERE {}").format(sql.SQL(' AND ').join(map(sql.SQL,where)))])
+
+        return self.exec_and_fetchall(q,kind="select",table=table)
+
+    def create_select(self,table,ass_sql,unlogged = False,tablespace = None,explain = False):
+        kind, space = self.__table_options__(unlogged, tablespace)
+        q = sql.SQL("CREATE {} {}{} AS {}").format(
+                    kind,
                     self.__table_name__(table),
+                    space,
                     sql.SQL(ass_sql)
                     )
-        self.execute_ddl(q)
+        if explain:
+            plan = _parse_plan(self.exec_and_fetch(sql.Composed([sql.SQL(EXPLAIN_ANALYZE),q]),kind="create_select",table=table))
+            self.commit()
+            self.last_rowcount = plan_rows(plan)
+            return plan
+        self.execute_ddl(q,"create_select",table)
+
+    # statement of create_select as text (e.g. run by a stored procedure)
+    def create_select_text(self,table,ass_sql,unlogged = False,tablespace = None):
+        kind, space = self.__table_options__(unlogged, tablespace)
+        return self.__as_string__(sql.SQL("CREATE {} {}{} AS ").format(kind, self.__table_name__(table), space)) + ass_sql
 
     def update(self, table, columns, values, where = None, returning = None):
         sql_str = "UPDATE {} SET {}"
@@ -189,16 +430,42 @@ class DB(object):
 
         if returning:
             q = sql.Composed([q,sql.SQL(" RETURNING {}").format(sql.Identifier(returning))])
-            return self.exec_and_fetch(q)
+            return self.exec_and_fetch(q,kind="update",table=table)
         else:
-            self.execute(q)
+            self.execute(q,kind="update",table=table)
+
+    # concurrent replaces of the same procedure fail (--batch, daemon), so it is only
+    # replaced if its body differs, serialized by an advisory lock until the end of the transaction
+    def create_procedure(self, name, params, body, language = "plpgsql"):
+        source = f" {body} "
+        def current():
+            row = self.exec_and_fetch(sql.SQL("SELECT prosrc FROM pg_proc WHERE proname = %s AND pronamespace = current_schema()::regnamespace"),
+                [name], "select", name)
+            return row[0] if row else None
+        if current() == source:
+            return
+        self.execute(sql.SQL("SELECT pg_advisory_xact_lock(hashtext(%s))"), [name], "lock", name)
+        if current() == source:
+            return
+        q = sql.SQL("CREATE OR REPLACE PROCEDURE {} ({}) LANGUAGE {} AS $${}$$").format(
+                    sql.Identifier(name),
+                    sql.SQL(', ').join(sql.Identifier(p[0]) + sql.SQL(" "+p[1]) for p in params),
+                    sql.SQL(language),
+                    sql.SQL(source)
+                    )
+        self.execute_ddl(q,table=name)
 
     def call(self, procedure, params = []):
         q = sql.SQL("CALL {} ({})").format(
                     sql.Identifier(procedure),
                     sql.SQL(', ').join(sql.Placeholder() * len(params))
                     )
-        self.execute(q,params)
+        self.execute(q,params,"call",procedure)
+
+    # setting that only lasts until the end of the current transaction
+    def set_local(self, name, value):
+        q = sql.SQL("SET LOCAL {} = {}").format(sql.Identifier(name), sql.Literal(value))
+        self.execute(q,kind="set")
 
     def set_praefix(self, praefix):
         self._praefix = praefix
@@ -219,7 +486,280 @@ class DBAdmin(DB):
             self.execute(sql.SQL(q),[self._db_name])
         """
 
+# base of in-process databases (db.backend duckdb / sqlite)
+# queries are composed with psycopg2.sql as for PostgreSQL and rendered without a server connection
+class EmbeddedDB(DB):
+    # (pattern, replacement) applied to column types of PostgreSQL that do not exist (or differ)
+    TYPES = []
+    # (pattern, replacement) applied to rendered statements
+    DIALECT = []
+
+    def close(self):
+        if self._pool:
+            self._pool.putconn(self._conn)
+        else:
+            self._conn.close()
+            self._conn = None
+
+    def __as_string__(self, query):
+        if isinstance(query, sql.Composed):
+            q = "".join(self.__as_string__(q) for q in query.seq)
+        elif isinstance(query, sql.Identifier):
+            q = ".".join('"{}"'.format(s.replace('"', '""')) for s in query.strings)
+        elif isinstance(query, sql.Literal):
+            q = sql_literal(query.wrapped)
+        elif isinstance(query, sql.Placeholder):
+            q = "?" if query.name is None else f"${query.name}"
+        elif isinstance(query, sql.SQL):
+            q = query.string
+        else:
+            q = str(query)
+        for pattern, repl in self.DIALECT:
+            q = pattern.sub(repl, q)
+        return q
+
+    # statements of all connections of a pool may have to be serialized
+    def __lock__(self):
+        return getattr(self._pool, "lock", None) or nullcontext()
+
+    def __rowcount__(self, res):
+        return res.rowcount
+
+    # whether e reports a number beyond the range of the database (e.g. a model count)
+    def __overflow__(self, e):
+        return False
+
+    def __overflow_error__(self, e):
+        return ValueError(f"Number out of the range of {self.name} ({e}), use db.backend postgres for exact counts")
+
+    def __run__(self, q, p, kind, table, fetch = None):
+        self.__debug_query__(q,p)
+        query = self.__as_string__(q)
+        if p:
+            query = query.replace("%s", "?")
+        start = time.perf_counter() if self._stats else None
+        with self.__lock__():
+            try:
+                res = self._conn.execute(query, p or [])
+                rows = None
+                if fetch == "all":
+                    rows = res.fetchall()
+                    self.last_rowcount = len(rows)
+                elif fetch == "one":
+                    rows = res.fetchone()
+                    self.last_rowcount = 1 if rows else 0
+                else:
+                    self.last_rowcount = self.__rowcount__(res)
+            except Exception as e:
+                if self.__overflow__(e):
+                    raise self.__overflow_error__(e) from e
+                raise
+        if start:
+            self._stats.record(start, kind, table, self._node, self.last_rowcount, len(query))
+        return rows
+
+    def set_autocommit(self, auto_commit):
+        self._auto_commit = auto_commit
+
+    # statements are committed one by one, there is no open transaction
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def execute(self,q,p = [],kind = "query",table = None):
+        self.__run__(q,p,kind,table)
+
+    def exec_and_fetchall(self,q,p = [],kind = "query",table = None):
+        return self.__run__(q,p,kind,table,"all")
+
+    def exec_and_fetch(self,q,p = [],kind = "query",table = None):
+        return self.__run__(q,p,kind,table,"one")
+
+    def execute_ddl(self,q,kind = "ddl",table = None):
+        self.__run__(q,[],kind,table)
+
+    # a separate cursor per stream, results are fetched lazily
+    def stream(self,q,p = [],itersize = 1000):
+        self.__debug_query__(q,p)
+        query = self.__as_string__(q)
+        if p:
+            query = query.replace("%s", "?")
+        cur = self._conn.cursor()
+        try:
+            with self.__lock__():
+                cur.execute(query, p or [])
+            while True:
+                with self.__lock__():
+                    rows = cur.fetchmany(itersize)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cur.close()
+
+    def cancel(self):
+        self._conn.interrupt()
+
+    def copy_to(self, table, f):
+        raise ValueError(f"Copying between backends is not supported with {self.name}")
+
+    def copy_from(self, table, f):
+        raise ValueError(f"Copying between backends is not supported with {self.name}")
+
+    # there is no WAL to skip and no tablespaces
+    def __table_options__(self, unlogged, tablespace):
+        return sql.SQL("TABLE"), sql.SQL("")
+
+    def __column_type__(self, table, column, type):
+        for pattern, repl in self.TYPES:
+            type = pattern.sub(repl, type)
+        return type
+
+    def create_table(self, name, columns, if_not_exists = True, unlogged = False, tablespace = None):
+        tab = self.__table_name__(name)
+        q = sql.SQL("CREATE TABLE %s{} ({})" % ("IF NOT EXISTS " if if_not_exists else "")).format(
+                    tab,
+                    sql.SQL(', ').join(sql.Identifier(c[0]) + sql.SQL(" "+self.__column_type__(tab.string, *c)) for c in columns)
+                    )
+        self.execute_ddl(q,table=name)
+
+    def insert_many(self, table, columns, rows):
+        q = sql.SQL("INSERT INTO {} ({}) VALUES ({})").format(
+                    self.__table_name__(table),
+                    sql.SQL(', ').join(map(sql.Identifier, columns)),
+                    sql.SQL(', ').join(sql.Placeholder() * len(columns))
+                    )
+        self.__debug_query__(q)
+        query = self.__as_string__(q)
+        start = time.perf_counter() if self._stats else None
+        with self.__lock__():
+            try:
+                self._conn.executemany(query, [list(r) for r in rows])
+            except Exception as e:
+                if self.__overflow__(e):
+                    raise self.__overflow_error__(e) from e
+                raise
+        if start:
+            self._stats.record(start, "insert", table, self._node, len(rows), len(query))
+
+    def insert_select(self, table, select, columns = None, returning = None, explain = False):
+        if explain:
+            raise ValueError(f"Query plans are not captured with {self.name}")
+        return super().insert_select(table, select, columns, returning)
+
+    def create_select(self,table,ass_sql,unlogged = False,tablespace = None,explain = False):
+        if explain:
+            raise ValueError(f"Query plans are not captured with {self.name}")
+        super().create_select(table, ass_sql)
+
+    def create_procedure(self, name, params, body, language = "plpgsql"):
+        raise ValueError(f"Stored procedures are not supported with {self.name}, use --execution-mode worker")
+
+    def call(self, procedure, params = []):
+        raise ValueError(f"Stored procedures are not supported with {self.name}, use --execution-mode worker")
+
+    # PostgreSQL settings (work_mem, parallel workers) have no equivalent
+    def set_local(self, name, value):
+        pass
+
+def sql_literal(value):
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'{}'".format(str(value).replace("'", "''"))
+
+# in-process DuckDB database (db.backend duckdb)
+class DuckDB(EmbeddedDB):
+    name = "DuckDB"
+    TYPES = [
+        # exact up to 10^38 - 1, overflows raise OutOfRangeException
+        (re.compile(r"\bNUMERIC\b"), "DECIMAL(38,0)"),
+        # updates of referenced rows are rejected by DuckDB
+        (re.compile(r"\s*REFERENCES \w+\s*\(\w+\)"), "")
+    ]
+    DIALECT = [(re.compile(r"\bstatement_timestamp\(\)"), "now()")]
+
+    def connect(self, params):
+        self._conn = duckdb.connect(params["path"] if "path" in params else ":memory:")
+
+    # sums and products of DECIMAL(38,0) and python ints that do not fit into it
+    def __overflow__(self, e):
+        return isinstance(e, (duckdb.OutOfRangeException, OverflowError)) or (isinstance(e, duckdb.ConversionException) and "DECIMAL" in str(e))
+
+    # DML statements return the number of affected rows as their result
+    def __rowcount__(self, res):
+        count = res.fetchone() if res.description and res.description[0][0] == "Count" else None
+        return count[0] if count else -1
+
+    # estimated from the number of rows, DuckDB does not report sizes of single tables
+    def relation_size(self, table):
+        name = self.__table_name__(table).string
+        return self.exec_and_fetch(sql.SQL("SELECT coalesce(sum(estimated_size * column_count * 8),0) FROM duckdb_tables() WHERE table_name = %s"),
+            [name], "size", table)[0]
+
+    def table_names(self, like):
+        return [r[0] for r in self.exec_and_fetchall(
+            sql.SQL("SELECT table_name FROM information_schema.tables WHERE table_schema = current_schema() AND table_name LIKE %s ESCAPE '\\'"), [like])]
+
+    # SERIAL columns are replaced by sequences
+    def __column_type__(self, table, column, type):
+        type = super().__column_type__(table, column, type)
+        if "SERIAL" in type:
+            seq = f"{table}_{column}_seq"
+            self.execute_ddl(sql.SQL("CREATE SEQUENCE IF NOT EXISTS {}").format(sql.Identifier(seq)),table=table)
+            type = type.replace("SERIAL", f"INTEGER DEFAULT nextval('{seq}')")
+        return type
+
+# in-process SQLite database (db.backend sqlite), meant for small instances
+# there is no generate_series, introduced vertices are always generated by --introduce union
+class SQLite(EmbeddedDB):
+    name = "SQLite"
+    generate_series = False
+    TYPES = [
+        # INTEGER PRIMARY KEY columns are filled from the rowid
+        (re.compile(r"\bSERIAL\b"), "INTEGER")
+    ]
+    DIALECT = [
+        (re.compile(r"\bstatement_timestamp\(\)"), "strftime('%Y-%m-%d %H:%M:%f','now')"),
+        (re.compile(r" CASCADE$"), "")
+    ]
+
+    def connect(self, params):
+        self._conn = sqlite3.connect(params["path"] if "path" in params else ":memory:", isolation_level=None)
+
+    # sum() of integers beyond 2^63 and python ints that do not fit into INTEGER
+    def __overflow__(self, e):
+        return isinstance(e, OverflowError) or (isinstance(e, sqlite3.OperationalError) and "integer overflow" in str(e))
+
+    def create_view(self, name, text, replace = False):
+        if replace:
+            tab = self.__table_name__(name)
+            self.execute_ddl(sql.SQL("DROP VIEW IF EXISTS {}").format(tab),table=name)
+            self.ignore_next_praefix()
+            name = tab.string
+        super().create_view(name, text)
+
+    # estimated from the number of rows and columns as for DuckDB
+    def relation_size(self, table):
+        name = self.__table_name__(table).string
+        cols = len(self.exec_and_fetchall(sql.SQL("SELECT name FROM pragma_table_info(%s)"), [name]))
+        if not cols:
+            return 0
+        return self.exec_and_fetch(sql.SQL("SELECT count(*) FROM {}").format(sql.Identifier(name)), [], "size", table)[0] * cols * 8
+
+    def table_names(self, like):
+        return [r[0] for r in self.exec_and_fetchall(
+            sql.SQL("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE %s ESCAPE '\\'"), [like])]
+
 class BlockingThreadedConnectionPool(ThreadedConnectionPool):
+    # QueryStats for all DB instances created from this pool
+    stats = None
+
     def __init__(self, minconn, maxconn, *args, **kwargs):
         self._semaphore = Semaphore(maxconn)
         super(BlockingThreadedConnectionPool,self).__init__(minconn, maxconn, *args, **kwargs)
@@ -231,3 +771,103 @@ class BlockingThreadedConnectionPool(ThreadedConnectionPool):
     def putconn(self, *args, **kwargs):
         super(BlockingThreadedConnectionPool,self).putconn(*args, **kwargs)
         self._semaphore.release()
+
+    # new pool with the same connection parameters (e.g. for a forked process)
+    def fork(self, maxconn):
+        return BlockingThreadedConnectionPool(1, maxconn, *self._args, **self._kwargs)
+
+# all connections are cursors of a single in-process database
+class DuckDBConnectionPool(object):
+    db_class = DuckDB
+    # QueryStats for all DB instances created from this pool
+    stats = None
+
+    def __init__(self, maxconn, path = ":memory:", threads = None):
+        if duckdb is None:
+            raise ValueError("db.backend duckdb requires duckdb (pip install duckdb)")
+        self._semaphore = Semaphore(maxconn)
+        self._db = duckdb.connect(path, config={"threads": threads} if threads else {})
+
+    def getconn(self):
+        self._semaphore.acquire()
+        return self._db.cursor()
+
+    def putconn(self, conn):
+        conn.close()
+        self._semaphore.release()
+
+    def closeall(self):
+        self._db.close()
+
+# a single connection, sqlite3 connections can be used by all threads but not concurrently
+class SQLiteConnectionPool(object):
+    db_class = SQLite
+    # QueryStats for all DB instances created from this pool
+    stats = None
+
+    def __init__(self, maxconn, path = ":memory:"):
+        self._semaphore = Semaphore(maxconn)
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.lock = RLock()
+
+    def getconn(self):
+        self._semaphore.acquire()
+        return self._conn
+
+    def putconn(self, conn):
+        self._semaphore.release()
+
+    def closeall(self):
+        self._conn.close()
+
+# chooses the backend of each problem by the width of its tree decomposition (db.backend auto)
+# problems are created with the large pool and switched by Problem.set_pool once the width is known
+class RoutingPool(object):
+    def __init__(self, small, large, max_width):
+        self.small = small
+        self.large = large
+        self.max_width = max_width
+
+    # exact: the problem has arbitrary precision (NUMERIC) columns, which stay on the large pool
+    def pool_for(self, td, exact = False):
+        return self.small if td.tree_width <= self.max_width and not exact else self.large
+
+    @property
+    def db_class(self):
+        return getattr(self.large, "db_class", DB)
+
+    @property
+    def stats(self):
+        return self.large.stats
+
+    @stats.setter
+    def stats(self, stats):
+        self.small.stats = self.large.stats = stats
+
+    def getconn(self):
+        return self.large.getconn()
+
+    def putconn(self, conn):
+        self.large.putconn(conn)
+
+    def closeall(self):
+        self.small.closeall()
+        self.large.closeall()
+
+# pool of the database configured in the "db" section of the config
+def create_pool(cfg, minconn = 1, backend = None):
+    backend = backend or (cfg["backend"] if "backend" in cfg else "postgres")
+    if backend != "postgres" and "backends" in cfg:
+        raise ValueError("Multiple backends require db.backend postgres")
+    if backend == "duckdb":
+        return DuckDBConnectionPool(cfg["max_connections"], **(cfg["duckdb"] if "duckdb" in cfg else {}))
+    elif backend == "sqlite":
+        return SQLiteConnectionPool(cfg["max_connections"], **(cfg["sqlite"] if "sqlite" in cfg else {}))
+    elif backend == "auto":
+        auto = cfg["auto"] if "auto" in cfg else {}
+        return RoutingPool(create_pool(cfg, minconn, auto["small"] if "small" in auto else "sqlite"),
+            create_pool(cfg, minconn, auto["large"] if "large" in auto else "postgres"),
+            auto["max_width"] if "max_width" in auto else 12)
+    elif backend == "postgres":
+        return BlockingThreadedConnectionPool(minconn, cfg["max_connections"], **cfg["dsn"])
+    raise ValueError(f"Unknown database backend: {backend}")
@@ -0,0 +1,128 @@
+# -*- coding: future_fstrings -*-
+# Re-solves an edited instance on the tree decomposition of a previous problem (--incremental-from)
+#
+# The decomposition is read from td_bag/td_edge of the previous problem and extended to cover
+# vertices and edges of the new input. Each node stores a hash of its bag and filters in
+# td_node_status.filter_hash, nodes whose hash and whose children are unchanged are not solved,
+# the tables of the topmost of them are linked as views from the problem that computed them.
+import logging
+
+from collections import deque
+
+from dpdb.treedecomp import TreeDecomp
+
+logger = logging.getLogger(__name__)
+
+def read_td(db, problem_id):
+    if not db.table_names(f"p{problem_id}\\_td\\_bag"):
+        raise ValueError(f"Problem {problem_id} has no stored tree decomposition (solved with --faster?)")
+    bags = {}
+    db.ignore_next_praefix()
+    for bag, node in db.select_all(f"p{problem_id}_td_bag", ["bag", "node"]):
+        bags.setdefault(bag, []).append(node)
+    adj = {b: [] for b in bags}
+    children = set()
+    db.ignore_next_praefix()
+    for node, parent in db.select_all(f"p{problem_id}_td_edge", ["node", "parent"]):
+        adj[node].append(parent)
+        adj[parent].append(node)
+        children.add(node)
+    root = min(set(bags) - children)
+    return bags, adj, root
+
+# adds vertices to bags (in place) until every edge of the graph is contained in a bag
+# a vertex is added along the tree path to the nearest bag of its neighbour, which keeps its bags connected
+def extend_bags(bags, adj, root, num_vertices, edges):
+    where = {}
+    for b, vertices in bags.items():
+        for v in vertices:
+            where.setdefault(v, set()).add(b)
+    changed = set()
+
+    def add(v, b):
+        bags[b].append(v)
+        where.setdefault(v, set()).add(b)
+        changed.add(b)
+
+    for u, w in edges:
+        if u in where and w in where and where[u] & where[w]:
+            continue
+        if u not in where and w not in where:
+            add(u, root)
+            add(w, root)
+        elif u not in where or w not in where:
+            new, old = (u, w) if u not in where else (w, u)
+            add(new, min(where[old], key=lambda b: (len(bags[b]), b)))
+        else:
+            # breadth first from all bags of u to the nearest bag of w
+            prev = {b: None for b in where[u]}
+            queue = deque(sorted(where[u]))
+            while queue:
+                b = queue.popleft()
+                if w in bags[b]:
+                    break
+                for n in adj[b]:
+                    if n not in prev:
+                        prev[n] = b
+                        queue.append(n)
+            while prev[b] is not None:
+                add(u, b)
+                b = prev[b]
+    for v in range(1, num_vertices + 1):
+        if v not in where:
+            add(v, root)
+    return changed
+
+# tree decomposition of the previous problem, extended for the input of problem
+def incremental_td(problem, fname):
+    logger.info("Reading tree decomposition of problem %d", problem.incremental_from)
+    bags, adj, root = read_td(problem.db, problem.incremental_from)
+    logger.info("Parsing input file")
+    num_vertices, edges = problem.prepare_input(fname)
+    changed = extend_bags(bags, adj, root, num_vertices, sorted(edges))
+    if changed:
+        logger.info("Extended %d bags for new edges", len(changed))
+    for b in bags:
+        bags[b] = sorted(bags[b])
+    td = TreeDecomp(len(bags), max(len(b) for b in bags.values()) - 1, max(num_vertices, max(max(b) for b in bags.values() if b)),
+        root, bags, adj)
+    logger.info(f"#bags: {td.num_bags} tree_width: {td.tree_width} #vertices: {td.num_orig_vertices} #leafs: {len(td.leafs)} #edges: {len(td.edges)}")
+    return td
+
+class Incremental(object):
+    def __init__(self, problem, base):
+        self.problem = problem
+        self.base = base
+        # nodes whose tables are reused, not solved at all
+        self.reused = set()
+        # reused node -> problem that solved it
+        self.origin = {}
+        # topmost reused nodes, their tables are linked as views
+        self.linked = []
+
+    def plan(self, db):
+        p = self.problem
+        db.ignore_next_praefix()
+        base_type = db.select("problem", ["type"], [f"id = {self.base}"])
+        if not base_type or base_type[0] != p.type:
+            raise ValueError(f"--incremental-from {self.base} requires a previous {p.type} problem")
+        db.ignore_next_praefix()
+        old = {n: (h, origin) for n, h, origin in db.select_all(f"p{self.base}_td_node_status",
+            ["node", "filter_hash", f"coalesce(origin, {self.base})"])}
+        for n in p.td.nodes:
+            h = p.filter_hash(n)
+            if n.id in old and h is not None and old[n.id][0] == h and all(c.id in self.reused for c in n.children):
+                self.reused.add(n.id)
+        for n in p.td.nodes:
+            if n.id in self.reused:
+                self.origin[n.id] = old[n.id][1]
+                if n.is_root() or n.parent.id not in self.reused:
+                    self.linked.append(n.id)
+                    if not db.table_names(f"p{self.origin[n.id]}\\_td\\_node\\_{n.id}"):
+                        raise ValueError(f"Table of node {n.id} of problem {self.origin[n.id]} does not exist anymore")
+        logger.info("Incremental: reusing %d of %d nodes of problem %d, solving %d", len(self.reused), len(p.td.nodes),
+            self.base, len(p.td.nodes) - len(self.reused))
+
+    def link(self, db):
+        for node_id in self.linked:
+            db.create_view(f"td_node_{node_id}", f"SELECT * FROM p{self.origin[node_id]}_td_node_{node_id}")
@@ -0,0 +1,185 @@
+# -*- coding: future_fstrings -*-
+# In-process dynamic programming on the tree decomposition (--execution-mode numpy)
+#
+# Node tables are kept in memory as numpy arrays: the assignment of a row is packed
+# into the bits of an uint64 (bit i <-> i-th vertex of the node), the problem
+# specific columns (e.g. model_count, size) are separate arrays of the same length.
+import logging
+import time
+
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+MAX_VERTICES = 63
+
+class NodeTable(object):
+    def __init__(self, vertices, bits, cols = {}):
+        self.vertices = vertices
+        self.pos = {v: i for i, v in enumerate(vertices)}
+        self.bits = bits
+        self.cols = dict(cols)
+
+    def __len__(self):
+        return len(self.bits)
+
+    def mask(self, vertices):
+        m = 0
+        for v in vertices:
+            m |= 1 << self.pos[v]
+        return np.uint64(m)
+
+    # boolean array with the value of vertex v in each row
+    def bit(self, v):
+        return ((self.bits >> np.uint64(self.pos[v])) & np.uint64(1)) == 1
+
+    def select(self, rows):
+        return NodeTable(self.vertices, self.bits[rows], {k: c[rows] for k, c in self.cols.items()})
+
+# candidate rows of a node before grouping
+# rows[c.id] is the matching row of child table children[c.id] for each candidate
+class Candidates(NodeTable):
+    def __init__(self, node, bits, children = {}, rows = {}):
+        super().__init__(node.vertices, bits)
+        self.node = node
+        self.children = dict(children)
+        self.rows = dict(rows)
+
+    def child_col(self, child, name):
+        return self.children[child.id].cols[name][self.rows[child.id]]
+
+    def select(self, rows):
+        return Candidates(self.node, self.bits[rows], self.children, {c: r[rows] for c, r in self.rows.items()})
+
+    # each row once with v false and once with v true
+    def introduce(self, v):
+        rows = np.concatenate([np.arange(len(self))] * 2)
+        cand = self.select(rows)
+        cand.bits[len(self):] |= np.uint64(1 << self.pos[v])
+        return cand
+
+# moves the stored vertices of a child table to their bit positions in the parent node
+def remap(table, child, node):
+    pos = {v: i for i, v in enumerate(node.vertices)}
+    bits = np.zeros(len(table), dtype=np.uint64)
+    for v in child.stored_vertices:
+        bits |= ((table.bits >> np.uint64(table.pos[v])) & np.uint64(1)) << np.uint64(pos[v])
+    return bits
+
+# sort-merge join of two packed bit arrays on the bits selected by common
+# returns the row indices of the matching pairs (left, right)
+def join(left, right, common):
+    lkey = left & common
+    rkey = right & common
+    order = np.argsort(rkey, kind="stable")
+    rsorted = rkey[order]
+    lo = np.searchsorted(rsorted, lkey, "left")
+    cnt = np.searchsorted(rsorted, lkey, "right") - lo
+    total = int(cnt.sum())
+    li = np.repeat(np.arange(len(left)), cnt)
+    start = np.cumsum(cnt) - cnt
+    ri = order[np.arange(total) + np.repeat(lo - start, cnt)]
+    return li, ri
+
+# evaluates a CNF over the candidate rows (clauses as lists of literals)
+def clause_filter(table, clauses):
+    keep = np.ones(len(table), dtype=bool)
+    for clause in clauses:
+        pos = table.mask([lit for lit in clause if lit > 0])
+        neg = table.mask([-lit for lit in clause if lit < 0])
+        keep &= ((table.bits & pos) != 0) | ((~table.bits & neg) != 0)
+    return keep
+
+def group_sum(values, groups, num_groups):
+    out = np.zeros(num_groups, dtype=values.dtype)
+    np.add.at(out, groups, values)
+    return out
+
+def group_min(values, groups, num_groups):
+    out = np.full(num_groups, np.iinfo(values.dtype).max, dtype=values.dtype)
+    np.minimum.at(out, groups, values)
+    return out
+
+class NumpyEngine(object):
+    def __init__(self, problem):
+        if np is None:
+            raise ValueError("--execution-mode numpy requires numpy (pip install numpy)")
+        # imported here, dpdb.problem imports this module
+        from dpdb.problem import Problem
+        if type(problem).np_filter is Problem.np_filter:
+            raise ValueError(f"{problem.type} does not support --execution-mode numpy")
+        width = max(len(n.vertices) for n in problem.td.nodes)
+        if width > MAX_VERTICES:
+            raise ValueError(f"--execution-mode numpy supports bags of at most {MAX_VERTICES} vertices, got {width}")
+        if problem.limit_result_rows or problem.randomize_rows:
+            logger.warning("--limit-result-rows and --randomize-rows are ignored with --execution-mode numpy")
+        self.problem = problem
+        self.tables = {}
+
+    def candidates(self, node):
+        p = self.problem
+        cand = Candidates(node, np.zeros(1, dtype=np.uint64))
+        known = []
+        # introduced vertices are added one by one, dropping rows as soon as a predicate can be checked
+        for v in node.vertices:
+            if node.needs_introduce(v):
+                cand = cand.introduce(v)
+                known.append(v)
+                keep = p.np_filter(node, cand, known)
+                if keep is not None:
+                    cand = cand.select(keep)
+        known = cand.mask(known)
+        for c in node.children:
+            table = self.tables[c.id]
+            bits = remap(table, c, node)
+            li, ri = join(cand.bits, bits, known & cand.mask(c.stored_vertices))
+            rows = {k: r[li] for k, r in cand.rows.items()}
+            rows[c.id] = ri
+            cand = Candidates(node, cand.bits[li] | bits[ri], {**cand.children, c.id: table}, rows)
+            known |= cand.mask(c.stored_vertices)
+            # check the predicates on the vertices joined so far to keep intermediate results small
+            keep = p.np_filter(node, cand, [v for v in node.vertices if int(known) >> cand.pos[v] & 1])
+            if keep is not None:
+                cand = cand.select(keep)
+        return cand
+
+    def solve_node(self, node):
+        p = self.problem
+        cand = self.candidates(node)
+        cols = p.np_candidate_cols(node, cand)
+        keys, groups = np.unique(cand.bits & cand.mask(node.stored_vertices), return_inverse=True)
+        return NodeTable(node.vertices, keys, p.np_aggregate(node, cols, groups.ravel(), len(keys)))
+
+    # solves all nodes in postorder, returns the table of the root
+    def solve(self):
+        p = self.problem
+        faster = "faster" in p.kwargs and p.kwargs["faster"]
+        for node in p.td.nodes:
+            if p.interrupted:
+                logger.info("Node %d interrupted", node.id)
+                return None
+            if p.progress:
+                p.progress.node_started(node)
+            start = time.time()
+            with p.trace(f"node {node.id}", "numpy", node=node.id, bag_size=len(node.vertices)) as span:
+                table = self.solve_node(node)
+                span["rows"] = len(table)
+            end = time.time()
+            self.tables[node.id] = table
+            for c in node.children:
+                del self.tables[c.id]
+            p.node_rows[node.id] = len(table)
+            num_bytes = table.bits.nbytes + sum(c.nbytes for c in table.cols.values())
+            if p.progress:
+                p.progress.node_finished(node, len(table), num_bytes)
+            if not faster:
+                p.db.update("td_node_status",["start_time","end_time","rows"],
+                    ["'{}'".format(datetime.fromtimestamp(start)),"'{}'".format(datetime.fromtimestamp(end)),str(len(table))],[f"node = {node.id}"])
+                p.db.commit()
+            logger.debug("Node %d finished (%d rows)", node.id, len(table))
+        return self.tables[p.td.root.id]
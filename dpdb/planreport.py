@@ -0,0 +1,102 @@
+# -*- coding: future_fstrings -*-
+# Summarizes the plans captured with --explain-time / --explain-rows / --explain-sample
+#
+# python -m dpdb.planreport [--config config.json] [--problem ID] [--top N]
+import argparse
+import json
+import logging
+
+from collections import defaultdict
+
+from psycopg2 import sql
+
+from dpdb.db import DB
+
+logger = logging.getLogger("dpdb.planreport")
+
+# walks the plan tree, yielding (plan node, parent plan node)
+def walk(plan, parent = None):
+    yield plan, parent
+    for c in plan.get("Plans", []):
+        yield from walk(c, plan)
+
+# total time spent in the node itself (without its children), in ms
+def exclusive_time(plan):
+    loops = plan.get("Actual Loops", 1)
+    total = plan.get("Actual Total Time", 0) * loops
+    for c in plan.get("Plans", []):
+        total -= c.get("Actual Total Time", 0) * c.get("Actual Loops", 1)
+    return max(total, 0)
+
+# direct scan of the introduce CTE, possibly materialized
+def scans_introduce(plan):
+    while plan.get("Node Type") == "Materialize":
+        plan = plan["Plans"][0]
+    return plan.get("Node Type") == "CTE Scan" and plan.get("CTE Name") == "introduce"
+
+# returns a list of warnings for a single plan node
+def spills(plan):
+    warn = []
+    node_type = plan.get("Node Type")
+    if node_type == "Hash" and plan.get("Hash Batches", 1) > 1:
+        warn.append(f"hash spilled to {plan['Hash Batches']} batches")
+    if node_type == "Sort" and plan.get("Sort Space Type") == "Disk":
+        warn.append(f"sort on disk ({plan.get('Sort Space Used')}kB)")
+    if node_type == "Aggregate" and plan.get("Disk Usage", 0) > 0:
+        warn.append(f"hash aggregate on disk ({plan['Disk Usage']}kB)")
+    if plan.get("Temp Written Blocks", 0) > 0 and not plan.get("Plans"):
+        warn.append(f"{plan['Temp Written Blocks']} temp blocks written")
+    if node_type == "Nested Loop" and any(scans_introduce(c) for c in plan.get("Plans", [])):
+        warn.append("nested loop over introduce")
+    return warn
+
+def tables(db, problem = None):
+    pattern = f"p{problem}_td_node_plan" if problem else "p%_td_node_plan"
+    return [r[0] for r in db.exec_and_fetchall(
+        sql.SQL("SELECT tablename FROM pg_tables WHERE tablename LIKE %s ORDER BY tablename"), [pattern])]
+
+def report(db, problem = None, top = 10):
+    by_type = defaultdict(lambda: [0, 0.0])
+    slowest = []
+    warnings = []
+    for tab in tables(db, problem):
+        for node, exec_time, rows, plan in db.exec_and_fetchall(
+                sql.SQL("SELECT node, exec_time, rows, plan FROM {}").format(sql.Identifier(tab))):
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            slowest.append((exec_time, tab, node, rows))
+            for p, _ in walk(plan[0]["Plan"]):
+                by_type[p["Node Type"]][0] += 1
+                by_type[p["Node Type"]][1] += exclusive_time(p)
+                for w in spills(p):
+                    warnings.append((tab, node, w))
+
+    print(f"{'node type':<24} {'count':>8} {'exclusive ms':>14}")
+    for node_type, (count, ms) in sorted(by_type.items(), key=lambda t: t[1][1], reverse=True):
+        print(f"{node_type:<24} {count:>8} {ms:>14.1f}")
+
+    print()
+    print(f"slowest {top} nodes:")
+    for exec_time, tab, node, rows in sorted(slowest, reverse=True)[:top]:
+        print(f"{tab:<24} node {node:>6} {exec_time:>12.1f}ms {rows:>12} rows")
+
+    if warnings:
+        print()
+        print("warnings:")
+        for tab, node, w in warnings:
+            print(f"{tab:<24} node {node:>6}: {w}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="Config file", default="config.json")
+    parser.add_argument("--problem", type=int, help="Only report plans of this problem id")
+    parser.add_argument("--top", type=int, help="Number of slowest nodes to list", default=10)
+    opts = parser.parse_args()
+
+    logging.basicConfig(format='[%(levelname)s] %(name)s: %(message)s', level=logging.INFO)
+
+    with open(opts.config) as c:
+        cfg = json.load(c)
+    db = DB.from_cfg(cfg["db"]["dsn"])
+    report(db, opts.problem, opts.top)
+    db.close()
@@ -1,13 +1,27 @@
 # -*- coding: future_fstrings -*-
+import hashlib
+import itertools
+import json
 import logging
 import os
+import random
 import signal
 import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from types import SimpleNamespace
 
+from psycopg2 import sql
+
 from dpdb.reader import TwReader
-from dpdb.db import DB
+from dpdb.db import DB, QueryCanceled
+from dpdb.numpy_engine import NumpyEngine
+from dpdb.process_engine import ProcessEngine
+from dpdb.subtree_cache import SubtreeCache
+from dpdb.sql_cache import SqlCache
+from dpdb.incremental import Incremental
+from dpdb.costmodel import schedule
 
 logger = logging.getLogger(__name__)
 
@@ -25,14 +39,110 @@ args.general = {
     ),
     "--candidate-store": dict(
         dest="candidate_store",
-        help="How to store/use candidate results",
-        choices=["cte","subquery","table"],
+        help="How to store/use candidate results (auto: choose per node by estimated size)",
+        choices=["cte","subquery","table","auto"],
         default="subquery"
+    ),
+    "--introduce": dict(
+        dest="introduce",
+        help="How to generate assignments of introduced vertices (series: single bit enumeration with pushed down filter)",
+        choices=["union","series"],
+        default="union"
+    ),
+    "--join-plan": dict(
+        dest="join_plan",
+        help="How to join children of join nodes (reduce: semi-join reduce children, project early and join by observed size)",
+        choices=["cross","reduce"],
+        default="cross"
+    ),
+    "--explain-time": dict(
+        type=float,
+        dest="explain_time",
+        help="Store EXPLAIN (ANALYZE, BUFFERS) plans of nodes taking longer than this many seconds (runs every node under EXPLAIN ANALYZE)"
+    ),
+    "--explain-rows": dict(
+        type=int,
+        dest="explain_rows",
+        help="Store EXPLAIN (ANALYZE, BUFFERS) plans of nodes producing more rows than this (runs every node under EXPLAIN ANALYZE)"
+    ),
+    "--explain-sample": dict(
+        type=float,
+        dest="explain_sample",
+        help="Fraction of randomly chosen nodes whose EXPLAIN (ANALYZE, BUFFERS) plans are stored"
+    ),
+    "--execution-mode": dict(
+        dest="execution_mode",
+        help="Solve nodes by python worker threads, by worker processes per independent subtree, by a stored procedure inside the database or in memory with numpy",
+        choices=["worker","process","procedure","numpy"],
+        default="worker"
+    ),
+    "--procedure-parts": dict(
+        type=int,
+        dest="procedure_parts",
+        help="Number of independent subtrees solved by concurrent procedure calls (--execution-mode procedure)",
+        default=1
+    ),
+    "--processes": dict(
+        type=int,
+        dest="processes",
+        help="Number of worker processes solving independent subtrees (--execution-mode process, default: number of CPUs)"
+    ),
+    "--sql-cache": dict(
+        dest="sql_cache",
+        help="Directory storing the generated SQL of the nodes, re-runs of the same instance and tree decomposition skip generating it"
+    ),
+    "--numpy-parity": dict(
+        action="store_true",
+        dest="numpy_parity",
+        help="Additionally solve with worker threads and compare the results (--execution-mode numpy)"
+    ),
+    "--incremental-from": dict(
+        type=int,
+        dest="incremental_from",
+        help="Reuse the tree decomposition and the tables of unchanged nodes of this previous problem id"
+    ),
+    "--witness": dict(
+        dest="witness",
+        help="Write a solution (literals of all vertices, positive if true) to this file"
+    ),
+    "--enumerate": dict(
+        type=int,
+        dest="enumerate",
+        help="Write up to this many solutions (0: all) to the --witness file"
     )
 }
 
 args.specific = {}
 
+# server side driver for --execution-mode procedure
+# runs all statements of one part of the decomposition in postorder
+# each node is solved in its own transaction, SET LOCAL statements of a node last until its end
+SOLVE_PART_PROCEDURE = "dpdb_solve_part"
+SOLVE_PART_BODY = """
+DECLARE
+    r RECORD;
+    cur_node INTEGER;
+    row_cnt BIGINT;
+BEGIN
+    FOR r IN EXECUTE format('SELECT node, stmt FROM %I WHERE part = $1 ORDER BY pos', praefix || 'td_node_sql') USING part LOOP
+        IF r.node IS DISTINCT FROM cur_node THEN
+            IF cur_node IS NOT NULL THEN
+                COMMIT;
+            END IF;
+            IF track_status THEN
+                EXECUTE format('UPDATE %I SET start_time = clock_timestamp() WHERE node = $1', praefix || 'td_node_status') USING r.node;
+            END IF;
+            cur_node := r.node;
+        END IF;
+        EXECUTE r.stmt;
+        GET DIAGNOSTICS row_cnt = ROW_COUNT;
+        IF track_status THEN
+            EXECUTE format('UPDATE %I SET end_time = clock_timestamp(), rows = $2 WHERE node = $1', praefix || 'td_node_status') USING r.node, row_cnt;
+        END IF;
+    END LOOP;
+END
+"""
+
 def node2tab(node):
     return f"td_node_{node.id}"
 
@@ -45,41 +155,138 @@ def var2tab(node, var):
     else:
         return node2tab(node.vertex_children(var)[0])
 
-def var2tab_alias(node, var):
+# packed: all introduced vertices are columns of a single introduce table
+def var2tab_alias(node, var, packed=False):
     if node.needs_introduce(var):
-        return f"i{var}"
+        return "i" if packed else f"i{var}"
     else:
         return node2tab_alias(node.vertex_children(var)[0])
 
 def var2col(var):
     return f"v{var}"
 
-def var2tab_col(node, var, alias=True):
+def var2tab_col(node, var, alias=True, packed=False):
     if node.needs_introduce(var):
+        col = var2col(var) if packed else "val"
         if alias:
-            return "{}.val {}".format(var2tab_alias(node, var),var2col(var))
+            return "{}.{} {}".format(var2tab_alias(node, var, packed),col,var2col(var))
         else:
-            return "{}.val".format(var2tab_alias(node, var))
+            return "{}.{}".format(var2tab_alias(node, var, packed),col)
     else:
         return "{}.{}".format(var2tab_alias(node, var),var2col(var))
 
+# bigint limits bit enumeration
+MAX_PACKED_INTRODUCE = 62
+
+# thresholds for --candidate-store auto, can be overwritten by "candidate_store_auto" in config
+# work_mem values are in kB
+CANDIDATE_STORE_AUTO = {
+    "table_rows": 1000000,
+    "parallel_rows": 1000000,
+    "parallel_workers": 2,
+    "work_mem_min": 4096,
+    "work_mem_max": 1048576
+}
+
+# tables shared by all problems
+def create_base_tables(db):
+    db.create_table("problem", [
+        ("id", "SERIAL NOT NULL PRIMARY KEY"),
+        ("name", "VARCHAR(255) NOT NULL"),
+        ("type", "VARCHAR(32) NOT NULL"),
+        ("num_bags", "INTEGER"),
+        ("tree_width", "INTEGER"),
+        ("num_vertices", "INTEGER"),
+        ("setup_start_time", "TIMESTAMP"),
+        ("calc_start_time", "TIMESTAMP"),
+        ("end_time", "TIMESTAMP")
+    ])
+    db.create_table("problem_option", [
+        ("id", "INTEGER NOT NULL REFERENCES PROBLEM(id)"),
+        ("type", "VARCHAR(8) NOT NULL DEFAULT 'argument'"),
+        ("name", "VARCHAR(255) NOT NULL"),
+        ("value", "VARCHAR(255)")
+    ])
+
 class Problem(object):
     id = None
     td = None
 
     def __init__(self, name, pool, max_worker_threads=12,
             candidate_store="cte", limit_result_rows=None,
-            randomize_rows=False, **kwargs):
+            randomize_rows=False, introduce="union", join_plan="cross",
+            execution_mode="worker", procedure_parts=1, candidate_store_auto={},
+            node_persistence="logged", node_tablespace=None, explain_time=None,
+            explain_rows=None, explain_sample=None, budget={}, attempt=0, numpy_parity=False, subtree_cache={},
+            incremental_from=None, witness=None, enumerate=None, processes=None, sql_cache=None, **kwargs):
         self.name = name
         self.pool = pool
         self.candidate_store = candidate_store
+        self.candidate_store_auto = dict(CANDIDATE_STORE_AUTO, **candidate_store_auto)
+        self.introduce_strategy = introduce
+        if node_persistence not in ("logged", "unlogged"):
+            raise ValueError(f"Unknown node persistence: {node_persistence}")
+        self.node_persistence = node_persistence
+        self.node_tablespace = node_tablespace
+        self.explain_time = explain_time
+        self.explain_rows = explain_rows
+        self.explain_sample = explain_sample
+        # limits on rows, bytes and seconds per node / in total, see check_budget
+        self.budget = dict(budget)
+        self.attempt = attempt
+        # options of the SubtreeCache (enabled if set)
+        self.subtree_cache = dict(subtree_cache)
+        self.cache = None
+        # SQL of the nodes rendered once (and stored in directory sql_cache if set)
+        self.sql_cache = SqlCache(self, sql_cache)
+        self.incremental_from = incremental_from
+        # Incremental planning the reuse of nodes of problem incremental_from
+        self.incremental = None
+        if enumerate is not None and not witness:
+            raise ValueError("--enumerate requires --witness")
+        self.witness = witness
+        self.enumerate = enumerate
+        # dpdb.costmodel.CostModel and its predictions for the nodes (if set)
+        self.cost_model = None
+        self.predictions = None
+        self.budget_exceeded = None
+        # set by after_solve of the problem type (e.g. number of models)
+        self.result = None
+        # exception of a failed node worker
+        self.error = None
+        # cancel only this problem if a node worker fails instead of signalling the process
+        self.cancel_on_error = False
+        self.join_plan = join_plan
+        self.execution_mode = execution_mode
+        self.procedure_parts = procedure_parts
+        self.processes = processes
+        # forked processes of --execution-mode process, terminated by cancel
+        self.worker_processes = []
+        self.numpy_parity = numpy_parity
         self.limit_result_rows = limit_result_rows
         self.randomize_rows = randomize_rows
         self.max_worker_threads = max_worker_threads
         self.kwargs = kwargs
         self.type = type(self).__name__
         self.db = DB.from_pool(pool)
+        # pools of all backends, the first one also stores the metadata and the top of the tree
+        self.pools = [pool]
+        # index of the backend solving a node (default 0)
+        self.node_backend = {}
         self.interrupted = False
+        # number of rows of already solved nodes
+        self.node_rows = {}
+        # per node choices of --candidate-store auto
+        self.node_plans = {}
+        # dpdb.trace.Tracer recording the timeline of solve (if set)
+        self.tracer = None
+        # dpdb.progress.Progress tracking solved nodes (if set)
+        self.progress = None
+        # size of already solved node tables
+        self.node_bytes = {}
+        # (db, start time) of nodes currently being solved
+        self._active = {}
+        self._active_lock = threading.Lock()
 
     # overwrite the following methods (if required)
     def td_node_column_def(self, var):
@@ -88,6 +295,10 @@ class Problem(object):
     def td_node_extra_columns(self):
         return []
 
+    # whether extra columns need arbitrary precision (NUMERIC, e.g. model counts), see RoutingPool
+    def exact_columns(self):
+        return any(t.split("(")[0].strip().upper() == "NUMERIC" for _, t in self.td_node_extra_columns())
+
     def candidate_extra_cols(self,node):
         return []
 
@@ -101,6 +312,10 @@ class Problem(object):
     def introduce(self,node):
         return "SELECT true val UNION ALL SELECT false"
 
+    # predicates only on introduced vertices, pushed into their generation with --introduce series
+    def introduce_filter(self,node):
+        return ""
+
     def join(self,node):
         joins = []
         for v in node.vertices:
@@ -124,6 +339,10 @@ class Problem(object):
     def filter(self,node):
         return "WHERE FALSE"
 
+    # vertices referenced by filter, all others can be projected away early with --join-plan reduce
+    def filter_vertices(self,node):
+        return node.vertices
+
     def prepare_input(self, fname):
         pass
 
@@ -142,50 +361,210 @@ class Problem(object):
     def after_solve_node(self, node, db):
         pass
 
+    # number of constraints checked in node (e.g. clauses), a feature of the cost model
+    def node_constraints(self, node):
+        return 0
+
+    # ORDER BY expressions choosing the best candidate of a node for a witness (e.g. smallest size), empty for any
+    def witness_order(self, node):
+        return []
+
+    # filters of node with vertices renamed by label (for the subtree cache), None if not supported
+    def cache_key(self, node, label):
+        return None
+
+    # options the generated SQL depends on besides the input and the decomposition (key of the SQL cache)
+    def sql_options(self):
+        return [self.candidate_store, sorted(self.candidate_store_auto.items()), self.introduce_strategy, self.join_plan,
+            bool(self.db.generate_series)]
+
+    # hooks of --execution-mode numpy, see dpdb.numpy_engine
+    # boolean array of the candidate rows to keep (None keeps all), only checking the given vertices
+    # required, problems that do not overwrite it do not support --execution-mode numpy
+    def np_filter(self, node, candidates, vertices):
+        return None
+
+    # dict of extra columns of the candidate rows
+    def np_candidate_cols(self, node, candidates):
+        return {}
+
+    # dict of extra columns aggregated by the (0 based) group index of each candidate row
+    def np_aggregate(self, node, cols, groups, num_groups):
+        return {}
+
+    # result of the problem computed from the root table
+    def np_result(self, table):
+        return None
+
     # the following methods can be overwritten at your own risk
-    def candidates_select(self,node):
+    def packed_introduce(self,node):
+        if self.introduce_strategy != "series" or type(self).introduce is not Problem.introduce or not self.db.generate_series:
+            return False
+        return 0 < len([v for v in node.vertices if node.needs_introduce(v)]) <= MAX_PACKED_INTRODUCE
+
+    # enumerate all assignments of the introduced vertices as bits of a single series
+    def introduce_packed(self,node):
+        introduced = [v for v in node.vertices if node.needs_introduce(v)]
+        q = "SELECT {} FROM generate_series(0,{}::bigint) g(g)".format(
+                ",".join(["(g & {}::bigint) <> 0 {}".format(1 << i,var2col(v)) for i, v in enumerate(introduced)]),
+                (1 << len(introduced)) - 1
+                )
+        introduce_filter = self.introduce_filter(node)
+        if introduce_filter:
+            q = f"SELECT * FROM ({q}) AS bits {introduce_filter}"
+        return q
+
+    # extra_cols: replace candidate_extra_cols, reduce: allow --join-plan reduce (which projects vertices away)
+    def candidates_select(self,node,extra_cols=None,reduce=True):
         q = ""
+        packed = self.packed_introduce(node)
 
         if any(node.needs_introduce(v) for v in node.vertices):
-            q += "WITH introduce AS ({}) ".format(self.introduce(node))
+            q += "WITH introduce AS ({}) ".format(self.introduce_packed(node) if packed else self.introduce(node))
 
         q += "SELECT {}".format(
-                ",".join([var2tab_col(node, v) for v in node.vertices]),
+                ",".join([var2tab_col(node, v, packed=packed) for v in node.vertices]),
                 )
 
-        extra_cols = self.candidate_extra_cols(node)
+        if extra_cols is None:
+            extra_cols = self.candidate_extra_cols(node)
         if extra_cols:
             q += "{}{}".format(", " if node.vertices else "", ",".join(extra_cols))
 
-        if node.vertices or node.children:
-            q += " FROM {}".format(
-                    ",".join(set(["{} {}".format(var2tab(node, v), var2tab_alias(node, v)) for v in node.vertices] +
-                                 ["{} {}".format(node2tab(n), node2tab_alias(n)) for n in node.children]))
-                    )
+        if reduce and self.reduce_join(node):
+            q += " FROM {}".format(self.reduced_join(node, packed))
+        else:
+            if node.vertices or node.children:
+                q += " FROM {}".format(
+                        ",".join(sorted(set(["{} {}".format(var2tab(node, v), var2tab_alias(node, v, packed)) for v in node.vertices] +
+                                            ["{} {}".format(node2tab(n), node2tab_alias(n)) for n in node.children])))
+                        )
 
-        if len(node.children) > 1:
-            q += " {} ".format(self.join(node))
+            if len(node.children) > 1:
+                q += " {} ".format(self.join(node))
 
         return q
 
+    def reduce_join(self,node):
+        return self.join_plan == "reduce" and len(node.children) > 1 and type(self).join is Problem.join
+
+    # children are joined in order of their observed size, each child is
+    # semi-join reduced by its siblings and vertices only needed for the
+    # child itself are aggregated away before the join
+    def reduced_join(self,node,packed):
+        children = sorted(node.children, key=lambda c: (self.node_rows.get(c.id, 0), c.id))
+        keep = set(node.stored_vertices) | set(self.filter_vertices(node))
+        keep |= set(v for v in node.vertices if len(node.vertex_children(v)) > 1)
+
+        q = ""
+        joined = []
+        for c in children:
+            child = "({}) {}".format(self.reduced_child(node, c, keep), node2tab_alias(c))
+            if not joined:
+                q = child
+            else:
+                on = []
+                for v in c.stored_vertices:
+                    prev = [j for j in joined if v in j.stored_vertices]
+                    if prev:
+                        on.append("{0}.{2} = {1}.{2}".format(node2tab_alias(prev[0]), node2tab_alias(c), var2col(v)))
+                q += " JOIN {} ON {}".format(child, " AND ".join(on) if on else "TRUE")
+            joined.append(c)
+
+        introduce = sorted(set(["{} {}".format(var2tab(node, v), var2tab_alias(node, v, packed))
+                                for v in node.vertices if node.needs_introduce(v)]))
+        for i in introduce:
+            q += f" CROSS JOIN {i}"
+
+        return q
+
+    def reduced_child(self,node,child,keep):
+        tab = node2tab(child)
+        alias = f"r{child.id}"
+        proj = [v for v in child.stored_vertices if v in keep]
+        dropped = [v for v in child.stored_vertices if v not in keep]
+
+        semi_joins = []
+        for s in node.children:
+            shared = [v for v in child.stored_vertices if s != child and v in s.stored_vertices]
+            if shared:
+                semi_joins.append("EXISTS (SELECT 1 FROM {} s{} WHERE {})".format(node2tab(s), s.id,
+                    " AND ".join(["s{0}.{2} = {1}.{2}".format(s.id, alias, var2col(v)) for v in shared])))
+        where = " WHERE {}".format(" AND ".join(semi_joins)) if semi_joins else ""
+
+        if not dropped or not proj:
+            return f"SELECT * FROM {tab} {alias}{where}"
+
+        sel_list = [var2col(v) for v in proj]
+        sel_list += ["CAST(null AS {}) {}".format(self.td_node_column_def(v)[1], var2col(v)) for v in dropped]
+        extra_cols = self.assignment_extra_cols(node)
+        group_by = " GROUP BY {}".format(",".join([var2col(v) for v in proj]))
+        if extra_cols:
+            return "SELECT {} FROM {} {}{}{}".format(",".join(sel_list + extra_cols), tab, alias, where, group_by)
+        else:
+            return "SELECT DISTINCT {} FROM {} {}{}".format(",".join(sel_list), tab, alias, where)
+
+    # estimated number of candidates, based on the recorded sizes of the children
+    def estimate_rows(self,node):
+        est = 2 ** len([v for v in node.vertices if node.needs_introduce(v)])
+        for c in node.children:
+            est *= self.node_rows.get(c.id, 2 ** len(c.stored_vertices))
+        for v in node.vertices:
+            if len(node.vertex_children(v)) > 1:
+                est //= 2 ** (len(node.vertex_children(v)) - 1)
+        return max(1, min(est, 2 ** len(node.vertices), 2 ** 62))
+
+    def plan_node(self,node):
+        auto = self.candidate_store_auto
+        est = self.estimate_rows(node)
+        row_bytes = 24 + len(node.vertices) + 16 * len(self.td_node_extra_columns())
+        plan = {
+            "est_rows": est,
+            "candidate_store": "table" if len(node.children) > 1 and est >= auto["table_rows"] else "subquery",
+            "work_mem": min(max(est * row_bytes // 1024, auto["work_mem_min"]), auto["work_mem_max"]),
+            "parallel_workers": auto["parallel_workers"] if est >= auto["parallel_rows"] else 0
+        }
+        logger.debug("Node %d: estimated %d rows, candidate store %s, work_mem %dkB, %d parallel workers",
+            node.id, est, plan["candidate_store"], plan["work_mem"], plan["parallel_workers"])
+        self.node_plans[node.id] = plan
+        return plan
+
+    # intermediate results can always be recomputed, only the root is kept logged
+    def node_table_options(self,node,candidate=False):
+        return {
+            "unlogged": self.node_persistence == "unlogged" and (candidate or not node.is_root()),
+            "tablespace": self.node_tablespace
+        }
+
+    def node_candidate_store(self,node):
+        if self.candidate_store != "auto":
+            return self.candidate_store
+        if node.id not in self.node_plans:
+            self.plan_node(node)
+        return self.node_plans[node.id]["candidate_store"]
+
     def assignment_select(self,node):
         sel_list = ",".join([var2col(v) if v in node.stored_vertices
-                                        else "null::{} {}".format(self.td_node_column_def(v)[1],var2col(v)) for v in node.vertices])
+                                        else "CAST(null AS {}) {}".format(self.td_node_column_def(v)[1],var2col(v)) for v in node.vertices])
         extra_cols = self.assignment_extra_cols(node)
         if extra_cols:
             sel_list += "{}{}".format(", " if sel_list else "", ",".join(extra_cols))
 
-        candidates_sel = self.candidates_select(node)
+        candidate_store = self.node_candidate_store(node)
 
-        if self.candidate_store == "cte":
-            q = f"WITH candidate AS ({candidates_sel}) SELECT {sel_list} FROM candidate"
-        elif self.candidate_store == "subquery":
-            q = f"SELECT {sel_list} FROM ({candidates_sel}) AS candidate"
-        elif self.candidate_store == "table":
+        if candidate_store == "cte":
+            q = f"WITH candidate AS ({self.candidates_select(node)}) SELECT {sel_list} FROM candidate"
+        elif candidate_store == "subquery":
+            q = f"SELECT {sel_list} FROM ({self.candidates_select(node)}) AS candidate"
+        elif candidate_store == "table":
             q = f"SELECT {sel_list} FROM td_node_{node.id}_candidate"
 
         return q
 
+    # candidates ("candidates") or assignment ("assignment") query of node from the SQL cache, with the tables of db
+    def node_sql(self, node, kind, db):
+        return db.bind_praefix(self.sql_cache.get(node, kind))
+
     def assignment_view(self,node):
         q = "{} {}".format(self.assignment_select(node),self.filter(node))
 
@@ -208,29 +587,124 @@ class Problem(object):
     def set_td(self, td):
         self.td = td
 
+    def set_cost_model(self, model):
+        self.cost_model = model
+        self.predictions = model.predict(self, self.td)
+
+    def is_reused(self, node):
+        return self.incremental is not None and node.id in self.incremental.reused
+
+    # hash of the bag and the filters of node (None if not supported), see dpdb.incremental
+    def filter_hash(self, node):
+        key = self.cache_key(node, {v: v for v in node.vertices})
+        if key is None:
+            return None
+        return hashlib.sha256(repr((sorted(node.vertices), sorted(node.stored_vertices), key)).encode()).hexdigest()
+
     def set_id(self,id):
         self.id = id
         self.db.set_praefix(f"p{self.id}_")
 
+    # additional database servers, whole subtrees of the decomposition are solved on them
+    # switches to another database before setup (e.g. chosen by the width of the decomposition)
+    def set_pool(self, pool):
+        self.db.close()
+        self.pool = pool
+        self.pools[0] = pool
+        self.db = DB.from_pool(pool)
+
+    def set_backends(self, pools):
+        self.pools = [self.pool] + list(pools)
+
+    def pool_for(self, node):
+        return self.pools[self.node_backend.get(node.id, 0)]
+
+    # the table of the root of a subtree has to be copied to the backend of its parent
+    def is_shipped(self, node):
+        return not node.is_root() and self.node_backend.get(node.id, 0) != self.node_backend.get(node.parent.id, 0)
+
+    # rows copied to the parent's backend if node is the root of a subtree on another backend
+    def transfer_rows(self, node):
+        if self.predictions:
+            return self.predictions[node.id]["rows"]
+        return min(self.estimate_rows(node), 2 ** len(node.stored_vertices))
+
+    # each other backend solves one subtree, the rest of the tree stays on the first backend
+    # only the root table of a subtree is transferred, subtrees of at most a fair share of the nodes
+    # (preferably at least half of it) are chosen by the fewest rows to transfer
+    def place_nodes(self):
+        nodes = self.td.nodes
+        size = {}
+        for n in nodes:
+            size[n.id] = 1 + sum(size[c.id] for c in n.children)
+        share = len(nodes) // len(self.pools)
+        candidates = [n for n in nodes if not n.is_root() and size[n.id] <= share]
+        candidates.sort(key=lambda n: (2 * size[n.id] < share, self.transfer_rows(n), -size[n.id]))
+        # nodes of chosen subtrees and their ancestors
+        blocked = set()
+        backend = 1
+        for n in candidates:
+            if backend == len(self.pools):
+                break
+            if n.id in blocked:
+                continue
+            stack = [n]
+            while stack:
+                m = stack.pop()
+                self.node_backend[m.id] = backend
+                blocked.add(m.id)
+                stack.extend(m.children)
+            a = n.parent
+            while a and a.id not in blocked:
+                blocked.add(a.id)
+                a = a.parent
+            logger.info("Backend %d: %d nodes, ~%d rows to transfer", backend, size[n.id], self.transfer_rows(n))
+            backend += 1
+        if backend < len(self.pools):
+            logger.warning("Only %d of %d backends used, the tree decomposition is too small", backend, len(self.pools))
+
+    # copies the table of node to the backend of its parent, db is connected to the node's backend
+    def ship(self, node, db):
+        dst = DB.from_pool(self.pool_for(node.parent))
+        try:
+            dst.set_praefix(f"p{self.id}_")
+            dst.create_table(f"td_node_{node.id}", [self.td_node_column_def(c) for c in node.vertices] + self.td_node_extra_columns(),
+                **self.node_table_options(node))
+            error = []
+            r, w = os.pipe()
+            def send():
+                try:
+                    with os.fdopen(w, "wb") as f:
+                        db.copy_to(f"td_node_{node.id}", f)
+                except Exception as e:
+                    error.append(e)
+            sender = threading.Thread(target=send, name=f"copy_{node.id}")
+            sender.start()
+            try:
+                with os.fdopen(r, "rb") as f:
+                    dst.copy_from(f"td_node_{node.id}", f)
+            finally:
+                # closing the read end stops the sender if the copy failed
+                sender.join()
+            if error:
+                raise error[0]
+            logger.debug("Copied %d rows of node %d to backend %d", dst.last_rowcount, node.id, self.node_backend.get(node.parent.id, 0))
+            dst.commit()
+        except Exception:
+            dst.rollback()
+            raise
+        finally:
+            # hand the connection back to the pool in any case
+            dst.close()
+
     def setup(self):
-        def create_base_tables():
-            self.db.create_table("problem", [
-                ("id", "SERIAL NOT NULL PRIMARY KEY"),
-                ("name", "VARCHAR(255) NOT NULL"),
-                ("type", "VARCHAR(32) NOT NULL"),
-                ("num_bags", "INTEGER"),
-                ("tree_width", "INTEGER"),
-                ("num_vertices", "INTEGER"),
-                ("setup_start_time", "TIMESTAMP"),
-                ("calc_start_time", "TIMESTAMP"),
-                ("end_time", "TIMESTAMP")
-            ])
-            self.db.create_table("problem_option", [
-                ("id", "INTEGER NOT NULL REFERENCES PROBLEM(id)"),
-                ("type", "VARCHAR(8) NOT NULL DEFAULT 'argument'"),
-                ("name", "VARCHAR(255) NOT NULL"),
-                ("value", "VARCHAR(255)")
-            ])
+        backend_dbs = {0: self.db}
+
+        def backend_db(backend):
+            if backend not in backend_dbs:
+                backend_dbs[backend] = DB.from_pool(self.pools[backend])
+                backend_dbs[backend].set_praefix(f"p{self.id}_")
+            return backend_dbs[backend]
 
         def init_problem():
             problem_id = self.db.insert("problem",
@@ -244,16 +718,28 @@ class Problem(object):
             self.db.drop_table("td_bag")
             self.db.drop_table("td_edge")
             for n in self.td.nodes:
-                self.db.drop_table(f"td_node_{n.id}")
+                if self.is_reused(n):
+                    continue
+                backend_db(self.node_backend.get(n.id, 0)).drop_table(f"td_node_{n.id}")
+                if self.is_shipped(n):
+                    backend_db(self.node_backend.get(n.parent.id, 0)).drop_table(f"td_node_{n.id}")
 
         def create_tables():
             logger.debug("Creating tables")
-            self.db.create_table("td_node_status", [
-                ("node", "INTEGER NOT NULL PRIMARY KEY"),
-                ("start_time", "TIMESTAMP"),
-                ("end_time", "TIMESTAMP"),
-                ("rows", "INTEGER")
-            ])
+            # other backends keep the status of their nodes until the end of solve
+            for b in set([0] + list(self.node_backend.values())):
+                backend_db(b).create_table("td_node_status", [
+                    ("node", "INTEGER NOT NULL PRIMARY KEY"),
+                    ("start_time", "TIMESTAMP"),
+                    ("end_time", "TIMESTAMP"),
+                    ("rows", "INTEGER"),
+                    ("est_rows", "BIGINT"),
+                    ("candidate_store", "VARCHAR(8)"),
+                    ("work_mem", "INTEGER"),
+                    ("filter_hash", "VARCHAR(64)"),
+                    ("origin", "INTEGER"),
+                    ("num_constraints", "INTEGER")
+                ])
             self.db.create_table("td_edge", [("node", "INTEGER NOT NULL"), ("parent", "INTEGER NOT NULL")])
             self.db.create_table("td_bag", [("bag", "INTEGER NOT NULL"),("node", "INTEGER")])
 
@@ -261,69 +747,184 @@ class Problem(object):
                 workers = {}
                 with ThreadPoolExecutor(self.max_worker_threads) as executor:
                     for n in self.td.nodes:
-                        e = executor.submit(create_tables_for_node,n,workers)
-                        workers[n.id] = e
+                        if not self.is_reused(n):
+                            e = executor.submit(create_tables_for_node,n,workers)
+                            workers[n.id] = e
             else:
                 for n in self.td.nodes:
-                    create_tables_for_node(n)
+                    if not self.is_reused(n):
+                        create_tables_for_node(n)
 
 
         def create_tables_for_node(n, workers = {}):
             if "parallel_setup" in self.kwargs and self.kwargs["parallel_setup"]:
                 for c in n.children:
-                    if not self.interrupted:
+                    if not self.interrupted and c.id in workers:
                         workers[c.id].result()
                 if self.interrupted:
                     return
-                db = DB.from_pool(self.pool)
+                db = DB.from_pool(self.pool_for(n))
                 db.set_praefix(f"p{self.id}_")
             else:
-                db = self.db
+                db = backend_db(self.node_backend.get(n.id, 0))
+            db.set_node(n.id)
 
             # create all columns and insert null if values are not used in parent
             # this only works in the current version of manual inserts without procedure calls in worker
-            db.create_table(f"td_node_{n.id}", [self.td_node_column_def(c) for c in n.vertices] + self.td_node_extra_columns())
-            if self.candidate_store == "table":
-                db.create_table(f"td_node_{n.id}_candidate", [self.td_node_column_def(c) for c in n.vertices] + self.td_node_extra_columns())
-                candidate_view = self.candidates_select(n)
-                candidate_view = db.replace_dynamic_tabs(candidate_view)
-                db.create_view(f"td_node_{n.id}_candidate_v", candidate_view)
-            ass_view = self.assignment_view(n)
-            ass_view = db.replace_dynamic_tabs(ass_view)
-            db.create_view(f"td_node_{n.id}_v", ass_view)
+            db.create_table(f"td_node_{n.id}", [self.td_node_column_def(c) for c in n.vertices] + self.td_node_extra_columns(),
+                **self.node_table_options(n))
+            if self.node_candidate_store(n) == "table":
+                db.create_table(f"td_node_{n.id}_candidate", [self.td_node_column_def(c) for c in n.vertices] + self.td_node_extra_columns(),
+                    **self.node_table_options(n, True))
+                db.create_view(f"td_node_{n.id}_candidate_v", self.node_sql(n, "candidates", db))
+            db.create_view(f"td_node_{n.id}_v", self.node_sql(n, "assignment", db))
+            db.set_node(None)
             if "parallel_setup" in self.kwargs and self.kwargs["parallel_setup"]:
                 db.close()
+            if self.is_shipped(n):
+                # target of the copy, the parent's views refer to it
+                if "parallel_setup" in self.kwargs and self.kwargs["parallel_setup"]:
+                    db = DB.from_pool(self.pool_for(n.parent))
+                    db.set_praefix(f"p{self.id}_")
+                else:
+                    db = backend_db(self.node_backend.get(n.parent.id, 0))
+                db.create_table(f"td_node_{n.id}", [self.td_node_column_def(c) for c in n.vertices] + self.td_node_extra_columns(),
+                    **self.node_table_options(n))
+                if "parallel_setup" in self.kwargs and self.kwargs["parallel_setup"]:
+                    db.close()
             
         def insert_data():
             logger.debug("Inserting problem data")
-            self.db.ignore_next_praefix(3)
+            self.db.ignore_next_praefix(19)
             self.db.insert("problem_option",("id", "name", "value"),(self.id,"candidate_store",self.candidate_store))
+            self.db.insert("problem_option",("id", "name", "value"),(self.id,"introduce",self.introduce_strategy))
+            self.db.insert("problem_option",("id", "name", "value"),(self.id,"join_plan",self.join_plan))
             self.db.insert("problem_option",("id", "name", "value"),(self.id,"limit_result_rows",self.limit_result_rows))
             self.db.insert("problem_option",("id", "name", "value"),(self.id,"randomize_rows",self.randomize_rows))
+            self.db.insert("problem_option",("id", "name", "value"),(self.id,"execution_mode",self.execution_mode))
+            self.db.insert("problem_option",("id", "name", "value"),(self.id,"procedure_parts",self.procedure_parts))
+            self.db.insert("problem_option",("id", "name", "value"),(self.id,"numpy_parity",self.numpy_parity))
+            self.db.insert("problem_option",("id", "name", "value"),(self.id,"explain_time",self.explain_time))
+            self.db.insert("problem_option",("id", "name", "value"),(self.id,"explain_rows",self.explain_rows))
+            self.db.insert("problem_option",("id", "name", "value"),(self.id,"explain_sample",self.explain_sample))
+            self.db.insert("problem_option",("id", "name", "value"),(self.id,"budget",json.dumps(self.budget) if self.budget else None))
+            self.db.insert("problem_option",("id", "name", "value"),(self.id,"attempt",self.attempt))
+            self.db.insert("problem_option",("id", "name", "value"),(self.id,"subtree_cache",json.dumps(self.subtree_cache) if self.subtree_cache else None))
+            self.db.insert("problem_option",("id", "name", "value"),(self.id,"incremental_from",self.incremental_from))
+            self.db.insert("problem_option",("id", "name", "value"),(self.id,"witness",self.witness))
+            self.db.insert("problem_option",("id", "name", "value"),(self.id,"enumerate",self.enumerate))
+            self.db.insert("problem_option",("id", "name", "value"),(self.id,"backends",len(self.pools)))
+            self.db.insert("problem_option",("id", "name", "value"),(self.id,"sql_cache",self.sql_cache.path))
             for k, v in self.kwargs.items():
                 if v:
                     self.db.ignore_next_praefix()
                     self.db.insert("problem_option",("id", "name", "value"),(self.id,k,v))
 
+            # tables that are incomplete or emptied after a crash (unlogged) must not be reused by --incremental-from
+            reusable = self.complete_node_tables() and self.node_persistence == "logged"
             for n in self.td.nodes:
-                self.db.insert("td_node_status", ["node"],[n.id])
+                self.db.insert("td_node_status", ["node","filter_hash","origin","num_constraints"],
+                    [n.id,self.filter_hash(n) if reusable else None,self.incremental.origin.get(n.id) if self.incremental else None,self.node_constraints(n)])
+                if self.node_backend.get(n.id, 0):
+                    backend_db(self.node_backend[n.id]).insert("td_node_status", ["node"],[n.id])
                 for v in n.vertices:
                     self.db.insert("td_bag",("bag","node"), (n.id,v))
             for edge in self.td.edges:
                 self.db.insert("td_edge",("node","parent"),(edge[1],edge[0]))
 
-        create_base_tables()
+        def create_plan_table():
+            self.db.create_table("td_node_plan", [
+                ("node", "INTEGER NOT NULL"),
+                ("captured", "TIMESTAMP DEFAULT statement_timestamp()"),
+                ("exec_time", "DOUBLE PRECISION"),
+                ("rows", "BIGINT"),
+                ("plan", "JSON")
+            ])
+
+        def upload_node_sql():
+            logger.debug("Uploading node statements")
+            self.db.ignore_next_praefix()
+            self.db.create_procedure(SOLVE_PART_PROCEDURE, [
+                ("praefix", "TEXT"),
+                ("part", "INTEGER"),
+                ("track_status", "BOOLEAN")
+            ], SOLVE_PART_BODY)
+            self.db.drop_table("td_node_sql")
+            self.db.create_table("td_node_sql", [
+                ("pos", "INTEGER NOT NULL PRIMARY KEY"),
+                ("part", "INTEGER NOT NULL"),
+                ("node", "INTEGER NOT NULL"),
+                ("stmt", "TEXT NOT NULL")
+            ])
+            pos = 0
+            for part, nodes in enumerate(self.td.partition(self.procedure_parts)):
+                for n in nodes:
+                    for stmt in self.node_statements(n, self.db):
+                        self.db.insert("td_node_sql",("pos","part","node","stmt"),(pos,part,n.id,stmt))
+                        pos += 1
+                    if self.candidate_store == "auto" and ("faster" not in self.kwargs or not self.kwargs["faster"]):
+                        plan = self.node_plans[n.id]
+                        self.db.update("td_node_status",["est_rows","candidate_store","work_mem"],
+                            [str(plan["est_rows"]),"'{}'".format(plan["candidate_store"]),str(plan["work_mem"])],[f"node = {n.id}"])
+
+        create_base_tables(self.db)
         init_problem()
+        if len(self.pools) > 1:
+            if self.execution_mode != "worker":
+                raise ValueError("Multiple backends require --execution-mode worker")
+            self.place_nodes()
         self.db.ignore_next_praefix()
         self.db.update("problem",["setup_start_time"],["statement_timestamp()"],[f"ID = {self.id}"])
+        if self.incremental_from:
+            self.setup_incremental()
+        self.sql_cache.load()
         if "faster" not in self.kwargs or not self.kwargs["faster"]:
             drop_tables()
             create_tables()
             insert_data()
+        if self.execution_mode == "procedure":
+            upload_node_sql()
+        if self.explain_time or self.explain_rows or self.explain_sample:
+            if self.execution_mode == "procedure":
+                logger.warning("Plans are not captured with --execution-mode procedure")
+            create_plan_table()
+        if self.subtree_cache:
+            self.setup_cache()
 
         self.setup_extra()
+        self.sql_cache.save()
 
         self.db.commit()
+        for b, db in backend_dbs.items():
+            if b:
+                db.commit()
+                db.close()
+
+    # links the tables of unchanged nodes, the others are solved
+    def setup_incremental(self):
+        if self.execution_mode != "worker" or len(self.pools) > 1:
+            raise ValueError("--incremental-from requires --execution-mode worker and a single backend")
+        self.incremental = Incremental(self, self.incremental_from)
+        self.incremental.plan(self.db)
+        self.incremental.link(self.db)
+
+    def setup_cache(self):
+        if self.execution_mode != "worker" or len(self.pools) > 1 or self.limit_result_rows or self.randomize_rows:
+            logger.warning("The subtree cache requires --execution-mode worker, a single backend and unlimited result rows")
+            return
+        if self.incremental:
+            logger.warning("The subtree cache is not used with --incremental-from")
+            return
+        cache = SubtreeCache(self, **self.subtree_cache)
+        if not cache.hash_nodes():
+            logger.warning("%s does not support the subtree cache", self.type)
+            return
+        cache.plan(self.db)
+        self.cache = cache
+        if "faster" not in self.kwargs or not self.kwargs["faster"]:
+            # skipped nodes have no table to reuse with --incremental-from
+            for node_id in cache.skipped:
+                self.db.update("td_node_status", ["filter_hash"], ["null"], [f"node = {node_id}"])
 
     def store_cfg(self,cfg):
         for k, v in cfg.items():
@@ -331,22 +932,50 @@ class Problem(object):
                 self.db.ignore_next_praefix()
                 self.db.insert("problem_option",("id", "type", "name", "value"),(self.id,"cfg",k,v))
 
-    def solve(self):
+    # executor: shared ThreadPoolExecutor to run the node workers in (e.g. for batch mode)
+    def solve(self, executor = None):
         self.db.ignore_next_praefix()
         self.db.update("problem",["calc_start_time"],["statement_timestamp()"],[f"ID = {self.id}"])
         self.db.commit()
 
         self.before_solve()
 
-        workers = {}
-
-        with ThreadPoolExecutor(self.max_worker_threads) as executor:
-            for n in self.td.nodes:
-                e = executor.submit(self.node_worker,n,workers)
-                workers[n.id] = e
-
-        self.after_solve()
+        if self.execution_mode == "procedure":
+            if self.budget:
+                logger.warning("Budgets are not enforced with --execution-mode procedure")
+            self.solve_procedure()
+        elif self.execution_mode == "numpy":
+            if self.budget:
+                logger.warning("Budgets are not enforced with --execution-mode numpy")
+            numpy_result = self.solve_numpy(executor)
+        elif self.execution_mode == "process":
+            if self.budget:
+                logger.warning("Budgets are not enforced with --execution-mode process")
+            ProcessEngine(self, self.processes).solve(executor)
+        else:
+            self.solve_workers(executor)
 
+        if self.budget_exceeded:
+            self.db.ignore_next_praefix()
+            self.db.insert("problem_option",("id", "name", "value"),(self.id,"budget_exceeded",self.budget_exceeded[:255]))
+            self.db.commit()
+        if self.interrupted:
+            self.drop_node_tables()
+        else:
+            if len(self.pools) > 1 and ("faster" not in self.kwargs or not self.kwargs["faster"]):
+                self.collect_status()
+            if self.cache:
+                self.cache.evict(self.db)
+            self.after_solve()
+            if self.witness:
+                self.write_solutions()
+            if self.execution_mode == "numpy" and self.numpy_parity:
+                if numpy_result == self.result:
+                    logger.info("Results of numpy and worker threads agree: %s", self.result)
+                else:
+                    logger.error("Results differ: numpy %s, worker threads %s", numpy_result, self.result)
+
+        self.sql_cache.save()
         self.db.ignore_next_praefix()
         self.db.update("problem",["end_time"],["statement_timestamp()"],[f"ID = {self.id}"])
         self.db.commit()
@@ -356,55 +985,423 @@ class Problem(object):
             logger.info("Setup time: %s; Calc time: %s", elapsed[1], elapsed[0])
         self.db.close()
 
+    # whether every node solved by this problem fills its complete table in the first database
+    def complete_node_tables(self):
+        return not ((self.execution_mode == "numpy" and not self.numpy_parity) or len(self.pools) > 1 or self.limit_result_rows)
+
+    # whether the complete tables of all nodes are in the first database (required by top-down passes)
+    def all_node_tables(self):
+        return self.complete_node_tables() and not ((self.cache and self.cache.skipped) or (self.incremental and self.incremental.reused))
+
+    # candidates of node (values of all its vertices) agreeing with values of its stored vertices
+    def witness_select(self, node, values, limit = None):
+        where = self.filter(node)
+        cond = [var2col(v) if values[v] else f"NOT {var2col(v)}" for v in node.stored_vertices if v in values]
+        if cond:
+            where += "{} {}".format(" AND" if where else "WHERE", " AND ".join(cond))
+        q = "SELECT {} FROM ({}) AS candidate {}".format(",".join([var2col(v) for v in node.vertices]) or "1",
+            self.candidates_select(node, reduce=False), where)
+        if self.witness_order(node):
+            q += " ORDER BY {}".format(",".join(self.witness_order(node)))
+        if limit:
+            q += f" LIMIT {limit}"
+        return self.db.replace_dynamic_tabs(q)
+
+    # values of all vertices of one (best) solution, reconstructed top down, None if there is none
+    def solution(self):
+        values = {}
+        # parents are visited before their children
+        for node in reversed(self.td.nodes):
+            row = self.db.exec_and_fetch(sql.SQL(self.witness_select(node, values, 1)))
+            if row is None:
+                return None
+            values.update(zip(node.vertices, row))
+        return values
+
+    # lazily enumerates the values of all vertices of all solutions
+    # each node streams its candidates for the values chosen by its ancestors, siblings are combined by nested loops
+    def solutions(self):
+        def subtree(node, values):
+            for row in self.db.stream(sql.SQL(self.witness_select(node, values))):
+                own = {v: val for v, val in zip(node.vertices, row) if v not in values}
+                yield from children(node.children, {**values, **own}, own)
+
+        def children(nodes, values, found):
+            if not nodes:
+                yield found
+                return
+            for sub in subtree(nodes[0], values):
+                yield from children(nodes[1:], values, {**found, **sub})
+
+        yield from subtree(self.td.root, {})
+
+    def write_solutions(self):
+        if not self.all_node_tables():
+            logger.warning("Witnesses require the complete tables of all nodes in a single database")
+            return
+        if self.enumerate is not None and self.witness_order(self.td.root):
+            logger.warning("%s only writes a single witness, --enumerate is ignored", self.type)
+        with open(self.witness, "w") as f:
+            if self.enumerate is None or self.witness_order(self.td.root):
+                solution = self.solution()
+                solutions = [solution] if solution is not None else []
+            else:
+                solutions = itertools.islice(self.solutions(), self.enumerate or None)
+            cnt = 0
+            for values in solutions:
+                f.write(" ".join([str(v) if values[v] else str(-v) for v in sorted(values)]) + " 0\n")
+                cnt += 1
+        self.db.commit()
+        logger.info("Wrote %d solutions to %s", cnt, self.witness)
+
+    def solve_workers(self, executor = None):
+        workers = {}
+        if self.budget:
+            stop_watchdog = threading.Event()
+            watchdog = threading.Thread(target=self.watchdog, args=(stop_watchdog,), name="budget-watchdog", daemon=True)
+            watchdog.start()
+
+        # nodes are submitted in postorder, children are therefore always started before their parents
+        # this also holds for executors shared by several problems as long as they are FIFO
+        # with a cost model children with longer predicted critical paths are submitted first
+        nodes = schedule(self.td, self.predictions) if self.predictions else self.td.nodes
+        with nullcontext(executor) if executor else ThreadPoolExecutor(self.max_worker_threads) as ex:
+            for n in nodes:
+                e = ex.submit(self.node_worker,n,workers)
+                workers[n.id] = e
+        for w in workers.values():
+            w.result()
+
+        if self.budget:
+            stop_watchdog.set()
+            watchdog.join()
+
+    # solves in memory and stores the root table for after_solve
+    # with --numpy-parity the node tables are computed by the worker threads instead
+    # returns the result computed by numpy
+    def solve_numpy(self, executor = None):
+        root = NumpyEngine(self).solve()
+        if root is None:
+            return None
+        result = self.np_result(root)
+        if self.numpy_parity:
+            self.solve_workers(executor)
+            return result
+
+        node = self.td.root
+        extra = self.td_node_extra_columns()
+        if "faster" in self.kwargs and self.kwargs["faster"]:
+            self.db.create_table(f"td_node_{node.id}", [self.td_node_column_def(v) for v in node.vertices] + extra)
+        bits = [root.bit(v).tolist() for v in node.stored_vertices]
+        cols = [root.cols[c].tolist() for c, _ in extra]
+        rows = [list(r) for r in zip(*(bits + cols))]
+        if rows:
+            self.db.insert_many(f"td_node_{node.id}", [var2col(v) for v in node.stored_vertices] + [c for c, _ in extra], rows)
+        self.db.commit()
+        return result
+
     def interrupt(self):
         self.interrupted = True
 
+    # stops solving because the budget is exceeded
+    def abort(self, reason):
+        with self._active_lock:
+            if self.budget_exceeded:
+                return
+            self.budget_exceeded = reason
+        logger.warning("Budget exceeded (%s), aborting", reason)
+        self.cancel()
+
+    # interrupts solving and cancels the statements of all nodes currently being solved
+    def cancel(self):
+        self.interrupt()
+        with self._active_lock:
+            active = list(self._active.values())
+        for db, _ in active:
+            db.cancel()
+        for proc in self.worker_processes:
+            proc.terminate()
+
+    # called in the worker thread whose node failed
+    def worker_error(self, e):
+        logger.exception("Error in worker thread")
+        self.error = e
+        if self.cancel_on_error:
+            self.cancel()
+        else:
+            os.kill(os.getpid(), signal.SIGUSR1)
+
+    def check_budget(self, node):
+        b = self.budget
+        rows = self.node_rows.get(node.id) or 0
+        num_bytes = self.node_bytes.get(node.id) or 0
+        if "node_rows" in b and rows > b["node_rows"]:
+            self.abort(f"node {node.id}: {rows} rows > {b['node_rows']}")
+        elif "total_rows" in b and sum(r or 0 for r in self.node_rows.values()) > b["total_rows"]:
+            self.abort(f"total rows > {b['total_rows']}")
+        elif "node_bytes" in b and num_bytes > b["node_bytes"]:
+            self.abort(f"node {node.id}: {num_bytes} bytes > {b['node_bytes']}")
+        elif "total_bytes" in b and sum(self.node_bytes.values()) > b["total_bytes"]:
+            self.abort(f"total bytes > {b['total_bytes']}")
+
+    # checks time and size of running nodes, finished nodes are checked by check_budget
+    def watchdog(self, stop):
+        # own connections for the sizes (to the backend of each node), self.db is not thread safe
+        dbs = {}
+        try:
+            self.watch(stop, dbs)
+        finally:
+            for db in dbs.values():
+                db.close()
+
+    def watch(self, stop, dbs):
+        b = self.budget
+        sizes = "node_bytes" in b or "total_bytes" in b
+        start = time.time()
+        while not stop.wait(b.get("check_interval", 1)) and not self.interrupted:
+            now = time.time()
+            with self._active_lock:
+                active = dict(self._active)
+            if "total_seconds" in b and now - start > b["total_seconds"]:
+                self.abort(f"total time {now - start:.1f}s > {b['total_seconds']}s")
+                return
+            total_bytes = sum(self.node_bytes.values())
+            for node_id, (_, node_start) in active.items():
+                if "node_seconds" in b and now - node_start > b["node_seconds"]:
+                    self.abort(f"node {node_id}: {now - node_start:.1f}s > {b['node_seconds']}s")
+                    return
+                if sizes:
+                    backend = self.node_backend.get(node_id, 0)
+                    if backend not in dbs:
+                        dbs[backend] = DB.from_pool(self.pools[backend])
+                        dbs[backend].set_praefix(f"p{self.id}_")
+                    num_bytes = dbs[backend].relation_size(f"td_node_{node_id}")
+                    total_bytes += num_bytes
+                    if "node_bytes" in b and num_bytes > b["node_bytes"]:
+                        self.abort(f"node {node_id}: {num_bytes} bytes > {b['node_bytes']}")
+                        return
+            for db in dbs.values():
+                db.commit()
+            if "total_bytes" in b and total_bytes > b["total_bytes"]:
+                self.abort(f"total bytes > {b['total_bytes']}")
+
+    # removes all tables of this run, the problem and its options are kept
+    def drop_node_tables(self):
+        logger.info("Dropping tables of problem %d", self.id)
+        for pool in self.pools:
+            db = self.db if pool is self.pool else DB.from_pool(pool)
+            for tab in db.table_names(f"p{self.id}\\_%"):
+                db.ignore_next_praefix()
+                db.drop_table(tab, cascade=True)
+            if db is not self.db:
+                db.close()
+
+    # copies the status of nodes solved on other backends to the first one
+    def collect_status(self):
+        for backend in set(self.node_backend.values()) - set([0]):
+            db = DB.from_pool(self.pools[backend])
+            db.set_praefix(f"p{self.id}_")
+            for node, start, end, rows in db.select_all("td_node_status", ["node", "start_time", "end_time", "rows"]):
+                self.db.update("td_node_status", ["start_time", "end_time", "rows"],
+                    ["'{}'".format(start) if start else "null", "'{}'".format(end) if end else "null", str(rows) if rows is not None else "null"],
+                    [f"node = {node}"])
+            db.close()
+        self.db.commit()
+
+    def trace(self, name, cat, **args):
+        if self.tracer:
+            return self.tracer.span(name, cat, **args)
+        return nullcontext(args)
+
     def node_worker(self, node, workers):
+        db = None
         try:
-            for c in node.children:
-                if not self.interrupted:
-                    logger.debug("Node %d waiting for %d", node.id,c.id)
-                    workers[c.id].result()
+            if self.is_reused(node) or (self.cache and node.id in self.cache.skipped):
+                if self.progress:
+                    self.progress.node_finished(node, 0, 0)
+                return node
+
+            # a subtree copied from an isomorphic one waits for it instead of its children
+            deps = node.children
+            if self.cache and self.cache.source(node):
+                deps = [self.cache.source(node)]
+            with self.trace("wait children", "wait", node=node.id, children=len(node.children)):
+                for c in deps:
+                    if not self.interrupted:
+                        logger.debug("Node %d waiting for %d", node.id,c.id)
+                        workers[c.id].result()
 
             if self.interrupted:
                 logger.info("Node %d interrupted", node.id)
                 return node
 
-            db = DB.from_pool(self.pool)
+            with self.trace("wait connection", "wait", node=node.id):
+                db = DB.from_pool(self.pool_for(node))
             db.set_praefix(f"p{self.id}_")
+            db.set_node(node.id)
             logger.debug("Creating records for node %d", node.id)
-            self.solve_node(node,db)
+            if self.progress:
+                self.progress.node_started(node)
+            with self._active_lock:
+                self._active[node.id] = (db, time.time())
+            try:
+                with self.trace(f"node {node.id}", "sql", node=node.id, bag_size=len(node.vertices)) as span:
+                    if self.cache and self.cache.reused(node):
+                        self.cache.copy(node, db)
+                    else:
+                        self.solve_node(node,db)
+                        if self.cache and not self.interrupted:
+                            self.cache.store(node, db)
+                    span["rows"] = self.node_rows.get(node.id)
+            finally:
+                with self._active_lock:
+                    del self._active[node.id]
+            if self.is_shipped(node) and not self.interrupted:
+                with self.trace("copy", "copy", node=node.id, rows=self.node_rows.get(node.id)):
+                    self.ship(node, db)
+            if (self.progress or self.budget) and not self.interrupted:
+                self.node_bytes[node.id] = db.relation_size(f"td_node_{node.id}")
+                if self.progress:
+                    self.progress.node_finished(node, self.node_rows.get(node.id), self.node_bytes[node.id])
+                if self.budget:
+                    self.check_budget(node)
             db.close()
             if not self.interrupted:
                 logger.debug("Node %d finished", node.id)
             return node
-        except Exception:
-            logger.exception("Error in worker thread")
-            os.kill(os.getpid(), signal.SIGUSR1)
+        except Exception as e:
+            if isinstance(e, QueryCanceled) and self.interrupted:
+                logger.info("Node %d cancelled", node.id)
+            else:
+                self.worker_error(e)
+            if db:
+                db.rollback()
+                db.close()
+            return node
+
+    def solve_procedure(self):
+        if type(self).before_solve_node is not Problem.before_solve_node or \
+                type(self).after_solve_node is not Problem.after_solve_node:
+            logger.warning("Node hooks are not called with --execution-mode procedure")
+
+        track_status = "faster" not in self.kwargs or not self.kwargs["faster"]
+
+        def call_part(part):
+            with self.trace("wait connection", "wait", part=part):
+                db = DB.from_pool(self.pool)
+            # the procedure commits after each node, this is not allowed inside a transaction block
+            db.set_autocommit(True)
+            logger.debug("Calling procedure for part %d", part)
+            with self.trace(f"part {part}", "sql", part=part, nodes=len(parts[part])):
+                db.call(SOLVE_PART_PROCEDURE, [f"p{self.id}_", part, track_status])
+            db.close()
+            logger.debug("Part %d finished", part)
+
+        parts = self.td.partition(self.procedure_parts)
+        # part 0 contains the top of the tree and depends on all other parts
+        if len(parts) > 1:
+            with ThreadPoolExecutor(len(parts) - 1) as executor:
+                for f in [executor.submit(call_part, p) for p in range(1, len(parts))]:
+                    f.result()
+        if parts[0] and not self.interrupted:
+            call_part(0)
+
+    def node_select(self, node):
+        select = f"SELECT * from td_node_{node.id}_v"
+        if self.randomize_rows:
+            select += " ORDER BY RANDOM()"
+        if self.limit_result_rows and (node.stored_vertices or self.group_extra_cols(node)):
+            select += f" LIMIT {self.limit_result_rows}"
+        return select
+
+    # statements solving a single node, used by --execution-mode procedure
+    def node_statements(self, node, db):
+        stmts = []
+        if self.candidate_store == "auto":
+            plan = self.node_plans[node.id] if node.id in self.node_plans else self.plan_node(node)
+            stmts.append(f"SET LOCAL work_mem = '{plan['work_mem']}kB'")
+            stmts.append(f"SET LOCAL max_parallel_workers_per_gather = {plan['parallel_workers']}")
+        if self.node_candidate_store(node) == "table":
+            if "faster" in self.kwargs and self.kwargs["faster"]:
+                stmts.append(db.create_select_text(f"td_node_{node.id}_candidate", self.node_sql(node, "candidates", db),
+                    **self.node_table_options(node, True)))
+            else:
+                stmts.append(db.replace_dynamic_tabs(f"INSERT INTO td_node_{node.id}_candidate SELECT * FROM td_node_{node.id}_candidate_v"))
+        if "faster" in self.kwargs and self.kwargs["faster"]:
+            stmts.append(db.create_select_text(f"td_node_{node.id}", self.node_sql(node, "assignment", db),
+                **self.node_table_options(node)))
+        else:
+            stmts.append(db.replace_dynamic_tabs(f"INSERT INTO td_node_{node.id} {self.node_select(node)}"))
+        return stmts
+
+    # returns whether the node is run under EXPLAIN ANALYZE and whether its plan is kept regardless of thresholds
+    def explain_node(self, node):
+        if self.explain_sample and random.random() < self.explain_sample:
+            return True, True
+        return bool(self.explain_time or self.explain_rows), False
+
+    def store_plan(self, node, plan, keep, db):
+        exec_time = plan[0]["Execution Time"]
+        rows = db.last_rowcount
+        if keep or (self.explain_time and exec_time >= self.explain_time * 1000) or \
+                (self.explain_rows and rows >= self.explain_rows):
+            logger.debug("Storing plan of node %d (%.1fms, %d rows)", node.id, exec_time, rows)
+            db.insert("td_node_plan",("node","exec_time","rows","plan"),(node.id,exec_time,rows,json.dumps(plan)))
+            db.last_rowcount = rows
 
     def solve_node(self, node, db):
-        if "faster" not in self.kwargs or not self.kwargs["faster"]:
-            db.update("td_node_status",["start_time"],["statement_timestamp()"],[f"node = {node.id}"])
+        faster = "faster" in self.kwargs and self.kwargs["faster"]
+        auto = self.candidate_store == "auto"
+        if auto:
+            setup_store = self.node_candidate_store(node)
+            node_plan = self.plan_node(node)
+
+        if not faster:
+            columns = ["start_time"]
+            values = ["statement_timestamp()"]
+            if auto:
+                columns += ["est_rows","candidate_store","work_mem"]
+                values += [str(node_plan["est_rows"]),"'{}'".format(node_plan["candidate_store"]),str(node_plan["work_mem"])]
+            db.update("td_node_status",columns,values,[f"node = {node.id}"])
             db.commit()
 
         self.before_solve_node(node, db)
-        if self.candidate_store == "table":
-            db.persist_view(f"td_node_{node.id}_candidate")
-        if "faster" in self.kwargs and self.kwargs["faster"]:
-            ass_view = self.assignment_view(node)
-            ass_view = self.db.replace_dynamic_tabs(ass_view)
-            db.create_select(f"td_node_{node.id}", ass_view)
+        candidate_store = self.node_candidate_store(node)
+        if (self.reduce_join(node) or auto) and not faster:
+            # views were created before sizes of the children were known
+            if candidate_store == "table":
+                if auto and setup_store != "table":
+                    db.create_table(f"td_node_{node.id}_candidate", [self.td_node_column_def(c) for c in node.vertices] + self.td_node_extra_columns(),
+                        **self.node_table_options(node, True))
+                db.create_view(f"td_node_{node.id}_candidate_v", self.node_sql(node, "candidates", db), True)
+            db.create_view(f"td_node_{node.id}_v", self.node_sql(node, "assignment", db), True)
+        # SET LOCAL only lasts until the next commit, which create_select does (DDL)
+        def settings():
+            if auto:
+                db.set_local("work_mem", "{}kB".format(node_plan["work_mem"]))
+                db.set_local("max_parallel_workers_per_gather", node_plan["parallel_workers"])
+        if candidate_store == "table":
+            settings()
+            if faster:
+                db.create_select(f"td_node_{node.id}_candidate", self.node_sql(node, "candidates", db),
+                    **self.node_table_options(node, True))
+            else:
+                db.persist_view(f"td_node_{node.id}_candidate")
+        explain, keep_plan = self.explain_node(node)
+        if faster or candidate_store != "table":
+            settings()
+        if faster:
+            explain_plan = db.create_select(f"td_node_{node.id}", self.node_sql(node, "assignment", db), explain=explain, **self.node_table_options(node))
         else:
-            select = f"SELECT * from td_node_{node.id}_v"
-            if self.randomize_rows:
-                select += " ORDER BY RANDOM()"
-            if self.limit_result_rows and (node.stored_vertices or self.group_extra_cols(node)):
-                select += f" LIMIT {self.limit_result_rows}"
-            db.insert_select(f"td_node_{node.id}", db.replace_dynamic_tabs(select))
+            explain_plan = db.insert_select(f"td_node_{node.id}", db.replace_dynamic_tabs(self.node_select(node)), explain=explain)
+        self.sql_cache.release(node)
         if self.interrupted:
             return
+        if explain_plan:
+            self.store_plan(node, explain_plan, keep_plan, db)
+        self.node_rows[node.id] = db.last_rowcount
         self.after_solve_node(node, db)
-        if "faster" not in self.kwargs or not self.kwargs["faster"]:
+        if not faster:
             row_cnt = db.last_rowcount
             db.update("td_node_status",["end_time","rows"],["statement_timestamp()",str(row_cnt)],[f"node = {node.id}"])
         db.commit()
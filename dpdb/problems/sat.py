@@ -20,6 +20,24 @@ class Sat(Problem):
     def filter(self,node):
         return filter(self.var_clause_dict, node)
 
+    def filter_vertices(self,node):
+        return filter_vertices(self.var_clause_dict, node)
+
+    def introduce_filter(self,node):
+        return filter(self.var_clause_dict, node, [v for v in node.vertices if node.needs_introduce(v)])
+
+    def node_constraints(self, node):
+        return len(node_clauses(self.var_clause_dict, node))
+
+    def cache_key(self, node, label):
+        return cache_key(self.var_clause_dict, node, label)
+
+    def np_filter(self, node, candidates, vertices):
+        return np_filter(self.var_clause_dict, node, candidates, vertices)
+
+    def np_result(self, table):
+        return len(table) > 0
+
     def setup_extra(self):
         def create_tables():
             self.db.ignore_next_praefix()
@@ -58,6 +76,7 @@ class Sat(Problem):
         self.db.ignore_next_praefix()
         sat = self.db.update("problem_sat",["is_sat"],[is_sat],[f"ID = {self.id}"],"is_sat")[0]
         logger.info("Problem is %s", "SAT" if sat else "UNSAT")
+        self.result = sat
 
 args.specific[Sat] = dict(
     help="Solve SAT instances",
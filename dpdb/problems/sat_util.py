@@ -1,12 +1,15 @@
 # -*- coding: future_fstrings -*-
 from dpdb.problem import *
+from dpdb.numpy_engine import clause_filter
 from collections import defaultdict
 
 class hashabledict(dict):
     def __hash__(self):
         return hash(frozenset(self))
 
-def cnf2primal (num_vars, clauses, var_clause_dict = defaultdict(set)):
+def cnf2primal (num_vars, clauses, var_clause_dict = None):
+    if var_clause_dict is None:
+        var_clause_dict = defaultdict(set)
     edges = set([])
     for clause in clauses:
         atoms = [abs(lit) for lit in clause]
@@ -33,15 +36,25 @@ def lit2expr (lit):
     else:
         return "NOT {}".format(lit2var(lit))
 
-def filter(clauses, node):
-    vertice_set = set(node.vertices)
+# vertices: restrict to clauses over these vertices only (default: all vertices of node)
+def node_clauses(clauses, node, vertices=None):
+    if vertices is None:
+        vertices = node.vertices
+    vertice_set = set(vertices)
     cur_cl = set()
-    for v in node.vertices:
+    for v in vertices:
         candidates = clauses[v]
         for d in candidates:
             for key, val in d.items():
                 if key.issubset(vertice_set):
                     cur_cl.add(val)
+    return cur_cl
+
+def filter_vertices(clauses, node):
+    return set(abs(lit) for clause in node_clauses(clauses, node) for lit in clause)
+
+def filter(clauses, node, vertices=None):
+    cur_cl = node_clauses(clauses, node, vertices)
 
     if len(cur_cl) > 0:
         return "WHERE {0}".format(
@@ -51,6 +64,17 @@ def filter(clauses, node):
     else:
         return ""
 
+def np_filter(clauses, node, candidates, vertices):
+    cur_cl = node_clauses(clauses, node, vertices)
+    if cur_cl:
+        return clause_filter(candidates, cur_cl)
+    return None
+
+# clauses checked in node, variables renamed by label (see Problem.cache_key)
+def cache_key(clauses, node, label):
+    return tuple(sorted(tuple(sorted((label[abs(lit)] + 1) * (1 if lit > 0 else -1) for lit in clause))
+        for clause in node_clauses(clauses, node)))
+
 def store_clause_table(db, clauses):
     db.drop_table("sat_clause")
     num_vars = len(clauses)
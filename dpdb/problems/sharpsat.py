@@ -4,15 +4,19 @@ from collections import defaultdict
 
 from dpdb.reader import CnfReader
 from dpdb.problem import *
+from dpdb.numpy_engine import np, group_sum
 from .sat_util import *
 
 logger = logging.getLogger(__name__)
 
 class SharpSat(Problem):
 
-    def __init__(self, name, pool, store_formula=False, **kwargs):
+    def __init__(self, name, pool, store_formula=False, numpy_counts="object", marginals=False, cubes=None, **kwargs):
         super().__init__(name, pool, **kwargs)
         self.store_formula = store_formula
+        self.numpy_counts = numpy_counts
+        self.marginals = marginals
+        self.cubes = cubes
 
     def td_node_column_def(self,var):
         return td_node_column_def(var)
@@ -22,8 +26,8 @@ class SharpSat(Problem):
         
     def candidate_extra_cols(self,node):
         return ["{} AS model_count".format(
-                " * ".join(set([var2cnt(node,v) for v in node.vertices] +
-                               [node2cnt(n) for n in node.children])) if node.vertices or node.children else "1"
+                " * ".join(sorted(set([var2cnt(node,v) for v in node.vertices] +
+                                      [node2cnt(n) for n in node.children]))) if node.vertices or node.children else "1"
                 )]
 
     def assignment_extra_cols(self,node):
@@ -32,6 +36,33 @@ class SharpSat(Problem):
     def filter(self,node):
         return filter(self.var_clause_dict, node)
 
+    def filter_vertices(self,node):
+        return filter_vertices(self.var_clause_dict, node)
+
+    def introduce_filter(self,node):
+        return filter(self.var_clause_dict, node, [v for v in node.vertices if node.needs_introduce(v)])
+
+    def node_constraints(self, node):
+        return len(node_clauses(self.var_clause_dict, node))
+
+    def cache_key(self, node, label):
+        return cache_key(self.var_clause_dict, node, label)
+
+    def np_filter(self, node, candidates, vertices):
+        return np_filter(self.var_clause_dict, node, candidates, vertices)
+
+    def np_candidate_cols(self, node, candidates):
+        count = np.ones(len(candidates), dtype=object if self.numpy_counts == "object" else np.int64)
+        for c in node.children:
+            count = count * candidates.child_col(c, "model_count")
+        return {"model_count": count}
+
+    def np_aggregate(self, node, cols, groups, num_groups):
+        return {"model_count": group_sum(cols["model_count"], groups, num_groups)}
+
+    def np_result(self, table):
+        return int(table.cols["model_count"].sum())
+
     def prepare_input(self, fname):
         input = CnfReader.from_file(fname)
         self.num_vars = input.num_vars
@@ -50,6 +81,13 @@ class SharpSat(Problem):
                 ("num_clauses", "INTEGER NOT NULL"),
                 ("model_count", "NUMERIC")
             ])
+            if self.marginals or self.cubes:
+                self.db.ignore_next_praefix()
+                self.db.create_table("sharpsat_marginals", [
+                    ("id", "INTEGER NOT NULL REFERENCES PROBLEM(id)"),
+                    ("query", "TEXT NOT NULL"),
+                    ("model_count", "NUMERIC")
+                ])
 
         def insert_data():
             self.db.ignore_next_praefix()
@@ -58,6 +96,12 @@ class SharpSat(Problem):
             if "faster" not in self.kwargs or not self.kwargs["faster"]:
                 self.db.ignore_next_praefix()
                 self.db.insert("problem_option",("id", "name", "value"),(self.id,"store_formula",self.store_formula))
+                self.db.ignore_next_praefix()
+                self.db.insert("problem_option",("id", "name", "value"),(self.id,"numpy_counts",self.numpy_counts))
+                self.db.ignore_next_praefix()
+                self.db.insert("problem_option",("id", "name", "value"),(self.id,"marginals",self.marginals))
+                self.db.ignore_next_praefix()
+                self.db.insert("problem_option",("id", "name", "value"),(self.id,"cubes",self.cubes))
                 if self.store_formula:
                     store_clause_table(self.db, self.clauses)
 
@@ -69,7 +113,107 @@ class SharpSat(Problem):
         sum_count = self.db.replace_dynamic_tabs(f"(select coalesce(sum(model_count),0) from {root_tab})")
         self.db.ignore_next_praefix()
         model_count = self.db.update("problem_sharpsat",["model_count"],[sum_count],[f"ID = {self.id}"],"model_count")[0]
+        # SQLite turns integer products beyond 2^63 into REAL
+        if isinstance(model_count, float):
+            raise ValueError(f"Model count {model_count} is beyond the exact integers of {self.db.name}, use db.backend postgres")
         logger.info("Problem has %d models", model_count)
+        self.result = model_count
+        if self.marginals or self.cubes:
+            self.store_marginals()
+
+    def store_marginals(self):
+        if not self.all_node_tables():
+            logger.warning("Marginals and cubes require the complete tables of all nodes in a single database")
+            return
+        cubes = []
+        if self.marginals:
+            cubes += [[v] for v in sorted(set(v for n in self.td.nodes for v in n.vertices))]
+        if self.cubes:
+            cubes += read_cubes(self.cubes)
+        counts = self.count_cubes(cubes)
+        self.db.ignore_next_praefix()
+        self.db.insert_many("sharpsat_marginals", ("id", "query", "model_count"),
+            [(self.id, " ".join(map(str, c)), cnt) for c, cnt in zip(cubes, counts)])
+        self.db.commit()
+        logger.info("Counted %d of %d cubes", len([c for c in counts if c is not None]), len(cubes))
+
+    # model counts under each cube (list of literals) by a top-down pass over the node tables
+    # a cube is counted at the highest node containing all its variables, None if there is no such node
+    # td_node_{n}_outside: number of extensions of the assignments of n to the vertices outside its subtree
+    def count_cubes(self, cubes):
+        preorder = list(reversed(self.td.nodes))
+        nodes = {n.id: n for n in preorder}
+        nodes_with = defaultdict(list)
+        for n in preorder:
+            for v in n.vertices:
+                nodes_with[v].append(n)
+
+        counts = [None] * len(cubes)
+        queries = defaultdict(list)
+        for i, cube in enumerate(cubes):
+            vertices = set(abs(lit) for lit in cube)
+            if not vertices:
+                queries[self.td.root.id].append(i)
+                continue
+            for n in nodes_with[next(iter(vertices))]:
+                if vertices <= set(n.vertices):
+                    queries[n.id].append(i)
+                    break
+            else:
+                logger.warning("Cube %s is not contained in a bag", " ".join(map(str, cube)))
+
+        needed = set()
+        for node_id in queries:
+            n = nodes[node_id]
+            while n and n.id not in needed:
+                needed.add(n.id)
+                n = n.parent
+
+        for p in preorder:
+            if p.id not in needed:
+                continue
+            cols = self.candidate_extra_cols(p) + [f"{node2cnt(c)} AS count_{c.id}" for c in p.children]
+            candidates = f"SELECT * FROM ({self.candidates_select(p, cols, False)}) AS candidate {self.filter(p)}"
+            if p.is_root():
+                top = f"SELECT f.*, 1 AS outside FROM ({candidates}) f"
+            else:
+                top = "SELECT f.*, o.outside FROM ({}) f JOIN td_node_{}_outside o ON {}".format(candidates, p.id,
+                    " AND ".join([f"f.{var2col(v)} = o.{var2col(v)}" for v in p.stored_vertices]) or "TRUE")
+            self.db.drop_table(f"td_node_{p.id}_top")
+            self.db.create_select(f"td_node_{p.id}_top", self.db.replace_dynamic_tabs(top), **self.node_table_options(p, True))
+
+            if queries[p.id]:
+                sums = []
+                for i in queries[p.id]:
+                    cond = " AND ".join([var2col(lit) if lit > 0 else f"NOT {var2col(-lit)}" for lit in cubes[i]]) or "TRUE"
+                    sums.append(f"coalesce(sum(CASE WHEN {cond} THEN model_count * outside ELSE 0 END),0)")
+                for i, cnt in zip(queries[p.id], self.db.select(f"td_node_{p.id}_top", sums)):
+                    counts[i] = int(cnt)
+
+            for c in p.children:
+                if c.id not in needed:
+                    continue
+                others = " * ".join([f"count_{o.id}" for o in p.children if o is not c]) or "1"
+                stored = ",".join([var2col(v) for v in c.stored_vertices])
+                self.db.drop_table(f"td_node_{c.id}_outside")
+                outside = "SELECT {}sum(outside * {}) AS outside FROM td_node_{}_top{}".format(
+                    stored + "," if stored else "", others, p.id, f" GROUP BY {stored}" if stored else "")
+                self.db.create_select(f"td_node_{c.id}_outside", self.db.replace_dynamic_tabs(outside), **self.node_table_options(c, True))
+            self.db.drop_table(f"td_node_{p.id}_top")
+            self.db.drop_table(f"td_node_{p.id}_outside")
+            self.db.commit()
+        return counts
+
+# one cube per line, literals separated by whitespace and optionally terminated by 0
+def read_cubes(fname):
+    cubes = []
+    with open(fname) as f:
+        for line in f:
+            lits = line.split()
+            if not lits or lits[0] in ("c", "p"):
+                continue
+            cubes.append([int(lit) for lit in lits if lit != "0"])
+    return cubes
 
 def var2cnt(node,var):
     if node.needs_introduce(var):
@@ -88,6 +232,21 @@ args.specific[SharpSat] = dict(
             dest="store_formula",
             help="Store formula in database",
             action="store_true",
+        ),
+        "--numpy-counts": dict(
+            dest="numpy_counts",
+            help="Type of model counts with --execution-mode numpy (int64 is faster but overflows beyond 2^63)",
+            choices=["object","int64"],
+            default="object"
+        ),
+        "--marginals": dict(
+            dest="marginals",
+            help="Store the model count with each variable set to true in sharpsat_marginals",
+            action="store_true"
+        ),
+        "--cubes": dict(
+            dest="cubes",
+            help="File with one cube (literals) per line, store the model count under each cube in sharpsat_marginals"
         )
     }
 )
@@ -3,6 +3,7 @@ import logging
 
 from dpdb.reader import TdReader, TwReader, EdgeReader
 from dpdb.problem import *
+from dpdb.numpy_engine import np, group_min
 
 logger = logging.getLogger(__name__)
 
@@ -19,7 +20,7 @@ class VertexCover(Problem):
         return [("size","INTEGER")]
         
     def candidate_extra_cols(self,node):
-        introduce = [var2size(node,v) for v in node.vertices if node.needs_introduce(v)]
+        introduce = [var2size(node,v,self.packed_introduce(node)) for v in node.vertices if node.needs_introduce(v)]
         join = [node2size(n) for n in node.children]
 
         q = ""
@@ -33,7 +34,7 @@ class VertexCover(Problem):
                 children = [vc for c in node.children for vc in c.vertices if vc in node.vertices]
                 duplicates = ["case when {} then 1 else 0 end * {}".format(
                                     var2tab_col(node,var,False),len(node.vertex_children(var))-1) 
-                                for var in set(children) if len(node.vertex_children(var)) > 1]
+                                for var in sorted(set(children)) if len(node.vertex_children(var)) > 1]
 
                 if duplicates:
                     q += " - ({})".format(" + ".join(duplicates))
@@ -49,11 +50,60 @@ class VertexCover(Problem):
         return ["min(size) AS size"]
 
     def filter(self, node):
+        return self.edge_filter(node.vertices)
+
+    def witness_order(self, node):
+        return ["size"]
+
+    def filter_vertices(self, node):
+        return set(c for c in node.vertices for v in self.edges[c] if v in node.vertices)
+
+    def introduce_filter(self, node):
+        return self.edge_filter([v for v in node.vertices if node.needs_introduce(v)])
+
+    def node_constraints(self, node):
+        return len(set(frozenset((c, v)) for c in node.vertices for v in self.edges[c] if v in node.vertices))
+
+    def cache_key(self, node, label):
+        return tuple(sorted(set((min(label[c], label[v]), max(label[c], label[v]))
+            for c in node.vertices for v in self.edges[c] if v in node.vertices)))
+
+    def np_filter(self, node, candidates, vertices):
+        vertices = set(vertices)
+        keep = None
+        for c, v in set((min(c, v), max(c, v)) for c in vertices for v in self.edges[c] if v in vertices):
+            covered = candidates.bit(c) | candidates.bit(v)
+            keep = covered if keep is None else keep & covered
+        return keep
+
+    def np_candidate_cols(self, node, candidates):
+        size = np.zeros(len(candidates), dtype=np.int64)
+        for v in node.vertices:
+            if node.needs_introduce(v):
+                size += candidates.bit(v)
+            elif len(node.vertex_children(v)) > 1:
+                size -= candidates.bit(v) * (len(node.vertex_children(v)) - 1)
+        for c in node.children:
+            size += candidates.child_col(c, "size")
+        return {"size": size}
+
+    def np_aggregate(self, node, cols, groups, num_groups):
+        return {"size": group_min(cols["size"], groups, num_groups)}
+
+    def np_result(self, table):
+        return int(table.cols["size"].min()) if len(table) else 0
+
+    def edge_filter(self, vertices):
         check = []
 
         nv = []
-        for c in node.vertices:
-            [nv.append((c,v)) for v in self.edges[c] if v in node.vertices and (v,c) not in nv]
+        seen = set()
+        in_bag = set(vertices)
+        for c in vertices:
+            for v in self.edges[c]:
+                if v in in_bag and (v,c) not in seen:
+                    nv.append((c,v))
+                    seen.add((c,v))
 
         for edge in nv:
             check.append(" OR ".join(map(var2col, edge)))
@@ -96,10 +146,11 @@ class VertexCover(Problem):
         self.db.ignore_next_praefix()
         size = self.db.update("problem_vertexcover",["size"],[size_sql],[f"ID = {self.id}"],"size")[0]
         logger.info("Min vertex cover size: %d", size)
+        self.result = size
 
-def var2size(node,var):
+def var2size(node,var,packed=False):
     if node.needs_introduce(var):
-        return "case when {} then 1 else 0 end".format(var2tab_col(node,var,False))
+        return "case when {} then 1 else 0 end".format(var2tab_col(node,var,False,packed))
     else:
         return "{}.size".format(var2tab_alias(node,var))
 
@@ -0,0 +1,149 @@
+# -*- coding: future_fstrings -*-
+# Solves independent subtrees of the decomposition in worker processes (--execution-mode process)
+#
+# The decomposition is split by TreeDecomp.partition, each subtree part is solved by a forked
+# process with its own connection pool and worker threads (SQL generation is not serialized by
+# the GIL of a single process), the remaining top part by worker threads of this process.
+# Processes only report their finished nodes (and rows) through a queue, the parents of the
+# subtree roots in the top part wait for these signals instead of the worker futures.
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+
+from dpdb.db import DB
+
+logger = logging.getLogger(__name__)
+
+class ProcessEngine(object):
+    def __init__(self, problem, processes = None):
+        if not hasattr(problem.pool, "fork"):
+            raise ValueError("--execution-mode process requires db.backend postgres")
+        try:
+            self.ctx = multiprocessing.get_context("fork")
+        except ValueError:
+            raise ValueError("--execution-mode process requires fork(), which is not available on this platform")
+        self.problem = problem
+        self.processes = processes or os.cpu_count() or 1
+        self.parts = problem.td.partition(self.processes)
+        # connections are split among the processes
+        self.threads = max(1, problem.max_worker_threads // len(self.parts))
+
+    # runs in the forked process, reports ("node", id, rows) per solved node and ("end", part, error)
+    def run_part(self, part, q):
+        p = self.problem
+        error = None
+        try:
+            # the connections and locks of the parent are neither used nor closed here
+            self.inherited = (p.pool, p.pools, p.db)
+            # one more connection for the metadata (p.db)
+            p.pool = p.pool.fork(self.threads + 1)
+            p.pools = [p.pool]
+            p.db = DB.from_pool(p.pool)
+            p.db.set_praefix(f"p{p.id}_")
+            p._active = {}
+            p._active_lock = threading.Lock()
+            p.worker_processes = []
+            p.tracer = None
+            p.progress = None
+            p.cancel_on_error = True
+            for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGUSR1):
+                signal.signal(sig, lambda sig, frame: p.cancel())
+
+            def report(future):
+                if not p.interrupted:
+                    node = future.result()
+                    q.put(("node", node.id, p.node_rows.get(node.id)))
+
+            workers = {}
+            with ThreadPoolExecutor(self.threads, thread_name_prefix=f"part{part}") as ex:
+                for n in self.parts[part]:
+                    workers[n.id] = ex.submit(p.node_worker, n, workers)
+                    workers[n.id].add_done_callback(report)
+            if p.error:
+                error = repr(p.error)
+            elif p.interrupted:
+                error = "interrupted"
+            p.db.close()
+            p.pool.closeall()
+        except Exception as e:
+            logger.exception("Error in part %d", part)
+            error = repr(e)
+        q.put(("end", part, error))
+
+    # like Problem.worker_error for a failed process
+    def fail(self, error):
+        p = self.problem
+        logger.error("Error in worker process, %s", error)
+        p.error = p.error or RuntimeError(error)
+        if p.cancel_on_error:
+            p.cancel()
+        else:
+            os.kill(os.getpid(), signal.SIGUSR1)
+
+    # waits for the signals of the processes, completes the futures of their nodes
+    def listen(self, q, futures):
+        p = self.problem
+        nodes = {n.id: n for part in self.parts[1:] for n in part}
+        ended = set()
+        while len(ended) < len(self.procs):
+            try:
+                msg = q.get(timeout=1)
+            except queue.Empty:
+                # a process that died without reporting its end
+                for part, proc in self.procs.items():
+                    if part not in ended and proc.exitcode is not None and not proc.is_alive():
+                        ended.add(part)
+                        if not p.interrupted:
+                            self.fail(f"process of part {part} exited with {proc.exitcode}")
+                continue
+            if msg[0] == "node":
+                _, node_id, rows = msg
+                p.node_rows[node_id] = rows
+                if p.progress:
+                    p.progress.node_finished(nodes[node_id], rows, 0)
+                futures[node_id].set_result(nodes[node_id])
+            else:
+                _, part, error = msg
+                ended.add(part)
+                logger.debug("Part %d finished", part)
+                if error and not p.interrupted:
+                    self.fail(f"part {part}: {error}")
+        # parents waiting for unsolved nodes of failed parts
+        for f in futures.values():
+            if not f.done():
+                f.set_result(None)
+
+    def solve(self, executor = None):
+        p = self.problem
+        if len(self.parts) == 1:
+            p.solve_workers(executor)
+            return
+        logger.info("Solving %d subtree parts in processes (%d threads each), %d nodes on top",
+            len(self.parts) - 1, self.threads, len(self.parts[0]))
+        q = self.ctx.Queue()
+        futures = {n.id: Future() for part in self.parts[1:] for n in part}
+        self.procs = {}
+        # forked before the worker threads of the top part are started
+        for part in range(1, len(self.parts)):
+            self.procs[part] = self.ctx.Process(target=self.run_part, args=(part, q), name=f"dpdb-part-{part}", daemon=True)
+            self.procs[part].start()
+        p.worker_processes = list(self.procs.values())
+        listener = threading.Thread(target=self.listen, args=(q, futures), name="part-listener", daemon=True)
+        listener.start()
+
+        workers = dict(futures)
+        with nullcontext(executor) if executor else ThreadPoolExecutor(self.threads) as ex:
+            for n in self.parts[0]:
+                workers[n.id] = ex.submit(p.node_worker, n, workers)
+            for n in self.parts[0]:
+                workers[n.id].result()
+        listener.join()
+        for proc in self.procs.values():
+            proc.join()
+        p.worker_processes = []
@@ -0,0 +1,122 @@
+# -*- coding: future_fstrings -*-
+import logging
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# tracks solved nodes of a tree decomposition and estimates the remaining time
+# nodes are weighted by 2^bag width, the worst case number of rows of a node
+class Progress(object):
+    def __init__(self, td, problem_id = None):
+        self.problem_id = problem_id
+        self.weights = {n.id: 2 ** len(n.vertices) for n in td.nodes}
+        self.total_weight = sum(self.weights.values())
+        self.total_nodes = len(self.weights)
+        self.done_nodes = 0
+        self.done_weight = 0
+        self.rows = 0
+        self.bytes = 0
+        self.active = set()
+        self.start = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._server = None
+
+    def node_started(self, node):
+        with self._lock:
+            if self.start is None:
+                self.start = time.time()
+            self.active.add(node.id)
+
+    def node_finished(self, node, rows, num_bytes):
+        with self._lock:
+            self.active.discard(node.id)
+            self.done_nodes += 1
+            self.done_weight += self.weights[node.id]
+            self.rows += rows or 0
+            self.bytes += num_bytes or 0
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start if self.start else 0.0
+
+    # seconds until all nodes are solved, None as long as no node finished
+    @property
+    def eta(self):
+        if not self.done_weight:
+            return None
+        return self.elapsed * (self.total_weight - self.done_weight) / self.done_weight
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "nodes_total": self.total_nodes,
+                "nodes_done": self.done_nodes,
+                "nodes_active": len(self.active),
+                "weight_done_ratio": self.done_weight / self.total_weight,
+                "rows_total": self.rows,
+                "bytes_total": self.bytes,
+                "elapsed_seconds": self.elapsed,
+                "eta_seconds": self.eta
+            }
+
+    def metrics(self):
+        help = {
+            "nodes_total": "Number of tree decomposition nodes",
+            "nodes_done": "Number of solved nodes",
+            "nodes_active": "Number of nodes currently being solved",
+            "weight_done_ratio": "Solved fraction of nodes weighted by 2^bag width",
+            "rows_total": "Rows written to node tables",
+            "bytes_total": "Bytes of node tables",
+            "elapsed_seconds": "Seconds since the first node started",
+            "eta_seconds": "Estimated seconds until all nodes are solved"
+        }
+        labels = f'{{problem="{self.problem_id}"}}' if self.problem_id is not None else ""
+        lines = []
+        for name, value in self.snapshot().items():
+            lines.append(f"# HELP dpdb_{name} {help[name]}")
+            lines.append(f"# TYPE dpdb_{name} gauge")
+            lines.append(f"dpdb_{name}{labels} {value if value is not None else float('nan')}")
+        return "\n".join(lines) + "\n"
+
+    def log(self):
+        eta = self.eta
+        logger.info("%d/%d nodes (%.1f%% weighted), %d active, %d rows, %.1f MB, elapsed %.0fs, ETA %s",
+            self.done_nodes, self.total_nodes, 100.0 * self.done_weight / self.total_weight, len(self.active),
+            self.rows, self.bytes / 2**20, self.elapsed, f"{eta:.0f}s" if eta is not None else "unknown")
+
+    def serve(self, port, host = "localhost"):
+        progress = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = progress.metrics().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="progress-http", daemon=True).start()
+        logger.info("Serving progress on http://%s:%d/metrics", host, port)
+
+    def log_every(self, interval):
+        def run():
+            while not self._stop.wait(interval):
+                self.log()
+        threading.Thread(target=run, name="progress-log", daemon=True).start()
+
+    # can be called repeatedly
+    def stop(self):
+        self._stop.set()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,228 @@
+# -*- coding: future_fstrings -*-
+import csv
+import logging
+import os
+import subprocess
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+
+from dpdb.reader import TdReader
+from dpdb.writer import StreamWriter, FileWriter
+from dpdb.treedecomp import TreeDecomp
+from dpdb.progress import Progress
+from dpdb.incremental import incremental_td
+from dpdb.costmodel import CostModel, makespan, report
+
+logger = logging.getLogger("dpdb")
+
+def read_cfg(cfg_file):
+    import json
+
+    with open(cfg_file) as c:
+        cfg = json.load(c)
+    return cfg
+
+def flatten_cfg(dd, filter=[], separator='.', prefix=''):
+    if prefix.startswith(tuple(filter)):
+        return {}
+
+    if isinstance(dd, dict):
+        return { prefix + separator + k if prefix else k : v
+            for kk, vv in dd.items()
+            for k, v in flatten_cfg(vv, filter, separator, kk).items()
+                if not (prefix + separator + k).startswith(tuple(filter))
+            }
+    elif isinstance(dd, list):
+        return { prefix : " ".join(map(str, dd)) }
+    else:
+        return { prefix : dd }
+
+def decompose(cfg, problem, file, seed, **kwargs):
+    logger.info("Using tree decomposition seed: {}".format(seed))
+    # Run htd
+    p = subprocess.Popen([cfg["htd"]["path"], "--seed", str(seed), *cfg["htd"]["parameters"]], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    logger.info("Parsing input file")
+    input = problem.prepare_input(file)
+    if "gr_file" in kwargs and kwargs["gr_file"]:
+        logger.info("Writing graph file")
+        with FileWriter(kwargs["gr_file"]) as fw:
+            fw.write_gr(*input)
+    logger.info("Running htd")
+    StreamWriter(p.stdin).write_gr(*input)
+    p.stdin.close()
+    tdr = TdReader.from_stream(p.stdout)
+    p.wait()
+
+    logger.info("Parsing tree decomposition")
+    td = TreeDecomp(tdr.num_bags, tdr.tree_width, tdr.num_orig_vertices, tdr.root, tdr.bags, tdr.adjacency_list)
+    logger.info(f"#bags: {td.num_bags} tree_width: {td.tree_width} #vertices: {td.num_orig_vertices} #leafs: {len(td.leafs)} #edges: {len(td.edges)}")
+    if "td_file" in kwargs and kwargs["td_file"]:
+        with FileWriter(kwargs["td_file"]) as fw:
+            fw.write_td(tdr.num_bags, tdr.tree_width, tdr.num_orig_vertices, tdr.root, tdr.bags, td.edges)
+    return td
+
+# decomposes with candidates seeds and keeps the decomposition with the shortest predicted time
+# (the smallest sum of 2^bag size without a cost model)
+def choose_td(cfg, problem, file, seed, model = None, candidates = 1, **kwargs):
+    if candidates <= 1:
+        return decompose(cfg, problem, file, seed, **kwargs)
+    best = None
+    for s in range(seed * candidates, (seed + 1) * candidates):
+        td = decompose(cfg, problem, file, s, **kwargs)
+        if model:
+            score = makespan(td, model.predict(problem, td), problem.max_worker_threads)
+        else:
+            score = sum(2 ** len(n.vertices) for n in td.nodes)
+        logger.info("Seed %d: score %.4g", s, score)
+        if best is None or score < best[0]:
+            best = (score, s, td)
+    logger.info("Using tree decomposition of seed %d", best[1])
+    return best[2]
+
+# solves a single instance, retrying with the next seed if the budget is exceeded
+# running: set of problems currently being solved (to interrupt them)
+# warm_up: WarmUp shared by concurrently solved problems
+# track_progress: attach a Progress to the problem even if it is neither served nor logged
+# backend_pools: pools of additional backends (see Problem.set_backends)
+# cancel_on_error: a failed node only cancels this problem (see Problem.worker_error)
+def run_problem(cfg, cls, file, pool, tracer = None, executor = None, running = None, warm_up = None, track_progress = False, backend_pools = [],
+        cancel_on_error = False, **kwargs):
+    retries = 0
+    if "budget" in cfg["dpdb"] and "retries" in cfg["dpdb"]["budget"]:
+        retries = cfg["dpdb"]["budget"]["retries"]
+    for attempt in range(retries + 1):
+        seed = kwargs["runid"] + attempt
+        problem = cls(file,pool, **cfg["dpdb"], attempt=attempt, **kwargs)
+        problem.cancel_on_error = cancel_on_error
+        if running is not None:
+            running.add(problem)
+        try:
+            model = CostModel.load(problem.db, problem.type)
+            dry_run = "dry_run" in kwargs and kwargs["dry_run"]
+            if dry_run and not model:
+                logger.info("No stored cost model, training on the history")
+                model = CostModel.train(problem.db, problem.type)
+            if problem.incremental_from:
+                td = incremental_td(problem, file)
+            else:
+                td = choose_td(cfg, problem, file, seed, model, kwargs["td_candidates"] if "td_candidates" in kwargs and kwargs["td_candidates"] else 1, **kwargs)
+            problem.set_td(td)
+            if model:
+                problem.set_cost_model(model)
+            if dry_run:
+                report(td, problem.predictions, problem.max_worker_threads)
+                return problem
+            if hasattr(pool, "pool_for"):
+                problem.set_pool(pool.pool_for(td, problem.exact_columns()))
+                logger.info("Solving with %s", problem.db.name)
+            if backend_pools:
+                problem.set_backends(backend_pools)
+            with warm_up.setup() if warm_up else nullcontext():
+                problem.setup()
+            if "faster" not in kwargs or not kwargs["faster"]:
+                problem.store_cfg(flatten_cfg(cfg,("db.dsn","db.backends","db_admin","htd.path")))
+            problem.tracer = tracer
+            if track_progress or ("progress_port" in kwargs and kwargs["progress_port"]) or ("progress_interval" in kwargs and kwargs["progress_interval"]):
+                problem.progress = Progress(td, problem.id)
+                if "progress_port" in kwargs and kwargs["progress_port"]:
+                    problem.progress.serve(kwargs["progress_port"])
+                if "progress_interval" in kwargs and kwargs["progress_interval"]:
+                    problem.progress.log_every(kwargs["progress_interval"])
+            problem.solve(executor)
+            if problem.progress:
+                problem.progress.stop()
+                problem.progress.log()
+        finally:
+            # also stops the logger thread and frees --progress-port of a failed instance (batch, daemon)
+            if problem.progress:
+                problem.progress.stop()
+            if running is not None:
+                running.discard(problem)
+        if not problem.budget_exceeded:
+            break
+        if attempt < retries:
+            logger.warning("Retrying with tree decomposition seed %d", seed + 1)
+        else:
+            logger.error("Budget exceeded, giving up after %d attempts", attempt + 1)
+    return problem
+
+# input files of a batch: all files of a directory or the lines of a manifest file
+def batch_files(path):
+    if os.path.isdir(path):
+        return [os.path.join(path, f) for f in sorted(os.listdir(path))
+            if not f.startswith(".") and os.path.isfile(os.path.join(path, f))]
+    files = []
+    with open(path) as manifest:
+        for line in manifest:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                files.append(os.path.join(os.path.dirname(path), line))
+    return files
+
+# serializes setups until the first one succeeded, which creates the shared base tables
+class WarmUp(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._done = False
+
+    @contextmanager
+    def setup(self):
+        if self._done:
+            yield
+            return
+        self._lock.acquire()
+        if self._done:
+            self._lock.release()
+            yield
+            return
+        try:
+            yield
+            self._done = True
+        finally:
+            self._lock.release()
+
+BATCH_FIELDS = ("file", "id", "status", "result", "num_bags", "tree_width", "num_vertices", "wall_time")
+
+# solves all instances of a batch concurrently with a shared pool and node executor
+# returns a list of result dicts (see BATCH_FIELDS)
+def run_batch(cfg, cls, files, pool, jobs, tracer = None, running = None, **kwargs):
+    # the problem connections of all jobs must leave room for node workers
+    if cfg["db"]["max_connections"] <= jobs:
+        raise ValueError(f"max_connections ({cfg['db']['max_connections']}) must be larger than the number of batch jobs ({jobs})")
+    max_worker_threads = cfg["dpdb"]["max_worker_threads"] if "max_worker_threads" in cfg["dpdb"] else 12
+    warm_up = WarmUp()
+
+    def job(file):
+        start = time.time()
+        res = {"file": file, "status": "ok"}
+        try:
+            # errors of one instance must not stop the others
+            problem = run_problem(cfg, cls, file, pool, tracer, node_executor, running, warm_up, cancel_on_error=True, **kwargs)
+            res.update(id=problem.id, result=problem.result, num_bags=problem.td.num_bags,
+                tree_width=problem.td.tree_width, num_vertices=problem.td.num_orig_vertices)
+            if problem.error:
+                res["status"] = f"error: {problem.error}"
+            elif problem.budget_exceeded:
+                res["status"] = "budget_exceeded"
+            elif problem.interrupted:
+                res["status"] = "interrupted"
+        except Exception as e:
+            logger.exception("Error solving %s", file)
+            res["status"] = f"error: {e}"
+        res["wall_time"] = time.time() - start
+        logger.info("%s: %s %s", file, res["status"], res["result"] if "result" in res else "")
+        return res
+
+    with ThreadPoolExecutor(max_worker_threads, thread_name_prefix="node") as node_executor:
+        with ThreadPoolExecutor(jobs, thread_name_prefix="job") as job_executor:
+            return list(job_executor.map(job, files))
+
+def write_results(fname, results):
+    with open(fname, "w", newline="") as f:
+        w = csv.DictWriter(f, BATCH_FIELDS)
+        w.writeheader()
+        for r in results:
+            w.writerow(r)
@@ -0,0 +1,99 @@
+# -*- coding: future_fstrings -*-
+# Renders the SQL of each node once, shared by setup and solve (and by later runs with --sql-cache)
+#
+# Candidates and assignment queries are compiled by dpdb.db.compile_dynamic_tabs, a single regular
+# expression pass over each generated query (once per node and variant, not once per use) that
+# quotes the names of node tables with a placeholder for the praefix of the problem.
+# DB.bind_praefix fills it in by a plain string replacement for each database.
+# Queries depending on the solved children (candidate store of --candidate-store auto, order of
+# --join-plan reduce) are cached per variant.
+#
+# With a directory, the compiled queries are stored in a file per input, tree decomposition and
+# SQL relevant options, re-runs of the same instance load them instead of generating them.
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from dpdb.db import compile_dynamic_tabs
+
+logger = logging.getLogger(__name__)
+
+SQL_CACHE_VERSION = 1
+
+class SqlCache(object):
+    def __init__(self, problem, path = None):
+        self.problem = problem
+        self.path = path
+        # node id -> {kind and variant: compiled query}
+        self.sql = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._file = None
+
+    # hash of everything the generated SQL depends on
+    def key(self):
+        p = self.problem
+        h = hashlib.sha256()
+        h.update(f"{SQL_CACHE_VERSION} {p.type} {p.db.name}".encode())
+        if os.path.isfile(p.name):
+            with open(p.name, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+        else:
+            h.update(p.name.encode())
+        h.update(repr([(n.id, n.vertices, [c.id for c in n.children]) for n in p.td.nodes]).encode())
+        h.update(repr(p.sql_options()).encode())
+        return h.hexdigest()
+
+    def file_name(self):
+        if self._file is None:
+            self._file = os.path.join(self.path, f"{self.key()}.json")
+        return self._file
+
+    def load(self):
+        if not self.path or not os.path.exists(self.file_name()):
+            return
+        with open(self.file_name()) as f:
+            self.sql.update(json.load(f)["sql"])
+        logger.info("Loaded SQL of %d nodes from %s", len(self.sql), self.file_name())
+
+    def save(self):
+        if not self.path or not self._dirty:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        fname = self.file_name()
+        with self._lock:
+            data = {"version": SQL_CACHE_VERSION, "type": self.problem.type, "sql": {n: dict(q) for n, q in self.sql.items()}}
+            self._dirty = False
+        with open(fname + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(fname + ".tmp", fname)
+        logger.debug("Stored SQL of %d nodes in %s", len(data["sql"]), fname)
+
+    def variant(self, node):
+        p = self.problem
+        v = p.node_candidate_store(node)
+        if p.reduce_join(node):
+            v += ":" + ",".join(str(c.id) for c in sorted(node.children, key=lambda c: (p.node_rows.get(c.id, 0), c.id)))
+        return v
+
+    # compiled query of node, kind "candidates" or "assignment"
+    def get(self, node, kind):
+        key = f"{kind}:{self.variant(node)}"
+        with self._lock:
+            if str(node.id) in self.sql and key in self.sql[str(node.id)]:
+                return self.sql[str(node.id)][key]
+        p = self.problem
+        q = compile_dynamic_tabs(p.candidates_select(node) if kind == "candidates" else p.assignment_view(node))
+        with self._lock:
+            self.sql.setdefault(str(node.id), {})[key] = q
+            self._dirty = True
+        return q
+
+    # queries of a solved node are only kept to be stored
+    def release(self, node):
+        if not self.path:
+            with self._lock:
+                self.sql.pop(str(node.id), None)
@@ -0,0 +1,191 @@
+# -*- coding: future_fstrings -*-
+# Reuses node tables of subtrees that are identical up to renaming of vertices
+#
+# Vertices of a subtree are relabeled by their rank among all vertices of the subtree,
+# i.e. subtrees are recognized if one is an order preserving renaming of the other
+# (e.g. shifted variables of unrolled transition systems or grid graphs).
+# The canonical form consists of the relabeled bags, the relabeled filters of the problem
+# (Problem.cache_key) and the stored vertices of the subtree's root.
+#
+# Within an instance the first subtree (in postorder) is solved, isomorphic subtrees copy
+# its table. Across instances tables are kept in shared subtree_cache_* tables listed in
+# subtree_cache, these are evicted least recently used first once max_bytes is exceeded.
+import hashlib
+import logging
+
+from psycopg2 import sql
+
+logger = logging.getLogger(__name__)
+
+SUBTREE_CACHE_DEFAULTS = {
+    # total size of the cached tables of all problems
+    "max_bytes": 10 * 2**30,
+    # smaller subtrees are not stored in the cache (but still reused within an instance)
+    "min_nodes": 2
+}
+
+def create_cache_table(db):
+    db.ignore_next_praefix()
+    db.create_table("subtree_cache", [
+        ("hash", "VARCHAR(64) NOT NULL PRIMARY KEY"),
+        ("type", "VARCHAR(32) NOT NULL"),
+        ("tab", "VARCHAR(255) NOT NULL"),
+        ("nodes", "INTEGER"),
+        ("rows", "BIGINT"),
+        ("bytes", "BIGINT"),
+        ("hits", "INTEGER DEFAULT 0"),
+        ("created", "TIMESTAMP"),
+        ("last_used", "TIMESTAMP")
+    ])
+
+class SubtreeCache(object):
+    def __init__(self, problem, max_bytes = None, min_nodes = None):
+        self.problem = problem
+        self.max_bytes = max_bytes if max_bytes is not None else SUBTREE_CACHE_DEFAULTS["max_bytes"]
+        self.min_nodes = min_nodes if min_nodes is not None else SUBTREE_CACHE_DEFAULTS["min_nodes"]
+        # canonical hash and relabeling of each node
+        self.hashes = {}
+        self.labels = {}
+        self.sizes = {}
+        # node id -> node whose table is copied
+        self.sources = {}
+        # node id -> cached table
+        self.hits = {}
+        # nodes below reused subtrees, not solved at all
+        self.skipped = set()
+
+    # returns whether all nodes have a cache key (the problem supports caching)
+    def hash_nodes(self):
+        p = self.problem
+        nodes = p.td.nodes
+        pos = {n.id: i for i, n in enumerate(nodes)}
+        start = {}
+        for i, n in enumerate(nodes):
+            start[n.id] = min([i] + [start[c.id] for c in n.children])
+        for n in nodes:
+            # subtrees are contiguous in postorder
+            subtree = nodes[start[n.id]:pos[n.id] + 1]
+            label = {v: i for i, v in enumerate(sorted(set(v for m in subtree for v in m.vertices)))}
+            reps = {}
+            for m in subtree:
+                key = p.cache_key(m, label)
+                if key is None:
+                    return False
+                reps[m.id] = (tuple(sorted(label[v] for v in m.vertices)), key, tuple(sorted(reps[c.id] for c in m.children)))
+            rep = (p.type, tuple(sorted(label[v] for v in n.stored_vertices)), reps[n.id])
+            self.hashes[n.id] = hashlib.sha256(repr(rep).encode()).hexdigest()
+            self.labels[n.id] = label
+            self.sizes[n.id] = len(subtree)
+        return True
+
+    # decides top down which nodes are copied from the cache or from an isomorphic subtree
+    def plan(self, db):
+        p = self.problem
+        create_cache_table(db)
+        db.ignore_next_praefix()
+        cached = dict(db.select_all("subtree_cache", ["hash", "tab"], [f"type = '{p.type}'"]))
+
+        nodes = p.td.nodes
+        pos = {n.id: i for i, n in enumerate(nodes)}
+        # preorder visiting children in the same order as the postorder
+        start = {}
+        for i, n in enumerate(nodes):
+            start[n.id] = min([i] + [start[c.id] for c in n.children])
+        first = {}
+        for n in sorted(nodes, key=lambda n: (start[n.id], -pos[n.id])):
+            if n.id in self.skipped:
+                continue
+            h = self.hashes[n.id]
+            if h in cached:
+                self.hits[n.id] = cached[h]
+            elif h in first:
+                # solved earlier in postorder, i.e. submitted before this node
+                self.sources[n.id] = first[h]
+            else:
+                first[h] = n
+                continue
+            self.skipped.update(m.id for m in nodes[start[n.id]:pos[n.id]])
+
+        for h in set(self.hashes[n] for n in self.hits):
+            db.ignore_next_praefix()
+            db.update("subtree_cache", ["hits", "last_used"], ["hits + 1", "statement_timestamp()"], [f"hash = '{h}'"])
+        db.commit()
+        logger.info("Subtree cache: %d hits, %d subtrees reused within the instance, %d nodes skipped",
+            len(self.hits), len(self.sources), len(self.skipped))
+
+    def source(self, node):
+        return self.sources.get(node.id)
+
+    def reused(self, node):
+        return node.id in self.sources or node.id in self.hits
+
+    # fills the table of node from its source, column names are mapped through the canonical labels
+    def copy(self, node, db):
+        p = self.problem
+        label = self.labels[node.id]
+        extra = [c for c, _ in p.td_node_extra_columns()]
+        if node.id in self.hits:
+            tab = self.hits[node.id]
+            cols = [f"c{label[v]}" for v in node.vertices]
+        else:
+            src = self.sources[node.id]
+            tab = f"td_node_{src.id}"
+            src_var = {i: v for v, i in self.labels[src.id].items()}
+            cols = [f"v{src_var[label[v]]}" for v in node.vertices]
+        select = db.replace_dynamic_tabs("SELECT {} FROM {}".format(
+            ",".join([f"{c} v{v}" for c, v in zip(cols, node.vertices)] + extra), tab))
+        if "faster" in p.kwargs and p.kwargs["faster"]:
+            db.create_select(f"td_node_{node.id}", select, **p.node_table_options(node))
+        else:
+            db.update("td_node_status",["start_time"],["statement_timestamp()"],[f"node = {node.id}"])
+            db.insert_select(f"td_node_{node.id}", select)
+            row_cnt = db.last_rowcount
+            db.update("td_node_status",["end_time","rows"],["statement_timestamp()",str(row_cnt)],[f"node = {node.id}"])
+        p.node_rows[node.id] = db.last_rowcount
+        db.commit()
+        logger.debug("Copied node %d from %s", node.id, tab)
+
+    # stores the table of a solved node unless it is already cached
+    def store(self, node, db):
+        p = self.problem
+        if self.sizes[node.id] < self.min_nodes:
+            return
+        h = self.hashes[node.id]
+        db.ignore_next_praefix()
+        if db.select("subtree_cache", ["count(*)"], [f"hash = '{h}'"])[0]:
+            return
+        label = self.labels[node.id]
+        tab = f"subtree_cache_{h[:24]}"
+        select = db.replace_dynamic_tabs("SELECT {} FROM {}".format(
+            ",".join([f"v{v} c{label[v]}" for v in node.vertices] + [c for c, _ in p.td_node_extra_columns()]),
+            f"td_node_{node.id}"))
+        db.ignore_next_praefix()
+        db.drop_table(tab)
+        db.ignore_next_praefix()
+        db.create_select(tab, select)
+        rows = db.last_rowcount
+        db.ignore_next_praefix()
+        num_bytes = db.relation_size(tab)
+        db.ignore_next_praefix()
+        db.insert("subtree_cache", ("hash", "type", "tab", "nodes", "rows", "bytes", "created", "last_used"),
+            (h, p.type, tab, self.sizes[node.id], rows, num_bytes, None, None))
+        db.ignore_next_praefix()
+        db.update("subtree_cache", ["created", "last_used"], ["statement_timestamp()", "statement_timestamp()"], [f"hash = '{h}'"])
+        db.commit()
+
+    # drops least recently used tables until the cache fits into max_bytes
+    def evict(self, db):
+        db.ignore_next_praefix()
+        entries = db.select_all("subtree_cache", ["hash", "tab", "coalesce(bytes,0)", "last_used"])
+        total = 0
+        evicted = 0
+        for h, tab, num_bytes, _ in sorted(entries, key=lambda e: (e[3] is not None, e[3]), reverse=True):
+            total += num_bytes
+            if total > self.max_bytes:
+                db.ignore_next_praefix()
+                db.drop_table(tab)
+                db.execute(sql.SQL("DELETE FROM {} WHERE hash = %s").format(sql.Identifier("subtree_cache")), [h])
+                evicted += 1
+        db.commit()
+        if evicted:
+            logger.info("Evicted %d subtrees from the cache", evicted)
@@ -0,0 +1,43 @@
+# -*- coding: future_fstrings -*-
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+# records spans in Chrome's trace event format (chrome://tracing, Perfetto)
+class Tracer(object):
+    def __init__(self):
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self._tids = {}
+        self.events = []
+
+    def _tid(self):
+        ident = threading.get_ident()
+        if ident not in self._tids:
+            self._tids[ident] = len(self._tids) + 1
+            self.events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": self._tids[ident],
+                "args": {"name": threading.current_thread().name}})
+        return self._tids[ident]
+
+    def _ts(self, t):
+        return (t - self._t0) * 1e6
+
+    # the yielded dict can be extended with args known only at the end of the span (e.g. rows)
+    @contextmanager
+    def span(self, name, cat = "dpdb", **args):
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self.events.append({"name": name, "cat": cat, "ph": "X", "pid": os.getpid(), "tid": self._tid(),
+                    "ts": self._ts(start), "dur": self._ts(end) - self._ts(start), "args": args})
+
+    def write(self, fname):
+        with self._lock:
+            with open(fname, "w") as f:
+                json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
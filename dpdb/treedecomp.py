@@ -1,9 +1,9 @@
 class TreeDecomp(object):
     root = None
-    edges = []
-    leafs = []
 
     def __init__(self, num_bags, tree_width, num_orig_vertices, root, bags, adj):
+        self.edges = []
+        self.leafs = []
         self.num_bags = num_bags
         self.tree_width = tree_width
         self.num_orig_vertices = num_orig_vertices
@@ -45,9 +45,56 @@ class TreeDecomp(object):
             node = stack.pop()
             for c in node.children:
                 stack.append(c)
-            r.insert(0,node)
+            r.append(node)
+        r.reverse()
         return r
 
+    # splits the tree into independent subtrees that can be solved concurrently
+    # returns a list of node lists (each in postorder), the first entry is the
+    # remaining top part that can only be solved after all other parts
+    def partition(self, num_parts):
+        nodes = self.nodes
+        if num_parts <= 1:
+            return [nodes]
+
+        size = {}
+        for n in nodes:
+            size[n.id] = 1 + sum(size[c.id] for c in n.children)
+
+        top = set()
+        candidates = [self.root]
+        while len(candidates) < num_parts:
+            splittable = [c for c in candidates if c.children]
+            if not splittable:
+                break
+            largest = max(splittable, key=lambda n: size[n.id])
+            candidates.remove(largest)
+            top.add(largest.id)
+            candidates.extend(largest.children)
+
+        # distribute candidate subtrees to parts, largest first
+        parts = [[] for _ in range(num_parts)]
+        load = [0] * num_parts
+        assignment = {}
+        for c in sorted(candidates, key=lambda n: size[n.id], reverse=True):
+            part = load.index(min(load))
+            assignment[c.id] = part
+            load[part] += size[c.id]
+
+        # parents are visited before their children in reversed postorder
+        for n in reversed(nodes):
+            if n.id not in top and n.id not in assignment:
+                assignment[n.id] = assignment[n.parent.id]
+
+        top_part = []
+        for n in nodes:
+            if n.id in top:
+                top_part.append(n)
+            else:
+                parts[assignment[n.id]].append(n)
+
+        return [top_part] + [p for p in parts if p]
+
 class Node(object):
     def __init__(self, id, vertices):
         self.id = id